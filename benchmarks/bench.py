@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+"""
+Benchmark the stages of a typical nestly workflow on a synthetic nest.
+
+Builds a nest of ``--depth`` levels with ``--width`` values each in a
+temporary directory, then times ``Nest.add``, ``Nest.build``,
+``control_iter``, ``nest_map``, ``nestrun`` (running a command which exits
+immediately) and ``nestagg delim``, reporting the best wall time over
+``--repeat`` runs of each stage, and the peak memory allocated in one more
+run, traced separately as tracing slows allocation.
+
+Save results with ``--save baseline.json``, and check a later run against them
+with ``--compare baseline.json``: the exit status is nonzero if any stage is
+slower than the baseline by more than ``--threshold``.
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import os.path
+import shutil
+import signal
+import sys
+import tempfile
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from nestly import core
+from nestly.scripts import nestagg, nestrun
+
+STAGES = ('add', 'build', 'control_iter', 'nest_map', 'nestrun', 'nestagg')
+
+
+@contextlib.contextmanager
+def tempdir():
+    td = tempfile.mkdtemp(prefix='nestly-bench-')
+    try:
+        yield td
+    finally:
+        shutil.rmtree(td)
+
+
+def measure(fn, repeat):
+    """
+    Call ``fn`` ``repeat`` times, returning the best time in seconds, then
+    once more with memory tracing, returning the peak memory allocated in
+    bytes (``None`` without tracemalloc). Tracing slows allocation, so timed
+    calls are not traced.
+    """
+    times = []
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        fn()
+        times.append(timeit.default_timer() - start)
+    if tracemalloc is None:
+        return min(times), None
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(times), peak
+
+
+def make_nest(depth, width):
+    """
+    Build a nest of ``depth`` levels, each with ``width`` values. Levels are
+    added with functions, so every control is expanded.
+    """
+    nest = core.Nest()
+    values = ['v{0}'.format(i) for i in range(width)]
+    for i in range(depth):
+        nest.add('level{0}'.format(i), lambda c: values)
+    return nest
+
+
+class Benchmark(object):
+    """
+    State shared between stages: each stage uses the output of the last.
+    """
+    def __init__(self, root, depth, width, jobs):
+        self.root = root
+        self.runs = os.path.join(root, 'runs')
+        self.depth = depth
+        self.width = width
+        self.jobs = jobs
+        self.nest = None
+
+    def control_files(self):
+        return list(core.control_iter(self.runs))
+
+    def add(self):
+        self.nest = make_nest(self.depth, self.width)
+
+    def build(self):
+        if os.path.exists(self.runs):
+            shutil.rmtree(self.runs)
+        self.nest.build(self.runs)
+
+    def control_iter(self):
+        self.control_files()
+
+    def nest_map(self):
+        for _ in core.nest_map(self.control_files(), lambda d, c: len(c)):
+            pass
+
+    def nestrun(self):
+        data = {'dry_run': False,
+                'start_directory': os.getcwd(),
+                'template': 'true',
+                'template_file': None,
+                'savecmd_file': None,
+                'log_file': 'log.txt',
+                'stop_on_error': False,
+                'summary_file': None}
+        # invoke installs signal handlers which would be inherited by the
+        # worker processes of later stages
+        signums = (signal.SIGINT, signal.SIGTERM, signal.SIGUSR1)
+        handlers = [signal.getsignal(signum) for signum in signums]
+        try:
+            nestrun.invoke(self.jobs, data, self.control_files())
+        finally:
+            for signum, handler in zip(signums, handlers):
+                signal.signal(signum, handler)
+
+    def write_results(self):
+        for path in self.control_files():
+            with open(os.path.join(os.path.dirname(path), 'result.csv'),
+                      'w') as fp:
+                fp.write('x,y\n')
+                for i in range(10):
+                    fp.write('{0},{1}\n'.format(i, i * i))
+
+    def nestagg(self):
+        nestagg.main(['delim', '-o', os.path.join(self.root, 'agg.csv'),
+                      '-d', self.runs, '-k', 'level0', '-j', str(self.jobs),
+                      'result.csv'])
+
+    def run(self, stages, repeat):
+        """
+        Run ``stages`` in order, returning a dict of results for each.
+        """
+        results = {}
+        for stage in STAGES:
+            if stage not in stages:
+                # Later stages need the output of earlier ones
+                if stage in ('add', 'build'):
+                    getattr(self, stage)()
+                continue
+            if stage == 'nestagg':
+                self.write_results()
+            time, memory = measure(getattr(self, stage), repeat)
+            results[stage] = {'time': time, 'memory': memory}
+        return results
+
+
+def report(results, baseline, threshold, fp=sys.stdout):
+    """
+    Write a table of ``results``, compared to ``baseline`` if given.
+    Returns the names of stages slower than the baseline by more than
+    ``threshold``.
+    """
+    regressions = []
+    header = ['stage', 'time (s)', 'peak memory (KiB)']
+    if baseline:
+        header += ['baseline (s)', 'change']
+    fp.write('\t'.join(header) + '\n')
+    for stage in STAGES:
+        if stage not in results:
+            continue
+        r = results[stage]
+        row = [stage, '{0:.4f}'.format(r['time']),
+               '' if r['memory'] is None else str(r['memory'] // 1024)]
+        if baseline and stage in baseline:
+            base = baseline[stage]['time']
+            change = (r['time'] - base) / base if base else 0.0
+            row += ['{0:.4f}'.format(base), '{0:+.1%}'.format(change)]
+            if change > threshold:
+                row[-1] += ' REGRESSION'
+                regressions.append(stage)
+        fp.write('\t'.join(row) + '\n')
+    return regressions
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--depth', type=int, default=3,
+            help="""Number of levels in the nest (default: %(default)s)""")
+    parser.add_argument('--width', type=int, default=8,
+            help="""Number of values per level (default: %(default)s)""")
+    parser.add_argument('--repeat', type=int, default=3,
+            help="""Number of runs of each stage (default: %(default)s)""")
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+            help="""Processes for nestrun and nestagg (default:
+            %(default)s)""")
+    parser.add_argument('--stage', dest='stages', action='append',
+            choices=STAGES, help="""Stage to time. May be repeated (default:
+            all stages)""")
+    parser.add_argument('--save', metavar='FILE',
+            help="""Save results as a JSON baseline""")
+    parser.add_argument('--compare', metavar='FILE',
+            help="""Compare to a baseline saved with --save""")
+    parser.add_argument('--threshold', type=float, default=0.2,
+            help="""Fractional slowdown relative to the baseline reported as
+            a regression (default: %(default)s)""")
+    arguments = parser.parse_args(args)
+
+    # nestrun logs each process started
+    logging.basicConfig(level=logging.WARNING)
+
+    stages = arguments.stages or STAGES
+    with tempdir() as td:
+        benchmark = Benchmark(td, arguments.depth, arguments.width,
+                              arguments.jobs)
+        results = benchmark.run(stages, arguments.repeat)
+
+    baseline = None
+    if arguments.compare:
+        with open(arguments.compare) as fp:
+            saved = json.load(fp)
+        if saved['parameters'] != [arguments.depth, arguments.width,
+                                   arguments.jobs]:
+            sys.stderr.write('Warning: baseline was run with a different '
+                             'depth, width or number of jobs\n')
+        baseline = saved['stages']
+    regressions = report(results, baseline, arguments.threshold)
+
+    if arguments.save:
+        with open(arguments.save, 'w') as fp:
+            json.dump({'parameters': [arguments.depth, arguments.width,
+                                      arguments.jobs],
+                       'stages': results}, fp, indent=2)
+            fp.write('\n')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
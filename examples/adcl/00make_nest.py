@@ -39,9 +39,11 @@ def k(c):
     return range(1, n_leaves, n_leaves // 10)
 
 # Add `k` to the nest.
-# This will call k with each combination of (algorithm, tree, n_leaves).
-# Each value returned will be used as a possible value for `k`
-n.add('k', k)
+# Each value returned will be used as a possible value for `k`.
+# Since k only reads `n_leaves`, declaring it with `depends_on` means k is
+# called once per distinct number of leaves, rather than once for each
+# combination of (algorithm, tree, n_leaves).
+n.add('k', k, depends_on=['n_leaves'])
 
 # Build the nest:
 n.build('runs')
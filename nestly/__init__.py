@@ -3,6 +3,23 @@ nestly is a collection of functions designed to make running software with
 combinatorial choices of parameters easier.
 """
 
+import sys
+
 __version__ = '0.6.1'
 
-from .core import Nest, nest_map, stripext
+__all__ = ['Nest', 'nest_map', 'stripext']
+
+if sys.version_info >= (3, 7):
+    # Import nestly.core on first use, so that ``import nestly.scripts`` and
+    # ``nestly.__version__`` stay cheap.
+    def __getattr__(name):
+        if name in __all__:
+            from . import core
+            return getattr(core, name)
+        if name in ('core', 'scons'):
+            import importlib
+            return importlib.import_module('.' + name, __name__)
+        raise AttributeError(
+            "module {0!r} has no attribute {1!r}".format(__name__, name))
+else:
+    from .core import Nest, nest_map, stripext
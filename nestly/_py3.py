@@ -8,9 +8,13 @@ import sys
 py3 = sys.version_info[0] == 3
 
 if py3:
+    from io import StringIO
     imap = map
+    xrange = range
 else:
+    from StringIO import StringIO
     imap = itertools.imap
+    xrange = xrange
 
 def is_string(s):
     if py3:
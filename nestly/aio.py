@@ -0,0 +1,158 @@
+"""
+Concurrent reading of control files with :mod:`asyncio`.
+
+On network or object-store backed file systems, opening and reading each
+control file is bound by latency rather than CPU. :func:`async_nest_map`
+keeps many reads in flight on a pool of threads, yielding results as they
+arrive::
+
+    async def main():
+        async for d, control, result in async_nest_map(
+                control_iter('runs'), summarize, concurrency=64):
+            ...
+
+:func:`concurrent_nest_map` and :func:`concurrent_imap` provide the same from
+synchronous code. Requires Python 3.6 or later.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import os.path
+
+from .core import ordered_load
+
+DEFAULT_CONCURRENCY = 32
+
+def _load(path):
+    with open(path) as fp:
+        return ordered_load(fp)
+
+async def _bounded_map(fn, items, concurrency, executor, ordered):
+    """
+    Call ``fn`` on each of ``items`` in ``executor`` (or await it, if a
+    coroutine function), with at most ``concurrency`` calls in flight,
+    yielding results in the order of ``items`` if ``ordered``, otherwise as
+    they complete.
+    """
+    loop = asyncio.get_event_loop()
+    items = iter(items)
+    pending = collections.deque() if ordered else set()
+
+    def submit():
+        for item in items:
+            if asyncio.iscoroutinefunction(fn):
+                future = asyncio.ensure_future(fn(item))
+            else:
+                future = loop.run_in_executor(executor, fn, item)
+            if ordered:
+                pending.append(future)
+            else:
+                pending.add(future)
+            return True
+        return False
+
+    try:
+        while len(pending) < concurrency and submit():
+            pass
+        while pending:
+            if ordered:
+                result = await pending.popleft()
+                submit()
+                yield result
+            else:
+                done, _ = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    submit()
+                for future in done:
+                    yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+async def async_nest_map(control_files, map_fn,
+        concurrency=DEFAULT_CONCURRENCY, executor=None, ordered=False):
+    """
+    Asynchronous version of :func:`nestly.core.nest_map`, generating
+    ``(directory, control, result)`` tuples as each control file is read and
+    ``map_fn`` applied.
+
+    :param control_files: Iterable of paths to JSON control files
+    :param map_fn: Function of the directory and decoded control. A
+        coroutine function is awaited on the event loop; any other function
+        is called on the executor's threads, along with the read.
+    :param int concurrency: Maximum number of control files in flight.
+    :param executor: :class:`concurrent.futures.Executor` for reads.
+        Defaults to a thread pool of ``concurrency`` threads, shut down when
+        the generator finishes.
+    :param boolean ordered: Yield results in the order of ``control_files``
+        rather than as they complete.
+    """
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+    loop = asyncio.get_event_loop()
+
+    if asyncio.iscoroutinefunction(map_fn):
+        async def fn(path):
+            control = await loop.run_in_executor(executor, _load, path)
+            d = os.path.dirname(path)
+            return d, control, await map_fn(d, control)
+    else:
+        def fn(path):
+            control = _load(path)
+            d = os.path.dirname(path)
+            return d, control, map_fn(d, control)
+
+    try:
+        async for result in _bounded_map(fn, control_files, concurrency,
+                                         executor, ordered):
+            yield result
+    finally:
+        if own_executor:
+            executor.shutdown(wait=False)
+
+def _iterate(agen):
+    """
+    Drive the asynchronous generator ``agen`` from synchronous code, on a new
+    event loop.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        while True:
+            try:
+                yield loop.run_until_complete(agen.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(agen.aclose())
+        asyncio.set_event_loop(None)
+        loop.close()
+
+def concurrent_nest_map(control_files, map_fn,
+        concurrency=DEFAULT_CONCURRENCY, ordered=False):
+    """
+    Synchronous generator over :func:`async_nest_map`, for use outside of an
+    event loop.
+    """
+    return _iterate(async_nest_map(control_files, map_fn, concurrency,
+                                   ordered=ordered))
+
+def concurrent_imap(fn, items, concurrency=DEFAULT_CONCURRENCY, ordered=True):
+    """
+    Apply ``fn`` to each of ``items`` on a pool of ``concurrency`` threads,
+    with at most ``concurrency`` calls in flight, generating the results.
+
+    :param boolean ordered: Yield results in the order of ``items`` rather
+        than as they complete.
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+    try:
+        for r in _iterate(_bounded_map(fn, items, concurrency, executor,
+                                       ordered)):
+            yield r
+    finally:
+        executor.shutdown(wait=False)
@@ -3,20 +3,32 @@ Core functions for building nests.
 """
 
 import collections
+import contextlib
+import copy
 import errno
 import functools
+import itertools
 import json
 import os
 import os.path
+import random
+import sys
 import warnings
 
-from ._py3 import is_string, imap
+from ._py3 import is_string, imap, xrange
+from .instrument import record
 
 CONTROL_NAME = 'control.json'
+MANIFEST_NAME = 'nestly-manifest.jsonl'
+# Random draws per leaf wanted before Nest.sample stops drawing and
+# enumerates the leaves satisfying the constraints
+SAMPLE_DRAWS = 10
 
 # Load a JSON file into an ordered dict
 ordered_load = functools.partial(json.load,
         object_pairs_hook=collections.OrderedDict)
+ordered_loads = functools.partial(json.loads,
+        object_pairs_hook=collections.OrderedDict)
 
 def stripext(path):
     """
@@ -42,6 +54,36 @@ _Nestable = collections.namedtuple('Nestable', ('name', 'nestable',
                                                'create_dir', 'update',
                                                'label_func'))
 
+# A level of static values, expanded on demand
+_Level = collections.namedtuple('_Level', ('name', 'values', 'create_dir',
+                                           'label_func'))
+
+# A control in the history of a nest: the control it was derived from (or
+# ``None``, in which case ``items`` is the whole control), its output
+# directory, and the ``(key, value)`` pairs set by its level. Nodes are shared
+# between a nest and earlier states of it, so keeping an earlier state keeps
+# one small node per control rather than a copy of each control.
+_HistoryNode = collections.namedtuple('_HistoryNode', ('parent', 'outdir',
+                                                       'items'))
+
+def _rebuild(history):
+    """
+    Return the ``(outdir, control)`` pairs described by a list of history
+    nodes.
+    """
+    built = {}
+    def control(node):
+        if node.parent is None:
+            return node.items.copy()
+        key = id(node.parent)
+        parent = built.get(key)
+        if parent is None:
+            parent = built[key] = control(node.parent)
+        result = parent.copy()
+        result.update(node.items)
+        return result
+    return [(node.outdir, control(node)) for node in history]
+
 def _is_iter(iterable):
     """
     Return whether an item is iterable or not
@@ -57,6 +99,9 @@ def _repeat_iter(iterable):
         return iterable
     return repeat_iter
 
+def _format_all(templates, ctl):
+    return [i.format(**ctl) for i in templates]
+
 def _templated(fn):
     """
     Return a function which applies ``str.format(**ctl)`` to all results of
@@ -64,9 +109,94 @@ def _templated(fn):
     """
     @functools.wraps(fn)
     def inner(ctl):
-        return [i.format(**ctl) for i in fn(ctl)]
+        return _format_all(fn(ctl), ctl)
     return inner
 
+def _memo_key(control, keys):
+    """
+    Return a hashable key for the values of ``keys`` in ``control``.
+    """
+    result = []
+    for k in keys:
+        try:
+            v = control[k]
+        except KeyError:
+            raise KeyError("Missing key for depends_on: {0}".format(k))
+        try:
+            hash(v)
+        except TypeError:
+            v = json.dumps(v, sort_keys=True, default=repr)
+        result.append((type(v), v))
+    return tuple(result)
+
+def _evaluate(nestable, controls, depends_on=None, workers=None):
+    """
+    Evaluate ``nestable`` for each of ``controls``, returning a list of
+    results.
+
+    :param depends_on: If given, call ``nestable`` once for each distinct
+        combination of values for these keys.
+    :param workers: Number of threads with which to call ``nestable``.
+    """
+    calls, indices = [], []
+    seen = {}
+    for _, control in controls:
+        if depends_on is None:
+            indices.append(len(calls))
+            calls.append(control)
+            continue
+        key = _memo_key(control, depends_on)
+        if key not in seen:
+            seen[key] = len(calls)
+            calls.append(control)
+        indices.append(seen[key])
+
+    def call(control):
+        return list(nestable(control))
+
+    if workers is not None and workers > 1 and len(calls) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(workers, len(calls)))
+        try:
+            results = pool.map(call, calls)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [call(control) for control in calls]
+    return [results[i] for i in indices]
+
+def _to_digits(index, radices):
+    """
+    Convert ``index`` to a list of digits in the mixed radix ``radices``, most
+    significant first.
+    """
+    digits = []
+    for r in reversed(radices):
+        index, d = divmod(index, r)
+        digits.append(d)
+    return digits[::-1]
+
+class _Constraint(object):
+    """
+    A predicate over control dictionaries, evaluated once all of ``keys`` are
+    bound. Results are cached by the values of ``keys``.
+    """
+    def __init__(self, predicate, keys):
+        self.predicate = predicate
+        self.keys = tuple(keys)
+        self._cache = {}
+
+    def bound(self, control):
+        return all(k in control for k in self.keys)
+
+    def __call__(self, control):
+        key = _memo_key(control, self.keys)
+        result = self._cache.get(key)
+        if result is None:
+            result = self._cache[key] = bool(self.predicate(control))
+        return result
+
 class Nest(object):
     """
     Nests are used to build nested parameter selections, culminating in a
@@ -86,11 +216,14 @@ class Nest(object):
         (default: ``{}``)
     :param include_outdir: If true, include an OUTDIR key in every control
         indicating the directory this control would be written to.
+    :param profiler: An optional :class:`~nestly.instrument.NestProfiler`,
+        recording the time taken by each call to :meth:`Nest.add`.
     """
     def __init__(self, control_name=CONTROL_NAME, indent=2,
             fail_on_clash=False, warn_on_clash=True, base_dict=None,
-            include_outdir=True):
+            include_outdir=True, profiler=None):
         self.control_name = control_name
+        self.profiler = profiler
         self.indent = indent
         self.fail_on_clash = fail_on_clash
         self.warn_on_clash = warn_on_clash
@@ -100,19 +233,180 @@ class Nest(object):
         if self.include_outdir:
             base_dict['OUTDIR'] = ''
         self._controls = [('', base_dict)]
+        self._history = None
+        self._levels = []
+        self._constraints = []
+        self._index = None
+
+    @property
+    def _controls(self):
+        """
+        List of ``(outdir, control)`` pairs for the materialized levels,
+        rebuilt from the history if it was released.
+        """
+        if self._control_list is None:
+            self._control_list = _rebuild(self._history)
+        return self._control_list
+
+    @_controls.setter
+    def _controls(self, controls):
+        self._control_list = controls
+
+    def _record_history(self):
+        """
+        Start recording how each control was derived, so that
+        :meth:`_release` can drop the controls of an earlier state of this
+        nest while keeping it.
+        """
+        if self._history is None:
+            self._history = [_HistoryNode(None, outdir, control.copy())
+                             for outdir, control in self._controls]
+
+    def _release(self):
+        """
+        Drop the control dictionaries, if their history is recorded. They are
+        rebuilt from it when next needed; values are shared, but changes made
+        to the dictionaries themselves since they were added are lost.
+        """
+        if self._history is not None:
+            self._control_list = None
+            self._index = None
+
+    def _keep(self, predicate):
+        """
+        Drop the materialized controls for which ``predicate`` is false.
+        """
+        if self._history is None:
+            self._controls = [(d, c) for d, c in self._controls
+                              if predicate(c)]
+            return
+        kept = [(pair, node)
+                for pair, node in zip(self._controls, self._history)
+                if predicate(pair[1])]
+        self._controls = [pair for pair, _ in kept]
+        self._history = [node for _, node in kept]
 
     def iter(self, root=None):
         """
         Create an iterator of (directory, control_dict) tuples for all valid
         parameter choices in this :class:`Nest`.
 
+        Levels added with static values are expanded as the nest is iterated.
+        Once an iteration reaches the end, the dictionaries it created are
+        kept, so changes made to them persist to later iterations and levels
+        added later; changes made during an iteration which stops early do
+        not.
+
         :param root: Root directory
         :rtype: Generator of ``(directory, control_dictionary)`` tuples.
         """
+        if self._levels:
+            controls = self._iter_pending()
+        else:
+            controls = iter(self._controls)
         if root is None:
-            return iter(self._controls)
+            return controls
         return ((os.path.join(root, outdir), control)
-                for outdir, control in self._controls)
+                for outdir, control in controls)
+
+    def _iter_pending(self):
+        """
+        Expand the pending static levels beneath each materialized control.
+        If the nest is unchanged when the last control is produced, the
+        expanded controls replace the materialized ones.
+        """
+        levels, base, history = self._levels, self._controls, self._history
+        expanded, parents = [], []
+        for i, (outdir, control) in enumerate(base):
+            for item in self._iter_levels(outdir, control, 0):
+                expanded.append(item)
+                parents.append(i)
+                yield item
+
+        if (self._levels is not levels or self._control_list is not base or
+                self._history is not history):
+            return
+        if history is not None:
+            keys = [level.name for level in levels]
+            if self.include_outdir:
+                keys.append('OUTDIR')
+            self._history = [
+                    _HistoryNode(history[i], outdir,
+                                 tuple((k, control[k]) for k in keys))
+                    for i, (outdir, control) in zip(parents, expanded)]
+        self._controls = expanded
+        self._levels = []
+
+    def _iter_levels(self, outdir, control, i):
+        """
+        Expand the static levels from ``i`` on beneath a single control,
+        depth first.
+        """
+        level = self._levels[i]
+        last = i == len(self._levels) - 1
+        for value in level.values:
+            child = self._child(outdir, control, level.name, value,
+                                level.create_dir, False, level.label_func)
+            if child is None:
+                continue
+            if last:
+                yield child
+            else:
+                for item in self._iter_levels(child[0], child[1], i + 1):
+                    yield item
+
+    def _size(self):
+        """
+        Return the number of controls, if it can be computed without
+        enumerating pending levels; otherwise ``None``.
+        """
+        if not self._arithmetic():
+            return None
+        size = len(self._controls)
+        for level in self._levels:
+            size *= len(level.values)
+        return size
+
+    def _arithmetic(self):
+        """
+        Return whether controls can be addressed by index arithmetic over
+        level sizes: true unless a constraint involves a pending level.
+        """
+        names = set(level.name for level in self._levels)
+        if self.include_outdir and \
+                any(level.create_dir for level in self._levels):
+            names.add('OUTDIR')
+        return not any(names.intersection(c.keys) for c in self._constraints)
+
+    def _radices(self):
+        """
+        Number of choices for each digit of a leaf index: the materialized
+        controls, then each pending level.
+        """
+        return [len(self._controls)] + [len(l.values) for l in self._levels]
+
+    def _leaf(self, digits):
+        """
+        Return the ``(outdir, control)`` pair for one choice per digit of
+        :meth:`_radices`, or ``None`` if excluded by a constraint.
+        """
+        outdir, control = self._controls[digits[0]]
+        for level, d in zip(self._levels, digits[1:]):
+            child = self._child(outdir, control, level.name, level.values[d],
+                                level.create_dir, False, level.label_func)
+            if child is None:
+                return None
+            outdir, control = child
+        return outdir, control
+
+    def _materialize(self):
+        """
+        Expand any pending static levels into the list of controls.
+        """
+        levels, self._levels = self._levels, []
+        for level in levels:
+            self._expand((level.values for _ in self._controls), level.name,
+                         level.create_dir, False, level.label_func)
 
     def __iter__(self):
         """
@@ -120,22 +414,341 @@ class Nest(object):
         """
         return self.iter()
 
-    def build(self, root="runs"):
+    def build(self, root="runs", manifest=False):
         """
         Build a nested directory structure, starting in ``root``
 
         :param root: Root directory for structure
+        :param boolean manifest: Also write a manifest listing every control
+            file and its contents, one JSON object per line, to
+            :data:`MANIFEST_NAME` in ``root``, along with an offset index
+            for reading single entries. See :func:`iter_manifest` and
+            :func:`manifest_entry`.
         """
 
-        for d, control in self.iter(root):
-            _mkdirs(d)
-            with open(os.path.join(d, self.control_name), 'w') as fp:
-                json.dump(control, fp, indent=self.indent)
-                # RJSON and some other tools like a trailing newline
-                fp.write('\n')
+        _mkdirs(root)
+        with _manifest_writer(root if manifest else None) as write:
+            for outdir, control in self.iter():
+                self._write_control(root, outdir, control)
+                write(os.path.join(outdir, self.control_name), control)
+
+    def build_leaf(self, index, root="runs"):
+        """
+        Write the control file for a single control, ``self[index]``,
+        without enumerating the rest of the nest. Useful from array jobs::
+
+            nest.build_leaf(int(os.environ['SLURM_ARRAY_TASK_ID']))
+
+        :returns: Path to the control file written.
+        """
+        outdir, control = self[index]
+        return self._write_control(root, outdir, control)
+
+    def _write_control(self, root, outdir, control):
+        d = os.path.join(root, outdir)
+        _mkdirs(d)
+        path = os.path.join(d, self.control_name)
+        with open(path, 'w') as fp:
+            json.dump(control, fp, indent=self.indent)
+            # RJSON and some other tools like a trailing newline
+            fp.write('\n')
+        return path
+
+    def size(self):
+        """
+        Number of controls in the nest. Computed from the size of each level
+        unless a constraint applies to a level which has not been expanded.
+
+        Unlike ``len(nest)``, which raises :class:`OverflowError` for more
+        than ``sys.maxsize`` controls, the result is not bounded.
+        """
+        size = self._size()
+        if size is None:
+            size = sum(1 for _ in self.iter())
+        return size
+
+    def __len__(self):
+        """
+        Number of controls in the nest. See :meth:`size`.
+        """
+        return self.size()
+
+    def __bool__(self):
+        """
+        Always true, like other objects, rather than computing :meth:`size`.
+        """
+        return True
+    __nonzero__ = __bool__
+
+    def __getitem__(self, index):
+        """
+        Return the ``(directory, control_dict)`` pair at position ``index``,
+        in iteration order.
+
+        For levels added with static values this takes time proportional to
+        the depth of the nest rather than its size.
+        """
+        size = self._size()
+        if size is None:
+            # Constraints on pending levels: no arithmetic shortcut
+            if index < 0:
+                index += self.size()
+            if index >= 0:
+                for item in itertools.islice(self.iter(), index, None):
+                    return item
+        else:
+            if index < 0:
+                index += size
+            if 0 <= index < size:
+                return self._leaf(_to_digits(index, self._radices()))
+        raise IndexError("Nest index out of range")
+
+    def index_of(self, outdir, root=None):
+        """
+        Return the index of the control with directory ``outdir``, such that
+        ``self[self.index_of(outdir)][0] == outdir``.
+
+        :param outdir: Directory, as found in ``OUTDIR`` or returned by
+            :meth:`iter`.
+        :param root: Root directory ``outdir`` is relative to, if any.
+        :raises ValueError: if no control has directory ``outdir``, or the
+            directory does not determine a single control.
+
+        If a constraint applies to a level which has not been expanded, the
+        controls are scanned in order, and the first match returned.
+        """
+        if root is not None:
+            outdir = os.path.relpath(outdir, root)
+        outdir = os.path.normpath(outdir)
+        if self._size() is not None:
+            index = self._index_of(outdir)
+            if index is not None:
+                return index
+        else:
+            for i, (d, _) in enumerate(self.iter()):
+                if os.path.normpath(d) == outdir:
+                    return i
+        raise ValueError("No control with directory {0}".format(outdir))
+
+    def _index_of(self, outdir):
+        """
+        Compute the index of ``outdir`` from the labels of each pending
+        level, or return ``None`` if not present.
+        """
+        parts = [] if outdir == '.' else outdir.split(os.sep)
+        digits = []
+        for level in reversed(self._levels):
+            if not level.create_dir:
+                if len(level.values) != 1:
+                    raise ValueError(
+                        "Level {0} does not create a directory, so "
+                        "directories do not identify controls".format(
+                            level.name))
+                digits.append(0)
+                continue
+            if not parts:
+                return None
+            labels = [level.label_func(v) for v in level.values]
+            label = parts.pop()
+            if labels.count(label) > 1:
+                raise ValueError("Duplicate label {0} for level {1}".format(
+                    label, level.name))
+            if label not in labels:
+                return None
+            digits.append(labels.index(label))
+        prefix = os.path.join(*parts) if parts else ''
+        matches = [i for i, (d, _) in enumerate(self._controls)
+                   if os.path.normpath(d or '.') == os.path.normpath(
+                       prefix or '.')]
+        if not matches:
+            return None
+        if len(matches) > 1:
+            raise ValueError(
+                "Directory {0} does not identify a single control".format(
+                    prefix))
+        digits.append(matches[0])
+        index = 0
+        for r, d in zip(self._radices(), reversed(digits)):
+            index = index * r + d
+        return index
+
+    def select(self, **criteria):
+        """
+        Return the ``(directory, control_dict)`` pairs in this :class:`Nest`
+        matching all of ``criteria``, in order.
+
+        Each criterion maps a key to either a value, which must be equal; a
+        set, list or tuple of allowed values; or a function of one value
+        returning whether it is allowed. For example::
+
+            nest.select(algorithm='pam', k=lambda k: 10 <= k < 100)
+
+        The first call builds a :class:`NestIndex` over the current
+        controls, which is reused until another level is added.
+        """
+        if self._index is None:
+            self._materialize()
+            self._index = NestIndex(self._controls)
+        return self._index.select(**criteria)
+
+    def add_constraint(self, predicate, keys=None):
+        """
+        Exclude combinations of parameters from the nest.
+
+        ``predicate`` is called with a control dictionary, and should return
+        false if the control (and every control nested beneath it) should be
+        dropped. It is evaluated as soon as every key in ``keys`` has been
+        added, so branches are pruned before later levels expand them. For
+        example, to only keep ``k`` values less than the number of leaves in
+        a tree::
+
+            nest.add_constraint(lambda c: c['k'] < c['n_leaves'],
+                                keys=['k', 'n_leaves'])
+
+        :param predicate: Function of a control dictionary, returning whether
+            to keep it. It should only read the keys listed in ``keys``:
+            results are cached by their values.
+        :param keys: Keys read by ``predicate``. If ``None``, the predicate is
+            applied once to the current controls, and not to levels added
+            later.
+        """
+        if keys is None:
+            self._materialize()
+            self._keep(predicate)
+        else:
+            constraint = _Constraint(predicate, keys)
+            self._keep(lambda c: not constraint.bound(c) or constraint(c))
+            self._constraints = self._constraints + [constraint]
+        self._index = None
+
+    def sample(self, n, seed=None, method='uniform', by=None):
+        """
+        Return a new :class:`Nest` containing a sample of the controls in
+        this nest, in their original order.
+
+        Leaves are chosen by index arithmetic over the sizes of the levels
+        added with a list, tuple or other reusable collection of values, so
+        the full product is never enumerated. Levels added with a function
+        (or with ``update`` or ``template_subs``) are expanded first, and
+        sampled from as a single level.
+
+        :param int n: Number of controls to sample. For ``'stratified'``, the
+            number to sample for each value of ``by``.
+        :param seed: Seed for :class:`random.Random`, for reproducible
+            samples.
+        :param method: One of ``'uniform'``, to sample ``n`` leaves without
+            replacement; ``'lhs'``, for a Latin hypercube sample, in which
+            each level's values are chosen as evenly as possible over ``n``
+            draws (duplicate draws are only included once); or
+            ``'stratified'``, to sample ``n`` leaves for each value of
+            ``by``.
+        :param by: Key to stratify by.
+
+        Controls excluded by :meth:`add_constraint` are never returned, so a
+        sample may contain fewer than ``n`` controls.
+        """
+        if method not in ('uniform', 'lhs', 'stratified'):
+            raise ValueError("Unknown sampling method: {0}".format(method))
+        if method == 'stratified' and by is None:
+            raise ValueError("by is required for stratified sampling")
+        rng = random.Random(seed)
+        radices = self._radices()
+        if method == 'uniform':
+            leaves = self._sample_uniform(rng, n, radices, {})
+        elif method == 'stratified':
+            names = [level.name for level in self._levels]
+            if by in names:
+                position = names.index(by) + 1
+                strata = [{position: [i]} for i in xrange(radices[position])]
+            else:
+                groups = collections.OrderedDict()
+                for i, (_, control) in enumerate(self._controls):
+                    groups.setdefault(_index_key(control[by]), []).append(i)
+                strata = [{0: group} for group in groups.values()]
+            leaves = []
+            for stratum in strata:
+                leaves.extend(self._sample_uniform(rng, n, radices, stratum))
+        elif 0 in radices:
+            leaves = []
+        else:
+            columns = []
+            for r in radices:
+                column = [j * r // n for j in xrange(n)]
+                rng.shuffle(column)
+                columns.append(column)
+            leaves = []
+            for digits in sorted(set(zip(*columns))):
+                leaf = self._leaf(digits)
+                if leaf is not None:
+                    leaves.append((digits, leaf))
+
+        result = copy.copy(self)
+        result._controls = [leaf for _, leaf in sorted(leaves,
+                                                       key=lambda x: x[0])]
+        result._history = None
+        result._levels = []
+        result._index = None
+        return result
+
+    def _sample_uniform(self, rng, n, radices, allowed):
+        """
+        Sample up to ``n`` distinct leaves, returning a list of ``(digits,
+        (outdir, control))`` pairs.
+
+        :param allowed: Map from digit position to the list of values that
+            digit may take.
+        """
+        choices = [allowed.get(i) or list(xrange(r))
+                   for i, r in enumerate(radices)]
+        sizes = [len(c) for c in choices]
+        size = 1
+        for r in sizes:
+            size *= r
+
+        def leaf(j):
+            digits = tuple(c[d] for c, d in zip(choices, _to_digits(j, sizes)))
+            return digits, self._leaf(digits)
+
+        if self._arithmetic():
+            n = min(n, size)
+            if size <= sys.maxsize:
+                return [leaf(j) for j in rng.sample(xrange(size), n)]
+            # Too many leaves for random.sample, and far more than are
+            # wanted: draw indices until enough are distinct
+            drawn, seen = [], set()
+            while len(drawn) < n:
+                j = rng.randrange(size)
+                if j not in seen:
+                    seen.add(j)
+                    drawn.append(j)
+            return [leaf(j) for j in drawn]
+
+        # Some leaves are excluded by constraints: draw until enough remain,
+        # up to SAMPLE_DRAWS draws per leaf wanted
+        result, seen = [], set()
+        for _ in xrange(SAMPLE_DRAWS * n):
+            if len(result) == n or len(seen) == size:
+                return result
+            j = rng.randrange(size)
+            if j in seen:
+                continue
+            seen.add(j)
+            digits, control = leaf(j)
+            if control is not None:
+                result.append((digits, control))
+        if len(result) == n:
+            return result
+
+        # Too few leaves satisfy the constraints to find by drawing: sample
+        # the rest from those not yet drawn
+        rest = [item for item in (leaf(j) for j in xrange(size)
+                                  if j not in seen)
+                if item[1] is not None]
+        return result + rng.sample(rest, min(n - len(result), len(rest)))
 
     def add(self, name, nestable, create_dir=True, update=False,
-            label_func=str, template_subs=False):
+            label_func=str, template_subs=False, depends_on=None,
+            workers=None):
         """
         Add a level to the nest
 
@@ -156,7 +769,29 @@ class Nest(object):
         :param boolean template_subs: Should the strings in / returned by
             nestable be treated as templates? If true, str.format is called
             with the current values of the control dictionary.
+        :param depends_on: List of the keys of the control dictionary that a
+            callable nestable reads. If given, the nestable is called once for
+            each distinct combination of values of those keys, and the result
+            reused for every control dictionary sharing them. With
+            ``template_subs``, templates are still filled in from each
+            control dictionary, so they may use keys not in ``depends_on``.
+        :param int workers: If greater than one, call a callable nestable from
+            this many threads. Useful for nestables which wait on I/O, such as
+            globbing a directory or reading a file.
         """
+        if (not callable(nestable) and not update and not template_subs and
+                _is_iter(nestable) and not is_string(nestable) and
+                iter(nestable) is not nestable):
+            # A reusable collection of values: defer expansion, so the product
+            # is only enumerated when iterated over or sampled from.
+            with record(self.profiler, name, 'add') as event:
+                self._levels = self._levels + [
+                        _Level(name, list(nestable), create_dir, label_func)]
+                self._index = None
+                if event is not None:
+                    event.controls = self._size()
+            return
+
         # Convert everything to functions
         if not callable(nestable):
             if not _is_iter(nestable):
@@ -166,40 +801,268 @@ class Nest(object):
                         "Passed a string as an iterable for name {0}".format(name))
             old_nestable = nestable
             nestable = _repeat_iter(old_nestable)
-        if template_subs:
+        if template_subs and depends_on is None:
             nestable = _templated(nestable)
 
-        new_controls = []
-        for outdir, control in self._controls:
-            for r in nestable(control):
-                new_outdir, new_control = outdir, control.copy()
-                if update:
-                    # Make sure expected key exists
-                    if name not in r:
-                        raise KeyError("Missing key for {0}".format(name))
-                    # Check for collisions
-                    u = frozenset(control.keys()) & frozenset(r.keys())
-                    if u:
-                        msg = "Key overlap: {0}".format(u)
-                        if self.fail_on_clash:
-                            raise KeyError(msg)
-                        elif self.warn_on_clash:
-                            warnings.warn(msg)
-                    new_control.update(r)
-                    to_label = r[name]
-                else:
-                    new_control[name] = to_label = r
-
-                if create_dir:
-                    new_outdir = os.path.join(outdir, label_func(to_label))
-                if self.include_outdir:
-                    new_control['OUTDIR'] = new_outdir
-                new_controls.append((new_outdir, new_control))
+        self._materialize()
+        with record(self.profiler, name, 'add') as event:
+            if depends_on is not None or (workers or 1) > 1:
+                values = _evaluate(nestable, self._controls, depends_on,
+                                   workers)
+                if template_subs and depends_on is not None:
+                    # Results are shared by controls agreeing on depends_on,
+                    # which may differ in the keys the templates use
+                    values = [_format_all(rs, control) for (_, control), rs
+                              in zip(self._controls, values)]
+            else:
+                values = (nestable(control) for _, control in self._controls)
+            self._expand(values, name, create_dir, update, label_func)
+            self._index = None
+            if event is not None:
+                event.controls = len(self._controls)
 
+    def _expand(self, values, name, create_dir, update, label_func):
+        """
+        Add a level to each of the materialized controls, replacing them with
+        their children.
+
+        :param values: Iterable of the values of the nestable for each
+            control, in order.
+        """
+        history = self._history
+        new_controls = []
+        new_history = None if history is None else []
+        for i, ((outdir, control), rs) in enumerate(zip(self._controls,
+                                                        values)):
+            for r in rs:
+                child = self._child(outdir, control, name, r, create_dir,
+                                    update, label_func)
+                if child is None:
+                    continue
+                new_controls.append(child)
+                if new_history is not None:
+                    keys = list(r) if update else [name]
+                    if self.include_outdir:
+                        keys.append('OUTDIR')
+                    new_history.append(_HistoryNode(
+                        history[i], child[0],
+                        tuple((k, child[1][k]) for k in keys)))
         self._controls = new_controls
+        self._history = new_history
+
+    def _child(self, outdir, control, name, r, create_dir, update,
+            label_func):
+        """
+        Return the ``(outdir, control)`` pair adding value ``r`` of level
+        ``name`` to ``control``, or ``None`` if a constraint excludes it.
+        """
+        new_outdir, new_control = outdir, control.copy()
+        if update:
+            # Make sure expected key exists
+            if name not in r:
+                raise KeyError("Missing key for {0}".format(name))
+            # Check for collisions
+            u = frozenset(control.keys()) & frozenset(r.keys())
+            if u:
+                msg = "Key overlap: {0}".format(u)
+                if self.fail_on_clash:
+                    raise KeyError(msg)
+                elif self.warn_on_clash:
+                    warnings.warn(msg)
+            new_control.update(r)
+            to_label = r[name]
+        else:
+            new_control[name] = to_label = r
+
+        if create_dir:
+            new_outdir = os.path.join(outdir, label_func(to_label))
+        if self.include_outdir:
+            new_control['OUTDIR'] = new_outdir
+        if self._constraints:
+            # Evaluate constraints involving keys set by this level
+            changed = frozenset(r if update else (name,)) | \
+                      frozenset(['OUTDIR'])
+            if not all(c(new_control) for c in self._constraints
+                       if changed.intersection(c.keys) and
+                       c.bound(new_control)):
+                return None
+        return new_outdir, new_control
 
 
-def nest_map(control_iter, map_fn):
+class _Unhashable(object):
+    """
+    Index key for values which cannot be hashed, such as lists
+    """
+    def __init__(self, value):
+        self.key = json.dumps(value, sort_keys=True, default=repr)
+
+    def __eq__(self, other):
+        return isinstance(other, _Unhashable) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+def _index_key(value):
+    try:
+        hash(value)
+    except TypeError:
+        return _Unhashable(value)
+    return value
+
+class NestIndex(object):
+    """
+    Inverted index over a collection of control dictionaries, answering
+    queries without scanning every control.
+
+    For each key queried, an index from each distinct value to the positions
+    of the controls with that value is built on first use. Queries are then
+    answered by evaluating each criterion once per distinct value, and
+    intersecting the matching positions.
+
+    :param items: Iterable of ``(label, control_dict)`` pairs, such as
+        ``(directory, control)`` pairs from :meth:`Nest.iter` or
+        ``(path, control)`` pairs from :func:`iter_manifest`.
+    """
+    def __init__(self, items):
+        self.items = list(items)
+        self._indexes = {}
+
+    @classmethod
+    def from_control_files(cls, control_files):
+        """
+        Build an index by reading each of ``control_files``. Labels are paths
+        to control files.
+        """
+        def load(path):
+            with open(path) as fp:
+                return path, ordered_load(fp)
+        return cls(imap(load, control_files))
+
+    @classmethod
+    def from_manifest(cls, path):
+        """
+        Build an index from a manifest written by :meth:`Nest.build`. Labels
+        are paths to control files.
+        """
+        return cls(iter_manifest(path))
+
+    def __len__(self):
+        return len(self.items)
+
+    def _index(self, key):
+        index = self._indexes.get(key)
+        if index is None:
+            index = collections.OrderedDict()
+            for i, (_, control) in enumerate(self.items):
+                if key not in control:
+                    continue
+                value = control[key]
+                k = _index_key(value)
+                if k not in index:
+                    index[k] = value, []
+                index[k][1].append(i)
+            self._indexes[key] = index
+        return index
+
+    def _match(self, key, criterion):
+        """
+        Return the set of positions matching a single criterion
+        """
+        index = self._index(key)
+        if callable(criterion):
+            matches = (ids for value, ids in index.values() if criterion(value))
+        elif isinstance(criterion, (set, frozenset, list, tuple)):
+            keys = frozenset(_index_key(v) for v in criterion)
+            matches = (index[k][1] for k in keys if k in index)
+        else:
+            k = _index_key(criterion)
+            matches = [index[k][1]] if k in index else []
+        result = set()
+        for ids in matches:
+            result.update(ids)
+        return result
+
+    def ids(self, **criteria):
+        """
+        Return the sorted positions of the items matching all of
+        ``criteria``. See :meth:`Nest.select` for the form of criteria.
+        """
+        if not criteria:
+            return list(range(len(self.items)))
+        result = None
+        for key, criterion in criteria.items():
+            matches = self._match(key, criterion)
+            result = matches if result is None else result & matches
+            if not result:
+                return []
+        return sorted(result)
+
+    def select(self, **criteria):
+        """
+        Return the ``(label, control_dict)`` pairs matching all of
+        ``criteria``, in order.
+        """
+        return [self.items[i] for i in self.ids(**criteria)]
+
+@contextlib.contextmanager
+def _manifest_writer(root):
+    """
+    Context manager yielding a function which writes a line to the manifest
+    in ``root``. If ``root`` is ``None``, the function does nothing.
+    """
+    if root is None:
+        yield lambda path, control: None
+        return
+    manifest = os.path.join(root, MANIFEST_NAME)
+    offsets = [0]
+    with open(manifest, 'w') as fp:
+        def write(path, control):
+            line = json.dumps(collections.OrderedDict(
+                (('path', path), ('control', control)))) + '\n'
+            fp.write(line)
+            offsets.append(offsets[-1] + len(line.encode('utf-8')))
+        yield write
+    from .offsets import write_offsets
+    write_offsets(manifest, offsets)
+
+def iter_manifest(path):
+    """
+    Generate ``(control_path, control_dict)`` pairs from a manifest written
+    by :meth:`Nest.build`, in the order the nest was built.
+
+    :param path: Path to the manifest, or to a directory containing
+        :data:`MANIFEST_NAME`.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, MANIFEST_NAME)
+    root = os.path.dirname(path)
+    with open(path) as fp:
+        for line in fp:
+            record = ordered_loads(line)
+            yield os.path.join(root, record['path']), record['control']
+
+def manifest_entry(path, i):
+    """
+    Return entry ``i``, as a ``(control_path, control_dict)`` pair, of a
+    manifest written by :meth:`Nest.build`, using its offset index (see
+    :mod:`nestly.offsets`) to read only that line.
+
+    :param path: Path to the manifest, or to a directory containing
+        :data:`MANIFEST_NAME`.
+    :raises ValueError: if the manifest has no up-to-date offset index.
+    """
+    from .offsets import IndexedFile
+    if os.path.isdir(path):
+        path = os.path.join(path, MANIFEST_NAME)
+    with IndexedFile(path) as records:
+        record = ordered_loads(records[i].decode('utf-8'))
+    return (os.path.join(os.path.dirname(path), record['path']),
+            record['control'])
+
+def nest_map(control_iter, map_fn, processes=None):
     """
     Apply ``map_fn`` to the directories defined by ``control_iter``
 
@@ -216,9 +1079,18 @@ def nest_map(control_iter, map_fn):
     :param function map_fn: Function to run for each control file. It should
             accept two arguments: the directory of the control file and the
             json-decoded contents of the control file.
+    :param int processes: If greater than one, apply ``map_fn`` in a pool of
+            this many processes. Control files are read once, into a
+            :class:`~nestly.shared.ControlTable` in shared memory, which
+            workers index into; ``map_fn`` must be picklable where processes
+            are not forked. Results are generated in order.
     :returns: A generator of the results of applying ``map_fn`` to elements in
             ``control_iter``
     """
+    if processes is not None and processes > 1:
+        from .shared import shared_nest_map
+        return shared_nest_map(control_iter, map_fn, processes)
+
     def fn(control_path):
         """
         Read the control file, return the result of calling map_fn
@@ -231,10 +1103,15 @@ def nest_map(control_iter, map_fn):
     mapped = imap(fn, control_iter)
     return mapped
 
-def control_iter(base_dir, control_name=CONTROL_NAME):
+def control_iter(base_dir, control_name=CONTROL_NAME, sort=False):
     """
     Generate the names of all control files under base_dir
+
+    :param boolean sort: Visit directories in sorted order, so the order of
+        control files is the same on every call.
     """
-    controls = (os.path.join(p, control_name) for p, _, fs in os.walk(base_dir)
-                if control_name in fs)
-    return controls
+    for p, dirs, fs in os.walk(base_dir):
+        if sort:
+            dirs.sort()
+        if control_name in fs:
+            yield os.path.join(p, control_name)
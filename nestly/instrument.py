@@ -0,0 +1,305 @@
+"""
+Optional instrumentation of nest construction and runs.
+
+Pass a :class:`NestProfiler` to :class:`~nestly.core.Nest` to record the wall
+time, number of control dictionaries produced and memory growth of each level
+added, including targets added through :class:`~nestly.scons.SConsWrap`::
+
+    profiler = NestProfiler()
+    nest = Nest(profiler=profiler)
+    ...
+    profiler.report()
+    with open('nest-trace.json', 'w') as fp:
+        profiler.write_chrome_trace(fp)
+
+:class:`RunMetrics` does the same for each phase of each job run by
+``nestrun --metrics``.
+"""
+
+import contextlib
+import json
+import math
+import os
+import sys
+import time
+
+# tracemalloc and resource are imported when a profiler is created, so that
+# importing nestly.core does not pay for them.
+
+def _import(name):
+    try:
+        return __import__(name)
+    except ImportError:
+        return None
+
+
+class ProfileEvent(object):
+    """
+    Timing of a single nest operation
+
+    :ivar name: Name of the level or target
+    :ivar kind: Operation, e.g. ``'add'`` or ``'add_target'``
+    :ivar depth: Nesting depth; operations which call :meth:`Nest.add
+        <nestly.core.Nest.add>` contain a nested event.
+    :ivar start: Start time, in seconds since the profiler was created
+    :ivar duration: Wall time, in seconds
+    :ivar controls: Number of control dictionaries after the operation
+    :ivar memory: Memory growth in bytes, or ``None`` if unavailable. With
+        ``trace_memory``, this is the change in memory allocated by Python;
+        otherwise, the growth in peak resident set size.
+    """
+    def __init__(self, name, kind, depth, start):
+        self.name = name
+        self.kind = kind
+        self.depth = depth
+        self.start = start
+        self.duration = None
+        self.controls = None
+        self.memory = None
+
+
+class NestProfiler(object):
+    """
+    Records a :class:`ProfileEvent` for each nest operation
+
+    :param trace_memory: Use :mod:`tracemalloc` to measure memory allocated
+        during each operation. This is more precise than the default of
+        measuring peak resident set size, but slows nest construction.
+    """
+    def __init__(self, trace_memory=False):
+        self.events = []
+        self._depth = 0
+        self._origin = time.time()
+        self._tracemalloc = _import('tracemalloc') if trace_memory else None
+        self._resource = _import('resource')
+        self.trace_memory = self._tracemalloc is not None
+        if self.trace_memory and not self._tracemalloc.is_tracing():
+            self._tracemalloc.start()
+
+    def _memory(self):
+        if self.trace_memory:
+            return self._tracemalloc.get_traced_memory()[0]
+        resource = self._resource
+        if resource is not None:
+            # ru_maxrss is in kilobytes on Linux, bytes on OS X
+            scale = 1 if sys.platform == 'darwin' else 1024
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+        return None
+
+    @contextlib.contextmanager
+    def record(self, name, kind):
+        """
+        Context manager recording an operation. The caller may set
+        ``controls`` on the yielded :class:`ProfileEvent`.
+        """
+        event = ProfileEvent(name, kind, self._depth,
+                             time.time() - self._origin)
+        self.events.append(event)
+        memory = self._memory()
+        self._depth += 1
+        try:
+            yield event
+        finally:
+            self._depth -= 1
+            event.duration = time.time() - self._origin - event.start
+            if memory is not None:
+                event.memory = self._memory() - memory
+
+    def report(self, fp=sys.stderr):
+        """
+        Write a table of all events, in order, to ``fp``
+        """
+        fp.write('{0:<40} {1:>10} {2:>10} {3:>12}\n'.format(
+            'operation', 'time (s)', 'controls', 'memory (KiB)'))
+        for e in self.events:
+            label = '  ' * e.depth + '{0} {1}'.format(e.kind, e.name)
+            memory = '' if e.memory is None else '{0:.0f}'.format(
+                e.memory / 1024.0)
+            controls = '' if e.controls is None else e.controls
+            fp.write('{0:<40} {1:>10.3f} {2:>10} {3:>12}\n'.format(
+                label, e.duration, controls, memory))
+
+    def chrome_trace(self):
+        """
+        Return events in Chrome trace event format, for viewing in
+        ``chrome://tracing`` or Perfetto.
+        """
+        pid = os.getpid()
+        events = []
+        for e in self.events:
+            args = {}
+            if e.controls is not None:
+                args['controls'] = e.controls
+            if e.memory is not None:
+                args['memory_bytes'] = e.memory
+            events.append({'name': e.name, 'cat': e.kind, 'ph': 'X',
+                           'ts': e.start * 1e6, 'dur': e.duration * 1e6,
+                           'pid': pid, 'tid': 0, 'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, fp):
+        """
+        Write events to ``fp`` as Chrome trace JSON
+        """
+        json.dump(self.chrome_trace(), fp, indent=2)
+        fp.write('\n')
+
+
+@contextlib.contextmanager
+def record(profiler, name, kind):
+    """
+    Record an operation with ``profiler``, if it is not ``None``. Yields the
+    :class:`ProfileEvent`, or ``None`` without a profiler.
+    """
+    if profiler is None:
+        yield None
+    else:
+        with profiler.record(name, kind) as event:
+            yield event
+
+
+class JobEvent(object):
+    """
+    Timing of one phase of running a job with ``nestrun``
+
+    :ivar job: Path to the job's control file
+    :ivar phase: One of ``'load'`` (reading the control file), ``'render'``
+        (substituting into the template and template file), ``'write'``
+        (writing the rendered template file and command file), ``'spawn'``
+        (starting the process), ``'run'`` (from start to exit) or
+        ``'dispatch'`` (from a process slot becoming free to this job's
+        process starting)
+    :ivar start: Start time, in seconds since the epoch
+    :ivar duration: Wall time, in seconds
+    """
+    __slots__ = ('job', 'phase', 'start', 'duration')
+
+    def __init__(self, job, phase, start, duration):
+        self.job = job
+        self.phase = phase
+        self.start = start
+        self.duration = duration
+
+    def as_dict(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile ``q`` (0-100) of sorted ``values``
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(q * len(values) / 100.0))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+class RunMetrics(object):
+    """
+    Collects a :class:`JobEvent` for each phase of each job run by
+    :func:`nestly.scripts.nestrun.invoke`, passing each to ``callbacks`` as
+    it is recorded.
+
+    :param callbacks: Functions of one argument, the :class:`JobEvent`
+    :param boolean keep_events: Retain every event, for :meth:`write_jsonl`.
+        Summaries only need the durations.
+    """
+    QUANTILES = (50, 90, 99)
+
+    def __init__(self, callbacks=(), keep_events=True):
+        self.callbacks = list(callbacks)
+        self.keep_events = keep_events
+        self.events = []
+        self._durations = {}
+
+    def add(self, job, phase, start, duration=None):
+        """
+        Record a phase of ``job`` which started at ``start``, lasting
+        ``duration`` seconds, or until now if ``duration`` is ``None``.
+        """
+        if duration is None:
+            duration = time.time() - start
+        event = JobEvent(job, phase, start, duration)
+        if self.keep_events:
+            self.events.append(event)
+        self._durations.setdefault(phase, []).append(duration)
+        for callback in self.callbacks:
+            callback(event)
+        return event
+
+    @contextlib.contextmanager
+    def phase(self, job, phase):
+        """
+        Context manager recording ``phase`` of ``job``
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(job, phase, start)
+
+    def summary(self):
+        """
+        Return a dict mapping each phase to a dict of its ``count``, total
+        time (``sum``), ``max``, and percentiles (``p50``, ``p90``, ``p99``).
+        """
+        result = {}
+        for phase, durations in self._durations.items():
+            durations = sorted(durations)
+            s = {'count': len(durations), 'sum': sum(durations),
+                 'max': durations[-1]}
+            for q in self.QUANTILES:
+                s['p{0}'.format(q)] = percentile(durations, q)
+            result[phase] = s
+        return result
+
+    def report(self, fp=sys.stderr):
+        """
+        Write a table of the percentiles of each phase to ``fp``
+        """
+        columns = ['p{0}'.format(q) for q in self.QUANTILES] + ['max', 'sum']
+        fp.write('{0:<10} {1:>7}'.format('phase', 'count') +
+                 ''.join(' {0:>10}'.format(c + ' (s)') for c in columns) +
+                 '\n')
+        for phase, s in sorted(self.summary().items()):
+            fp.write('{0:<10} {1:>7}'.format(phase, s['count']) +
+                     ''.join(' {0:>10.4f}'.format(s[c]) for c in columns) +
+                     '\n')
+
+    def write_jsonl(self, fp):
+        """
+        Write each event to ``fp`` as a line of JSON
+        """
+        for event in self.events:
+            json.dump(event.as_dict(), fp)
+            fp.write('\n')
+
+    def write_prometheus(self, fp, prefix='nestrun'):
+        """
+        Write a summary of each phase to ``fp`` in the Prometheus text
+        exposition format.
+        """
+        name = prefix + '_phase_seconds'
+        fp.write('# HELP {0} Time spent in each phase of running a job\n'
+                 '# TYPE {0} summary\n'.format(name))
+        for phase, s in sorted(self.summary().items()):
+            for q in self.QUANTILES:
+                fp.write('{0}{{phase="{1}",quantile="{2}"}} {3!r}\n'.format(
+                    name, phase, q / 100.0, s['p{0}'.format(q)]))
+            fp.write('{0}_sum{{phase="{1}"}} {2!r}\n'.format(
+                name, phase, s['sum']))
+            fp.write('{0}_count{{phase="{1}"}} {2}\n'.format(
+                name, phase, s['count']))
+
+
+@contextlib.contextmanager
+def phase(metrics, job, name):
+    """
+    Record ``name`` phase of ``job`` with ``metrics``, if it is not
+    ``None``.
+    """
+    if metrics is None:
+        yield
+    else:
+        with metrics.phase(job, name):
+            yield
@@ -0,0 +1,119 @@
+"""
+Offset indexes for files of variable-length records.
+
+An offset index is a sidecar file, named by appending :data:`INDEX_SUFFIX` to
+the data file's name, listing the byte offset at which each record starts,
+followed by the offset at which the last ends. :class:`IndexedFile` maps both
+files into memory, so that any record can be read without parsing the ones
+before it.
+
+:meth:`Nest.build <nestly.core.Nest.build>` writes an index for its manifest,
+one record per line, and ``nestagg --write-index`` one for its output, one
+record per control file.
+"""
+
+import mmap
+import os
+import struct
+
+INDEX_SUFFIX = '.idx'
+
+_MAGIC = b'NSTLIDX1'
+_HEADER = struct.Struct('<8sQ')
+_OFFSET = struct.Struct('<Q')
+
+def index_path(path):
+    """
+    Return the path of the offset index for data file ``path``.
+    """
+    return path + INDEX_SUFFIX
+
+def write_offsets(path, offsets):
+    """
+    Write the offset index for data file ``path``.
+
+    :param offsets: Start of each record, then the end of the last record.
+    """
+    offsets = list(offsets)
+    with open(index_path(path), 'wb') as fp:
+        fp.write(_HEADER.pack(_MAGIC, len(offsets) - 1))
+        for i in range(0, len(offsets), 4096):
+            block = offsets[i:i + 4096]
+            fp.write(struct.pack('<{0}Q'.format(len(block)), *block))
+
+def _map(path):
+    """
+    Memory map ``path`` read-only. Empty files are returned as ``b''``.
+    """
+    with open(path, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+class IndexedFile(object):
+    """
+    Random access to the records of a data file with an offset index.
+
+    :param path: Path to the data file
+    :raises ValueError: if the index is missing, corrupt or older than the
+        data file.
+    """
+    def __init__(self, path):
+        self.path = path
+        try:
+            self._index = _map(index_path(path))
+        except (IOError, OSError):
+            raise ValueError("No offset index for {0}".format(path))
+        if len(self._index) < _HEADER.size:
+            raise ValueError("Invalid offset index for {0}".format(path))
+        magic, self._count = _HEADER.unpack_from(self._index, 0)
+        expected = _HEADER.size + _OFFSET.size * (self._count + 1)
+        if magic != _MAGIC or len(self._index) != expected:
+            raise ValueError("Invalid offset index for {0}".format(path))
+        self._data = _map(path)
+        if self._offset(self._count) != len(self._data):
+            self.close()
+            raise ValueError(
+                "Offset index for {0} is out of date".format(path))
+
+    def __len__(self):
+        return self._count
+
+    def _offset(self, i):
+        return _OFFSET.unpack_from(self._index,
+                                   _HEADER.size + _OFFSET.size * i)[0]
+
+    def span(self, i):
+        """
+        Return the ``(start, end)`` byte offsets of record ``i``.
+        """
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError("Record index out of range")
+        return self._offset(i), self._offset(i + 1)
+
+    def __getitem__(self, i):
+        """
+        Return the bytes of record ``i``.
+        """
+        start, end = self.span(i)
+        return self._data[start:end]
+
+    @property
+    def header(self):
+        """
+        Bytes preceding the first record, e.g. a header row.
+        """
+        return self._data[:self._offset(0)]
+
+    def close(self):
+        for m in (self._index, self._data):
+            if isinstance(m, mmap.mmap):
+                m.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,5 +1,6 @@
 """SCons integration for nestly."""
-from collections import OrderedDict
+from collections import namedtuple, OrderedDict
+import hashlib
 import json
 import logging
 import copy
@@ -7,14 +8,23 @@ import os
 import warnings
 
 from . import core
+from .instrument import record
 
-try:
-    import SCons.Node
-    import SCons.Node.FS
-    HAS_SCONS = True
-except ImportError:
-    warnings.warn('Unable to import SCons. Some functionality not available.')
-    HAS_SCONS = False
+def _find_module(name):
+    """
+    Return whether the top-level module ``name`` can be imported, without
+    importing it.
+    """
+    try:
+        from importlib.util import find_spec
+    except ImportError:
+        # Python < 3.4
+        import pkgutil
+        return pkgutil.find_loader(name) is not None
+    return find_spec(name) is not None
+
+# Whether SCons is available. SCons itself is only imported when needed.
+HAS_SCONS = _find_module('SCons')
 
 logger = logging.getLogger('nestly.scons')
 
@@ -23,6 +33,8 @@ class SConsEncoder(json.JSONEncoder):
     JSON Encoder which handles SCons objects.
     """
     def default(self, obj):
+        import SCons.Node
+        import SCons.Node.FS
         if isinstance(obj, SCons.Node.NodeList):
             return list(obj)
         elif isinstance(obj, (SCons.Node.FS.Entry, SCons.Node.FS.File)):
@@ -34,6 +46,31 @@ def _create_control_file(source, target, env):
     with open(target, 'w') as fp:
         json.dump(env['control_dict'], fp, indent=2, cls=env['encoder_cls'])
 
+def _write_control_files(source, target, env):
+    """
+    Write pre-serialized control files to each target. Files whose contents
+    are unchanged are not rewritten.
+    """
+    for t, contents in zip(target, env['control_contents']):
+        t = str(t)
+        try:
+            with open(t) as fp:
+                if fp.read() == contents:
+                    continue
+        except IOError:
+            pass
+        with open(t, 'w') as fp:
+            fp.write(contents)
+
+# A node in the history of an SConsWrap: the nest as it was before the level
+# ``name`` was added, and the previous checkpoint. Checkpoints form a linked
+# list, so adding a level only allocates a node, and popping to a level only
+# moves the head. The nest of a checkpoint keeps its controls only as nodes of
+# the history shared with the nests after it (see ``Nest._release``), so each
+# checkpoint costs one node per control of its level rather than a copy of
+# every control.
+_Checkpoint = namedtuple('_Checkpoint', ('name', 'nest', 'parent'))
+
 def name_targets(func):
     """
     Wrap a function such that returning ``'a', 'b', 'c', [1, 2, 3]`` transforms
@@ -61,23 +98,46 @@ class SConsWrap(object):
     :param alias_environment: An optional SCons ``Environment`` object.
         If present, targets added via :meth:`SConsWrap.add_target` will include
         an alias using the nest key.
+    :param level_aliases: If true (and ``alias_environment`` is given), also
+        add an alias ``level:value`` for each value of each level added with
+        :meth:`SConsWrap.add`, containing all targets added beneath it. For
+        example, ``scons algorithm:pam`` builds every target under
+        ``algorithm=pam``.
     """
 
-    def __init__(self, nest, dest_dir='.', alias_environment=None):
+    def __init__(self, nest, dest_dir='.', alias_environment=None,
+                 level_aliases=False):
         """Initialize an SConsWrap.
 
         Takes the Nest to operate on and the base directory for all output
         directories.
         """
         self.nest = nest
+        self.nest._record_history()
         self.dest_dir = dest_dir
         self.alias_environment = alias_environment
-        self.checkpoints = OrderedDict()
+        self.level_aliases = level_aliases
+        self._checkpoint = None
+        self._checkpoint_index = {}
 
     def __iter__(self):
         "Iterate over the current controls."
         return self.nest.iter(self.dest_dir)
 
+    @property
+    def checkpoints(self):
+        """
+        An ordered dictionary mapping the name of each level added with
+        :meth:`SConsWrap.add` to the nest before that level was added, oldest
+        first.
+        """
+        result = []
+        checkpoint = self._checkpoint
+        while checkpoint is not None:
+            result.append((checkpoint.name, checkpoint.nest))
+            checkpoint = checkpoint.parent
+        return OrderedDict(reversed(result))
+
     def add(self, name, nestable, **kw):
         """
         Adds a level to the nesting and creates a checkpoint that can be
@@ -89,8 +149,11 @@ class SConsWrap(object):
         :param kw: Additional parameters to pass to
             :meth:`Nest.add() <nestly.core.Nest.add>`.
         """
-        self.checkpoints[name] = self.nest
-        self.nest = copy.copy(self.nest)
+        nest = self.nest
+        self.nest = copy.copy(nest)
+        nest._release()
+        self._checkpoint = _Checkpoint(name, nest, self._checkpoint)
+        self._checkpoint_index[name] = self._checkpoint
         return self.nest.add(name, nestable, **kw)
 
     def pop(self, name=None):
@@ -104,16 +167,20 @@ class SConsWrap(object):
         :param name: Name of the nest level to pop.
         """
         if name is not None:
-            self.nest = self.checkpoints[name]
-            keys = list(self.checkpoints.keys())
-            name_idx = keys.index(name)
-            assert name_idx >= 0
-
-            # Pop every key from ``name`` on:
-            for k in reversed(keys[name_idx:]):
-                self.checkpoints.pop(k)
+            checkpoint = self._checkpoint_index[name]
+        elif self._checkpoint is None:
+            raise KeyError('No levels to pop')
         else:
-            self.nest = self.checkpoints.popitem()[1]
+            checkpoint = self._checkpoint
+
+        # Drop index entries for ``checkpoint`` and every level after it
+        c = self._checkpoint
+        while c is not checkpoint.parent:
+            if self._checkpoint_index.get(c.name) is c:
+                del self._checkpoint_index[c.name]
+            c = c.parent
+        self._checkpoint = checkpoint.parent
+        self.nest = checkpoint.nest
 
     def add_nest(self, name=None, **kw):
         """A simple decorator which wraps :meth:`nestly.core.Nest.add`."""
@@ -122,16 +189,44 @@ class SConsWrap(object):
             return func
         return deco
 
-    def _register_alias(self, key):
-        if self.alias_environment:
-            values = [c[key] for _, c in self if c[key]]
-            values = self.alias_environment.Flatten(values)
-            if values and any(isinstance(v, dict) for v in values):
-                warnings.warn(('Skipping adding alias for {0}: '
-                               'dictionaries in output.').format(key))
-                return
-            if values and not any(isinstance(v, dict) for v in values):
-                self.alias_environment.Alias(key, values)
+    def _register_alias(self, key, results):
+        """
+        Register aliases for the targets just added under ``key``.
+
+        :param results: List of ``(control, target)`` pairs, collected as the
+            targets were created.
+        """
+        if not self.alias_environment:
+            return
+        results = [(c, t) for c, t in results if t]
+        values = self.alias_environment.Flatten([t for _, t in results])
+        if any(isinstance(v, dict) for v in values):
+            warnings.warn(('Skipping adding alias for {0}: '
+                           'dictionaries in output.').format(key))
+            return
+        if not values:
+            return
+        self.alias_environment.Alias(key, values)
+
+        if not self.level_aliases:
+            return
+        # Group targets by the value of each level, e.g. level:value
+        levels = []
+        checkpoint = self._checkpoint
+        while checkpoint is not None:
+            levels.append(checkpoint.name)
+            checkpoint = checkpoint.parent
+        groups = OrderedDict()
+        for c, t in results:
+            for level in reversed(levels):
+                value = c.get(level)
+                if value is None or isinstance(value, (dict, list, tuple)):
+                    continue
+                alias = '{0}:{1}'.format(level, value)
+                groups.setdefault(alias, []).append(t)
+        for alias, targets in groups.items():
+            self.alias_environment.Alias(
+                alias, self.alias_environment.Flatten(targets))
 
     def add_target(self, name=None):
         """
@@ -145,16 +240,20 @@ class SConsWrap(object):
         :param name: Name for the target in the name (default: function name).
         """
         def deco(func):
+            results = []
             def nestfunc(control):
                 destdir = os.path.join(self.dest_dir, control['OUTDIR'])
-                return [func(destdir, control)]
+                result = func(destdir, control)
+                results.append((control, result))
+                return [result]
             key = name or func.__name__
-            self.nest.add(key, nestfunc, create_dir=False)
-            self._register_alias(key)
+            with record(self.nest.profiler, key, 'add_target'):
+                self.nest.add(key, nestfunc, create_dir=False)
+                self._register_alias(key, results)
             return func
         return deco
 
-    def add_target_with_env(self, environment, name=None):
+    def add_target_with_env(self, environment, name=None, clone=True):
         """Add an SCons target to this nest, with an SCons Environment
 
         The function decorated will be immediately called with three arguments:
@@ -170,21 +269,45 @@ class SConsWrap(object):
 
         Differs from :meth:`SConsWrap.add_target` only by the addition of the
         ``Environment`` clone.
+
+        :param clone: If false, pass a lightweight ``environment.Override``
+            view with the control values bound, rather than a full clone of
+            ``environment``, to each call. This is much faster for nests with
+            many leaves, but the decorated function must not modify the
+            environment in place.
         """
         def deco(func):
-            def nestfunc(control):
-                env = environment.Clone()
-                for k, v in control.items():
-                    if k in env:
+            # Warn about each overwritten variable once per level, rather than
+            # once per control dictionary
+            warned = set()
+            results = []
+            def warn_overwrite(env, control):
+                for k in control:
+                    if k not in warned and k in env:
                         logger.warn("Overwriting previously bound value %s=%s",
                                     k, env[k])
-                    env[k] = v
+                        warned.add(k)
+
+            def nestfunc(control):
                 destdir = os.path.join(self.dest_dir, control['OUTDIR'])
-                env['OUTDIR'] = destdir
-                return [func(env, destdir, control)]
+                if clone:
+                    env = environment.Clone()
+                    warn_overwrite(env, control)
+                    for k, v in control.items():
+                        env[k] = v
+                    env['OUTDIR'] = destdir
+                else:
+                    warn_overwrite(environment, control)
+                    overrides = dict(control)
+                    overrides['OUTDIR'] = destdir
+                    env = environment.Override(overrides)
+                result = func(env, destdir, control)
+                results.append((control, result))
+                return [result]
             key = name or func.__name__
-            self.nest.add(key, nestfunc, create_dir=False)
-            self._register_alias(key)
+            with record(self.nest.profiler, key, 'add_target_with_env'):
+                self.nest.add(key, nestfunc, create_dir=False)
+                self._register_alias(key, results)
             return func
         return deco
 
@@ -214,17 +337,49 @@ class SConsWrap(object):
 
     def add_controls(self, env, target_name='control',
                      file_name='control.json',
-                     encoder_cls=SConsEncoder):
+                     encoder_cls=SConsEncoder, batch=False):
         """
         Adds a target to build a control file at each of the current leaves.
 
         :param env: SCons Environment object
         :param target_name: Name for target in nest
         :param file_name: Name for output file.
+        :param batch: If true, write all control files from a single SCons
+            action, rather than one action per leaf. Controls are serialized
+            when this method is called, and the serialized contents used as
+            the action's source, so the files are rewritten whenever any
+            control changes. The files are marked ``Precious``, so SCons does
+            not remove them before the action runs, and those whose contents
+            are unchanged are left untouched: targets depending on them are
+            not rebuilt.
         """
         if not HAS_SCONS:
             raise ImportError('SCons not available')
 
+        if batch:
+            paths, contents = [], []
+            for outdir, c in self:
+                paths.append(os.path.join(outdir, file_name))
+                contents.append(json.dumps(c, indent=2, cls=encoder_cls))
+            # The digest of all contents stands in for the contents as the
+            # source signature
+            digest = hashlib.sha1()
+            for c in contents:
+                digest.update(c.encode('utf-8'))
+                digest.update(b'\0')
+            targets = env.Command(paths, env.Value(digest.hexdigest()),
+                                  action=_write_control_files,
+                                  control_contents=contents)
+            # Otherwise SCons removes every target before running the action
+            env.Precious(targets)
+            nodes = iter(targets)
+
+            @self.add_target(name=target_name)
+            def control(outdir, c):
+                # Targets are created in the same order as the controls
+                return [next(nodes)]
+            return
+
         @self.add_target(name=target_name)
         def control(outdir, c):
             return env.Command(os.path.join(outdir, file_name),
@@ -0,0 +1,198 @@
+"""
+Adaptive concurrency for ``nestrun -j auto``.
+
+:class:`AdaptiveLimit` adjusts the number of jobs allowed to run at once
+using additive increase, multiplicative decrease: every ``interval`` seconds
+it adds a slot while the system has headroom, halves the limit under memory
+pressure, and gives back a slot when the load average exceeds the number of
+CPUs or job throughput drops after an increase.
+"""
+
+import logging
+import os
+import time
+
+# Fraction of time some task stalled on memory (PSI avg10, in percent) above
+# which the limit is halved
+MEMORY_PSI_THRESHOLD = 10.0
+# Fraction of memory available below which the limit is halved
+MEMORY_AVAILABLE_THRESHOLD = 0.1
+# 1-minute load average per CPU above which the limit is decreased
+LOAD_THRESHOLD = 1.0
+# Relative drop in throughput after an increase which reverses it
+THROUGHPUT_TOLERANCE = 0.1
+
+
+def cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+def load_average():
+    """
+    1-minute load average, or ``None`` if unavailable.
+    """
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+
+def memory_psi(path='/proc/pressure/memory'):
+    """
+    Percentage of the last 10 seconds in which some task stalled waiting on
+    memory, from Linux pressure stall information, or ``None`` if
+    unavailable.
+    """
+    try:
+        with open(path) as fp:
+            for line in fp:
+                fields = line.split()
+                if fields and fields[0] == 'some':
+                    return float(dict(f.split('=', 1)
+                                      for f in fields[1:])['avg10'])
+    except (IOError, OSError, KeyError, ValueError):
+        pass
+    return None
+
+
+def memory_available(path='/proc/meminfo'):
+    """
+    Fraction of memory available for new processes, from ``/proc/meminfo``,
+    or ``None`` if unavailable.
+    """
+    values = {}
+    try:
+        with open(path) as fp:
+            for line in fp:
+                key, _, value = line.partition(':')
+                values[key] = int(value.split()[0])
+        return float(values['MemAvailable']) / values['MemTotal']
+    except (IOError, OSError, KeyError, ValueError, IndexError,
+            ZeroDivisionError):
+        return None
+
+
+class Decision(object):
+    """
+    A change to (or decision to hold) the concurrency limit
+
+    :ivar old: Limit before the decision
+    :ivar new: Limit after
+    :ivar reason: Why
+    :ivar load: 1-minute load average per CPU, or ``None``
+    :ivar psi: Memory PSI avg10, or ``None``
+    :ivar available: Fraction of memory available, or ``None``
+    :ivar throughput: Jobs completed per second since the last decision
+    """
+    def __init__(self, old, new, reason, load, psi, available, throughput):
+        self.old = old
+        self.new = new
+        self.reason = reason
+        self.load = load
+        self.psi = psi
+        self.available = available
+        self.throughput = throughput
+
+    def __str__(self):
+        def fmt(value, spec):
+            return 'n/a' if value is None else format(value, spec)
+        return ('{0} -> {1}: {2} (load/cpu {3}, memory psi {4}%, '
+                'memory available {5}, throughput {6} jobs/s)').format(
+                    self.old, self.new, self.reason, fmt(self.load, '.2f'),
+                    fmt(self.psi, '.1f'), fmt(self.available, '.0%'),
+                    fmt(self.throughput, '.3f'))
+
+
+class AdaptiveLimit(object):
+    """
+    Concurrency limit adjusted from observed load, memory pressure and job
+    throughput. Call :meth:`completed` as each job finishes, and
+    :meth:`update` whenever deciding whether to start another.
+
+    :param minimum: Lowest limit, and the starting point.
+    :param maximum: Highest limit. Defaults to the number of CPUs.
+    :param interval: Seconds between decisions.
+    """
+    def __init__(self, minimum=1, maximum=None, interval=10.0, ncpus=None,
+                 load=load_average, psi=memory_psi,
+                 available=memory_available, clock=time.time):
+        self.ncpus = ncpus or cpu_count()
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum or self.ncpus, self.minimum)
+        self.interval = interval
+        self.limit = self.minimum
+        self.decisions = []
+        self._load = load
+        self._psi = psi
+        self._available = available
+        self._clock = clock
+        self._last = clock()
+        self._completions = 0
+        self._last_throughput = None
+        self._increased = False
+
+    def completed(self):
+        """
+        Record that a job finished.
+        """
+        self._completions += 1
+
+    def _decide(self, running, load, psi, available, throughput):
+        limit = self.limit
+        if ((psi is not None and psi > MEMORY_PSI_THRESHOLD) or
+                (available is not None and
+                 available < MEMORY_AVAILABLE_THRESHOLD)):
+            return max(self.minimum, limit // 2), 'memory pressure'
+        if load is not None and load > LOAD_THRESHOLD:
+            return max(self.minimum, limit - 1), 'load above CPU count'
+        if (self._increased and throughput is not None and
+                self._last_throughput and
+                throughput < self._last_throughput *
+                (1 - THROUGHPUT_TOLERANCE)):
+            return max(self.minimum, limit - 1), 'throughput fell'
+        if running < limit:
+            return limit, 'limit not reached'
+        if limit >= self.maximum:
+            return limit, 'at maximum'
+        return limit + 1, 'headroom'
+
+    def update(self, running):
+        """
+        Return the limit, revised if ``interval`` seconds have passed since
+        the last decision.
+
+        :param running: Number of jobs currently running
+        """
+        now = self._clock()
+        elapsed = now - self._last
+        if elapsed < self.interval:
+            return self.limit
+
+        load = self._load()
+        if load is not None:
+            load /= float(self.ncpus)
+        psi = self._psi()
+        available = self._available()
+        throughput = self._completions / elapsed if self._completions \
+                else None
+
+        new, reason = self._decide(running, load, psi, available, throughput)
+        decision = Decision(self.limit, new, reason, load, psi, available,
+                            throughput)
+        self.decisions.append(decision)
+        if new != self.limit:
+            logging.info('Concurrency %s', decision)
+        else:
+            logging.debug('Concurrency %s', decision)
+
+        self._increased = new > self.limit
+        if throughput is not None:
+            self._last_throughput = throughput
+        self.limit = new
+        self._last = now
+        self._completions = 0
+        return self.limit
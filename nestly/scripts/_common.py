@@ -0,0 +1,188 @@
+"""
+Helpers shared by the nestly command line tools.
+"""
+
+import argparse
+import functools
+import itertools
+import json
+import operator
+import os.path
+import re
+
+from ..core import (MANIFEST_NAME, NestIndex, control_iter, iter_manifest,
+                    manifest_entry)
+
+_OPERATORS = {'=': operator.eq, '!=': operator.ne,
+              '<': operator.lt, '<=': operator.le,
+              '>': operator.gt, '>=': operator.ge}
+
+_WHERE_RE = re.compile(r'^([^=!<>]+)(!=|<=|>=|=|<|>)(.*)$')
+
+def where_expression(s):
+    """
+    'Type' for argparse - parses ``KEY=VALUE`` into a ``(key, operator,
+    value)`` tuple. The operator may also be one of ``!=``, ``<``, ``<=``,
+    ``>`` or ``>=``. Values are decoded as JSON if possible, otherwise kept
+    as strings.
+    """
+    m = _WHERE_RE.match(s)
+    if not m:
+        raise argparse.ArgumentTypeError(
+                "Invalid expression: {0}. Expected KEY=VALUE.".format(s))
+    key, op, value = m.groups()
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return key, op, value
+
+def add_where_argument(parser):
+    parser.add_argument('--where', type=where_expression, action='append',
+            metavar='KEY=VALUE', help="""Only use controls where KEY has
+            VALUE. Other comparisons (!=, <, <=, >, >=) may be used in place
+            of =. May be specified multiple times; all conditions must
+            hold.""")
+
+def shard_expression(s):
+    """
+    'Type' for argparse - parses ``I/N`` into an ``(i, n)`` tuple, with
+    ``0 <= i < n``.
+    """
+    try:
+        i, n = (int(x) for x in s.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+                "Invalid shard: {0}. Expected I/N.".format(s))
+    if not 0 <= i < n:
+        raise argparse.ArgumentTypeError(
+                "Invalid shard: {0}. I must be in [0, N).".format(s))
+    return i, n
+
+def nonnegative_int(s):
+    """
+    'Type' for argparse - an integer >= 0.
+    """
+    try:
+        value = int(s)
+    except ValueError:
+        value = -1
+    if value < 0:
+        raise argparse.ArgumentTypeError(
+                "Expected a non-negative integer: {0}".format(s))
+    return value
+
+def positive_int(s):
+    """
+    'Type' for argparse - an integer >= 1.
+    """
+    try:
+        value = int(s)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise argparse.ArgumentTypeError(
+                "Expected a positive integer: {0}".format(s))
+    return value
+
+def add_shard_arguments(parser):
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--index', type=nonnegative_int, metavar='I',
+            help="""Only use the control at (zero-based) position %(metavar)s,
+            e.g. $SLURM_ARRAY_TASK_ID. Controls are taken in the order of the
+            manifest written by Nest.build, if present, otherwise in sorted
+            directory order.""")
+    group.add_argument('--shard', type=shard_expression, metavar='I/N',
+            help="""Only use every Nth control, starting from (zero-based)
+            position I, in the same order as --index.""")
+
+def _check(tests, value):
+    try:
+        return all(op(value, v) for op, v in tests)
+    except TypeError:
+        # Unorderable types
+        return False
+
+def where_criteria(expressions):
+    """
+    Convert parsed ``--where`` expressions to criteria for
+    :meth:`NestIndex.select <nestly.core.NestIndex.select>`.
+    """
+    by_key = {}
+    for key, op, value in expressions:
+        by_key.setdefault(key, []).append((_OPERATORS[op], value))
+    criteria = {}
+    for key, tests in by_key.items():
+        if len(tests) == 1 and tests[0][0] is operator.eq:
+            # Equality is answered directly by the index
+            criteria[key] = tests[0][1]
+        else:
+            criteria[key] = functools.partial(_check, tests)
+    return criteria
+
+def select_control_files(control_files, directory=None, where=None,
+        index=None, shard=None, stable=False):
+    """
+    Return the paths of control files to use.
+
+    :param control_files: Control files given explicitly
+    :param directory: Directory to search for control files. If ``where`` is
+        given and the directory contains a manifest written by
+        :meth:`Nest.build <nestly.core.Nest.build>`, controls are read from
+        the manifest rather than from each control file.
+    :param where: List of parsed ``--where`` expressions
+    :param index: If given, only return the control at this position.
+    :param shard: If given, an ``(i, n)`` tuple: only return every
+        ``n``-th control, starting from position ``i``.
+    :param stable: Return control files in the same order on every call,
+        as when selecting by ``index`` or ``shard``.
+
+    When selecting by ``index`` or ``shard``, control files under
+    ``directory`` are taken in manifest order, or failing that, in sorted
+    directory order, stopping as soon as the selection is complete. If the
+    manifest has an offset index, a single ``index`` is looked up directly.
+
+    :raises IndexError: if there is no control at ``index``.
+    """
+    stable = stable or index is not None or shard is not None
+    manifest = directory and os.path.join(directory, MANIFEST_NAME)
+    if manifest and not os.path.exists(manifest):
+        manifest = None
+
+    if index is not None and manifest and not where and not control_files:
+        try:
+            return [manifest_entry(manifest, index)[0]]
+        except IndexError:
+            raise IndexError("No control at index {0}".format(index))
+        except ValueError:
+            # No usable offset index; read the manifest line by line
+            pass
+
+    if where:
+        criteria = where_criteria(where)
+        if manifest:
+            nest_index = NestIndex.from_manifest(manifest)
+        else:
+            if directory:
+                control_files = list(control_files) + \
+                        list(control_iter(directory, sort=stable))
+            nest_index = NestIndex.from_control_files(control_files)
+        paths = (p for p, _ in nest_index.select(**criteria))
+    elif directory:
+        if stable and manifest:
+            found = (p for p, _ in iter_manifest(manifest))
+        else:
+            found = control_iter(directory, sort=stable)
+        paths = itertools.chain(control_files, found)
+    else:
+        paths = iter(control_files)
+
+    if index is not None:
+        selected = list(itertools.islice(paths, index, index + 1))
+        if not selected:
+            raise IndexError("No control at index {0}".format(index))
+        return selected
+    if shard is not None:
+        i, n = shard
+        return list(itertools.islice(paths, i, None, n))
+    return list(paths)
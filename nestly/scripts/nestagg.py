@@ -4,14 +4,18 @@ Aggregate results of ``nestly`` runs.
 
 import argparse
 import collections
+import contextlib
 import csv
 import functools
-import itertools
 import os.path
 import json
+import numbers
+import re
 import sys
 
-from ..core import control_iter, nest_map
+from .._py3 import imap, is_string
+from ..core import _mkdirs
+from ._common import add_where_argument, select_control_files
 
 DEFAULT_SEP = ','
 DEFAULT_NAME = 'control.json'
@@ -23,120 +27,1058 @@ _ordered_loads = functools.partial(json.loads,
                                    object_pairs_hook=collections.OrderedDict)
 
 def warn(message):
-    print >>sys.stderr, message
+    sys.stderr.write(message + '\n')
 
-def _warn_on_io(fn):
-    @functools.wraps(fn)
-    def f(*args, **kwargs):
-        r = fn(*args, **kwargs)
-        try:
-            for i in r:
-                yield i
-        except IOError as e:
-            warn(str(e))
-    return f
+# Rows read from a single delimited file, along with the values from the
+# control dictionary to append to each row.
+_DelimChunk = collections.namedtuple('_DelimChunk', ('path', 'fieldnames',
+                                                     'control_items', 'rows',
+                                                     'error'))
 
-def _delim_accum(control_files, filename_template, keys=None,
-        exclude_keys=None, separator=DEFAULT_SEP, missing_action='fail'):
+def _select_keys(control, keys, exclude_keys, path):
+    """
+    Return the ``(key, value)`` pairs from ``control`` to add to each row.
     """
-    Accumulator for delimited files
+    keys = keys if keys is not None else control.keys()
+    if exclude_keys:
+        keys = list(frozenset(keys) - frozenset(exclude_keys))
+    if frozenset(keys) - frozenset(control):
+        # Unknown keys
+        raise ValueError(
+                "The following required key(s) are not present in {1}: {0}".format(
+                    ', '.join(frozenset(keys) - frozenset(control)),
+                    path))
+    keys = frozenset(keys)
+    return [(k, v) for k, v in control.items() if k in keys]
 
-    Combines each file with values from JSON dictionary in same directory
+def _resolve_data_file(control_path, filename_template, keys=None,
+        exclude_keys=None):
+    """
+    Load a control file, returning the path to its data file and the
+    ``(key, value)`` pairs to add to each row.
+    """
+    with open(control_path) as fp:
+        control = _ordered_load(fp)
+    d = os.path.dirname(control_path)
+    f = os.path.join(d, filename_template.format(**control))
+    return f, _select_keys(control, keys, exclude_keys, f)
 
-    :param iterable control_files: Iterable of control files
-    :param filename_template: A template for the file to nest_map
-    :param keys: List of keys to select from JSON dictionary. If ``None``, keep
-                 all keys.
-    :param separator: Delimiter
+def _read_delim_header(control_path, filename_template, keys=None,
+        exclude_keys=None, separator=DEFAULT_SEP):
     """
-    def map_fn(d, control, keys=keys):
-        f = os.path.join(d, filename_template.format(**control))
+    Read only the header of the delimited file associated with a control
+    file.
 
-        keys = keys if keys is not None else control.keys()
-        if exclude_keys:
-            keys = list(frozenset(keys) - frozenset(exclude_keys))
-        if frozenset(keys) - frozenset(control):
-            # Unknown keys
-            raise ValueError(
-                    "The following required key(s) are not present in {1}: {0}".format(
-                        ', '.join(frozenset(keys) - frozenset(control)),
-                        f))
+    :returns: A tuple of the column names in the file and the control keys
+              to add, or ``None`` if the file could not be read.
+    """
+    f, control_items = _resolve_data_file(control_path, filename_template,
+                                          keys, exclude_keys)
+    try:
         with open(f) as fp:
-            reader = csv.DictReader(fp, delimiter=separator)
-            for row in reader:
-                row_dict = collections.OrderedDict(
-                        itertools.chain(((k, row[k]) for k in reader.fieldnames),
-                        ((k, v) for k, v in control.items() if k in keys)))
+            fieldnames = next(csv.reader(fp, delimiter=separator), [])
+    except IOError:
+        return None
+    return fieldnames, [k for k, _ in control_items]
 
-                yield row_dict
-    if missing_action == 'warn':
-        map_fn = _warn_on_io(map_fn)
+def _parse_delim(path, separator=DEFAULT_SEP):
+    """
+    Parse a delimited file, returning ``(fieldnames, rows)``.
 
-    return itertools.chain.from_iterable(nest_map(control_files, map_fn))
+    The header is parsed once; rows are kept as lists in header order, rather
+    than building a dictionary for each row.
+    """
+    with open(path) as fp:
+        reader = csv.reader(fp, delimiter=separator)
+        fieldnames = next(reader, [])
+        width = len(fieldnames)
+        rows = []
+        for row in reader:
+            if not row:
+                # csv.DictReader skips blank lines
+                continue
+            if len(row) < width:
+                row.extend([''] * (width - len(row)))
+            elif len(row) > width:
+                del row[width:]
+            rows.append(row)
+    return fieldnames, rows
 
-def delim(arguments):
+def _cache_entry(cache_dir, path, control_items, separator):
     """
-    Execute delim action.
+    Return the path of the cache entry for the delimited file ``path``, and
+    the key it must hold to be valid.
 
-    :param arguments: Parsed command line arguments from :func:`main`
+    There is one entry per file, named by a hash of its path, so that a
+    changed file replaces its previous entry. The key holds the size and
+    modification time of the file, along with a hash of the selected control
+    values and the separator.
+    """
+    import hashlib
+
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    control_hash = hashlib.sha1(json.dumps(
+        control_items, sort_keys=True, default=str).encode('utf-8'))
+    key = [st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime),
+           control_hash.hexdigest(), separator]
+    digest = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, digest[:2], digest + '.pickle'), key
+
+def _cached_parse_delim(cache_dir, path, control_items,
+        separator=DEFAULT_SEP):
+    """
+    Parse a delimited file, using a previously parsed copy from ``cache_dir``
+    if the file is unchanged.
+    """
+    import pickle
+    import tempfile
+
+    cache_path, key = _cache_entry(cache_dir, path, control_items, separator)
+    try:
+        with open(cache_path, 'rb') as fp:
+            if pickle.load(fp) == key:
+                return pickle.load(fp)
+    except Exception:
+        # Missing, unreadable, truncated or written by an incompatible
+        # version: parse again
+        pass
+
+    result = _parse_delim(path, separator)
+    _mkdirs(os.path.dirname(cache_path))
+    # Write to a temporary file, then rename over any previous entry, so
+    # concurrent readers never see a partial entry.
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            pickle.dump(key, fp, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(result, fp, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, cache_path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return result
+
+def _read_delim(control_path, filename_template, keys=None,
+        exclude_keys=None, separator=DEFAULT_SEP, missing_action='fail',
+        cache_dir=None):
+    """
+    Read the delimited file associated with a single control file.
+
+    :param cache_dir: If given, directory of previously parsed files.
+    :returns: A :class:`_DelimChunk`. If ``missing_action`` is ``'warn'`` and
+              the file could not be read, ``rows`` is empty and ``error``
+              contains the message.
+    """
+    f, control_items = _resolve_data_file(control_path, filename_template,
+                                          keys, exclude_keys)
+    try:
+        if cache_dir:
+            fieldnames, rows = _cached_parse_delim(cache_dir, f,
+                                                   control_items, separator)
+        else:
+            fieldnames, rows = _parse_delim(f, separator)
+    except (IOError, OSError) as e:
+        if missing_action != 'warn':
+            raise
+        return _DelimChunk(f, [], control_items, [], str(e))
+    return _DelimChunk(f, fieldnames, control_items, rows, None)
+
+def _bounded_imap(pool, fn, iterable, window, ordered=True):
+    """
+    Apply ``fn`` to each item of ``iterable`` using ``pool``, keeping at most
+    ``window`` tasks in flight.
+
+    Unlike :meth:`multiprocessing.pool.Pool.imap`, which consumes the input
+    and buffers results without limit, completed results are only held until
+    the consumer takes them.
+
+    :param ordered: Yield results in input order. If false, results are
+                    yielded as they complete.
+    """
+    pending = collections.deque()
+    items = iter(iterable)
+    exhausted = False
+    while True:
+        while not exhausted and len(pending) < window:
+            try:
+                item = next(items)
+            except StopIteration:
+                exhausted = True
+            else:
+                pending.append(pool.apply_async(fn, (item,)))
+        if not pending:
+            return
+        if ordered:
+            yield pending.popleft().get()
+            continue
+        for i, r in enumerate(pending):
+            if r.ready():
+                del pending[i]
+                break
+        else:
+            r = pending.popleft()
+        yield r.get()
+
+def _pool_imap(fn, items, jobs=1, preserve_order=True):
+    """
+    Apply ``fn`` to each of ``items``, serially if ``jobs`` is 1, otherwise
+    with a pool of ``jobs`` worker processes.
+    """
+    if jobs <= 1:
+        for r in imap(fn, items):
+            yield r
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for r in _bounded_imap(pool, fn, items, 2 * jobs,
+                               ordered=preserve_order):
+            yield r
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _collision_error(names, path):
+    return ValueError(
+            "{0} contains column(s) which are also control keys: {1}. "
+            "Use -k or -x to choose control keys.".format(
+                path, ', '.join(sorted(names))))
+
+def _chunk_names(chunk):
+    """
+    Return the output columns of ``chunk``: its data columns, then its
+    control keys, raising ValueError if any name is both.
+    """
+    keys = [k for k, _ in chunk.control_items]
+    both = frozenset(chunk.fieldnames).intersection(keys)
+    if both:
+        raise _collision_error(both, chunk.path)
+    return chunk.fieldnames + keys
+
+def _merged_rows(chunk, rows):
+    """
+    Return the output columns of ``chunk`` and its rows with control values
+    appended. A control key which is also a data column is not repeated: its
+    value replaces that column.
+    """
+    positions = dict((n, i) for i, n in enumerate(chunk.fieldnames))
+    keys, values, replace = [], [], []
+    for k, v in chunk.control_items:
+        v = _delim_value(v)
+        if k in positions:
+            replace.append((positions[k], v))
+        else:
+            keys.append(k)
+            values.append(v)
+    if not replace:
+        return chunk.fieldnames + keys, (row + values for row in rows)
+
+    def merge(row):
+        row = row + values
+        for i, v in replace:
+            row[i] = v
+        return row
+    return chunk.fieldnames + keys, imap(merge, rows)
+
+def _union_header(header_fn, control_files, jobs=1):
+    """
+    Find the union of output columns over all control files.
+
+    :param header_fn: Function returning a tuple of data columns and control
+                      keys for a control file, or ``None`` if its data could
+                      not be read.
+    :returns: Data columns in order of first appearance, followed by control
+              keys.
+    :raises ValueError: if a control key is a data column in any file.
+    """
+    fields, control_keys = collections.OrderedDict(), collections.OrderedDict()
+    for r in _pool_imap(header_fn, control_files, jobs):
+        if r is None:
+            continue
+        fields.update((f, None) for f in r[0] if f not in fields)
+        control_keys.update((k, None) for k in r[1] if k not in control_keys)
+    both = frozenset(fields).intersection(control_keys)
+    if both:
+        raise _collision_error(both, 'The input')
+    return list(fields) + list(control_keys)
+
+def _chunk_header(control_path, chunk_fn):
+    """
+    Header function for :func:`_union_header` which reads the whole chunk.
+    """
+    chunk = chunk_fn(control_path)
+    if chunk.error is not None:
+        return None
+    return chunk.fieldnames, [k for k, _ in chunk.control_items]
+
+def _read_control(control_path, keys=None, exclude_keys=None):
+    """
+    Read a control file as a chunk with a single row, consisting only of
+    control values.
+    """
+    with open(control_path) as fp:
+        control = _ordered_load(fp)
+    return _DelimChunk(control_path, [],
+                       _select_keys(control, keys, exclude_keys, control_path),
+                       [[]], None)
+
+def _read_json(control_path, filename_template, keys=None, exclude_keys=None,
+        missing_action='fail'):
+    """
+    Read the JSON result file associated with a single control file.
+
+    The file may contain an object, which forms a single row, or a list of
+    objects, each forming a row.
+    """
+    f, control_items = _resolve_data_file(control_path, filename_template,
+                                          keys, exclude_keys)
+    try:
+        with open(f) as fp:
+            result = _ordered_load(fp)
+    except IOError as e:
+        if missing_action != 'warn':
+            raise
+        return _DelimChunk(f, [], control_items, [], str(e))
+    if isinstance(result, dict):
+        result = [result]
+    if not all(isinstance(r, dict) for r in result):
+        raise ValueError(
+                "{0} must contain an object or a list of objects".format(f))
+    fieldnames = list(collections.OrderedDict(
+        (k, None) for r in result for k in r))
+    rows = [[r.get(k) for k in fieldnames] for r in result]
+    return _DelimChunk(f, fieldnames, control_items, rows, None)
+
+def _delim_value(value):
+    """
+    Encode lists and objects, e.g. from JSON files, as JSON for delimited
+    output.
+    """
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+def _delim_rows(rows):
+    """
+    Apply :func:`_delim_value` to each value of ``rows``, if any need it.
+    """
+    if any(isinstance(v, (dict, list)) for row in rows for v in row):
+        return [[_delim_value(v) for v in row] for row in rows]
+    return rows
+
+def _write_delim(fp, chunks, separator=DEFAULT_SEP, header=None,
+        fill_value='', mark=None):
+    """
+    Write chunks to ``fp``.
+
+    Rows from each chunk are mapped onto the header once per file; columns
+    missing from a file are filled with ``fill_value``.
+
+    :param header: Output columns. If ``None``, the header is taken from the
+                   first readable chunk, later chunks may not add columns, and
+                   a control key which is also a data column replaces its
+                   values. Otherwise such a key is an error.
+    :param mark: Function called with ``header=True`` after the header is
+                 written, and with no arguments after each chunk, including
+                 chunks which could not be read.
+    """
+    mark = mark or (lambda header=False: None)
+    writer = csv.writer(fp, delimiter=separator)
+    merge = header is None
+    if not merge:
+        writer.writerow(header)
+        mark(header=True)
+    for chunk in chunks:
+        if chunk.error is not None:
+            warn(chunk.error)
+            mark()
+            continue
+        rows = _delim_rows(chunk.rows)
+        if merge:
+            names, rows = _merged_rows(chunk, rows)
+        else:
+            names = _chunk_names(chunk)
+            values = [_delim_value(v) for _, v in chunk.control_items]
+            rows = (row + values for row in rows)
+        if header is None:
+            header = names
+            writer.writerow(header)
+            mark(header=True)
+        if names == header:
+            writer.writerows(rows)
+            mark()
+            continue
+
+        extra = frozenset(names) - frozenset(header)
+        if extra:
+            raise ValueError(
+                    "{0} contains field(s) not in the header: {1}. "
+                    "Use --union to include all columns.".format(
+                        chunk.path, ', '.join(sorted(extra))))
+        positions = dict((n, i) for i, n in enumerate(names))
+        idx = [positions.get(n) for n in header]
+        for row in rows:
+            writer.writerow([fill_value if i is None else row[i]
+                             for i in idx])
+        mark()
+
+def _write_jsonl(fp, chunks, mark=None):
+    """
+    Write chunks to ``fp`` as JSON lines, one object per row.
+
+    :param mark: Function called after each chunk is written.
+    """
+    mark = mark or (lambda header=False: None)
+    for chunk in chunks:
+        if chunk.error is not None:
+            warn(chunk.error)
+            mark()
+            continue
+        names = _chunk_names(chunk)
+        values = [v for _, v in chunk.control_items]
+        for row in chunk.rows:
+            json.dump(collections.OrderedDict(zip(names, row + values)), fp)
+            fp.write('\n')
+        mark()
+
+def _category_key(value):
+    """
+    Return a hashable key for a control value
+    """
+    try:
+        hash(value)
+    except TypeError:
+        return json.dumps(value, sort_keys=True)
+    return (type(value), value)
+
+# Rows per record batch (row group) written by the columnar writers
+COLUMNAR_BATCH_ROWS = 65536
+
+# Order in which column types are widened
+_TYPES = (int, float, str)
+
+_INT_RE = re.compile(r'[-+]?[0-9]+\Z')
+_FLOAT_RE = re.compile(r'[-+]?(([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?'
+                       r'|nan|inf|infinity)\Z', re.IGNORECASE)
+
+def _convert(t, value):
+    """
+    Convert a string, or a number parsed from JSON, to ``t``, raising
+    ValueError if the value is not of that type.
+
+    Strings must be plain decimal literals: unlike :func:`int` and
+    :func:`float`, surrounding whitespace and digit separators are rejected.
+    """
+    if is_string(value):
+        if not (_INT_RE if t is int else _FLOAT_RE).match(value):
+            raise ValueError(value)
+        return t(value)
+    if isinstance(value, bool) or not isinstance(value, numbers.Real):
+        raise ValueError(value)
+    if t is int and not isinstance(value, numbers.Integral):
+        raise ValueError(value)
+    return t(value)
+
+def _widen(t, value):
+    """
+    Return the narrowest of :data:`_TYPES`, no narrower than ``t``, which
+    holds ``value``. ``t`` is ``None`` for a column with no values yet.
+    """
+    if value is None or value == '':
+        return t
+    for candidate in _TYPES[_TYPES.index(t) if t else 0:-1]:
+        try:
+            _convert(candidate, value)
+        except ValueError:
+            continue
+        return candidate
+    return str
+
+def _convert_or_none(t, value):
+    return None if value is None or value == '' else _convert(t, value)
+
+def _as_string(value):
+    return '' if value is None else value if is_string(value) else \
+            json.dumps(value)
+
+class _ColumnStore(object):
+    """
+    Collects chunks for columnar output, without holding them in memory.
+
+    :meth:`add` infers a type for each data column as chunks arrive, and
+    spills the chunks to a temporary file; :meth:`batches` then reads them
+    back, converting values, a batch of rows at a time. Values of data
+    columns are integers if possible, then floats, otherwise strings; empty
+    and missing values become ``None`` in numeric columns. Control values
+    repeat for every row of a file, so they are stored dictionary-encoded: a
+    list of distinct values, and an integer code per row.
+
+    As in delimited output, data columns (in order of first appearance) come
+    before control columns.
+    """
+    def __init__(self):
+        import tempfile
+
+        self.nrows = 0
+        self._data_names = []
+        self._control_names = []
+        self._types = {}
+        self._missing = {}
+        self._width = {}
+        self._categories = {}
+        self._category_index = {}
+        self._spill = tempfile.TemporaryFile()
+
+    def close(self):
+        self._spill.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def names(self):
+        return self._data_names + self._control_names
+
+    def _add_column(self, name, encoded, path):
+        if name in self._types or name in self._categories:
+            raise ValueError("{0} is both a data column and a control key "
+                             "in {1}".format(name, path))
+        self._missing[name] = self.nrows > 0
+        if encoded:
+            self._control_names.append(name)
+            self._categories[name] = []
+            self._category_index[name] = {}
+        else:
+            self._data_names.append(name)
+            self._types[name] = None
+            self._width[name] = 0
+
+    def _category(self, name, value):
+        index = self._category_index[name]
+        key = _category_key(value)
+        code = index.get(key)
+        if code is None:
+            code = index[key] = len(self._categories[name])
+            self._categories[name].append(value)
+        return code
+
+    def add(self, chunk):
+        import pickle
+
+        if not chunk.rows:
+            return
+        for i, name in enumerate(chunk.fieldnames):
+            if name not in self._types:
+                self._add_column(name, False, chunk.path)
+            t, width = self._types[name], self._width[name]
+            for row in chunk.rows:
+                value = row[i]
+                if value is None or value == '':
+                    self._missing[name] = True
+                    continue
+                t = _widen(t, value)
+                width = max(width, len(_as_string(value)))
+            self._types[name], self._width[name] = t, width
+        for name, value in chunk.control_items:
+            if name not in self._categories:
+                self._add_column(name, True, chunk.path)
+            self._category(name, value)
+        present = frozenset(chunk.fieldnames).union(
+                k for k, _ in chunk.control_items)
+        for name in self.names:
+            if name not in present:
+                self._missing[name] = True
+        self.nrows += len(chunk.rows)
+        pickle.dump(chunk, self._spill, pickle.HIGHEST_PROTOCOL)
+
+    def extend(self, chunks):
+        for chunk in chunks:
+            if chunk.error is not None:
+                warn(chunk.error)
+                continue
+            self.add(chunk)
+
+    def is_encoded(self, name):
+        return name in self._categories
+
+    def column_type(self, name):
+        """
+        Type inferred for a data column: ``int``, ``float`` or ``str``.
+        """
+        return self._types[name] or int
+
+    def has_missing(self, name):
+        """
+        Whether any row lacks a value for column ``name``.
+        """
+        return self._missing[name]
+
+    def width(self, name):
+        """
+        Length of the longest value in a data column, as a string.
+        """
+        return self._width[name]
+
+    def categories(self, name):
+        """
+        Distinct values of a control column, in order of their codes.
+        """
+        return _scalar_categories(self._categories[name])
+
+    def _chunks(self):
+        import pickle
+
+        self._spill.seek(0)
+        while True:
+            try:
+                yield pickle.load(self._spill)
+            except EOFError:
+                return
+
+    def _empty_batch(self):
+        return dict((name, []) for name in self.names)
+
+    def batches(self, size=None):
+        """
+        Generate batches of whole chunks, of at least ``size`` rows
+        (default: :data:`COLUMNAR_BATCH_ROWS`) where possible, as ``(nrows,
+        columns)``. ``columns`` maps each data column
+        to a list of converted values, and each control column to a list of
+        codes, with ``-1`` for missing values.
+        """
+        size = size or COLUMNAR_BATCH_ROWS
+        converters = {}
+        for name in self._types:
+            t = self.column_type(name)
+            if t is str:
+                converters[name] = _as_string
+            else:
+                converters[name] = functools.partial(_convert_or_none, t)
+        batch, n = self._empty_batch(), 0
+        for chunk in self._chunks():
+            for i, name in enumerate(chunk.fieldnames):
+                convert = converters[name]
+                batch[name].extend(convert(row[i]) for row in chunk.rows)
+            for name, value in chunk.control_items:
+                code = self._category_index[name][_category_key(value)]
+                batch[name].extend([code] * len(chunk.rows))
+            n += len(chunk.rows)
+            for name, values in batch.items():
+                if len(values) < n:
+                    fill = -1 if name in self._categories else \
+                            converters[name](None)
+                    values.extend([fill] * (n - len(values)))
+            if n >= size:
+                yield n, batch
+                batch, n = self._empty_batch(), 0
+        if n:
+            yield n, batch
+
+def _scalar_categories(categories):
+    """
+    Convert categories to a single scalar type, JSON-encoding if values are
+    mixed or not scalars.
+    """
+    if all(is_string(c) for c in categories):
+        return categories
+    types = frozenset(type(c) for c in categories)
+    if len(types) == 1 and types <= frozenset((int, float, bool)):
+        return categories
+    if types <= frozenset((int, float)):
+        return [float(c) for c in categories]
+    return [c if is_string(c) else json.dumps(c, sort_keys=True)
+            for c in categories]
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('pyarrow is required for Arrow, Feather and Parquet '
+                          'output')
+    return pyarrow
+
+def _arrow_batches(columns):
+    """
+    Return the Arrow schema for ``columns``, and a generator of record
+    batches.
     """
+    pyarrow = _import_pyarrow()
+    types = {int: pyarrow.int64(), float: pyarrow.float64(),
+             str: pyarrow.string()}
+    fields, dictionaries = [], {}
+    for name in columns.names:
+        if columns.is_encoded(name):
+            dictionary = pyarrow.array(columns.categories(name))
+            dictionaries[name] = dictionary
+            t = pyarrow.dictionary(pyarrow.int32(), dictionary.type)
+        else:
+            t = types[columns.column_type(name)]
+        fields.append(pyarrow.field(name, t))
+    schema = pyarrow.schema(fields)
 
+    def generate():
+        for _, batch in columns.batches():
+            arrays = []
+            for field in schema:
+                values = batch[field.name]
+                if field.name in dictionaries:
+                    indices = pyarrow.array(
+                            [None if c < 0 else c for c in values],
+                            type=pyarrow.int32())
+                    arrays.append(pyarrow.DictionaryArray.from_arrays(
+                        indices, dictionaries[field.name]))
+                else:
+                    arrays.append(pyarrow.array(values, type=field.type))
+            yield pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+    return schema, generate()
+
+def _write_parquet(columns, path):
+    schema, batches = _arrow_batches(columns)
+    import pyarrow
+    import pyarrow.parquet
+    writer = pyarrow.parquet.ParquetWriter(path, schema)
+    try:
+        for batch in batches:
+            writer.write_table(pyarrow.Table.from_batches([batch]))
+    finally:
+        writer.close()
+
+def _write_ipc(path, schema, batches, options=None):
+    import pyarrow
+    with pyarrow.OSFile(path, 'wb') as sink:
+        if options is None:
+            writer = pyarrow.ipc.new_file(sink, schema)
+        else:
+            writer = pyarrow.ipc.new_file(sink, schema, options=options)
+        try:
+            for batch in batches:
+                writer.write_batch(batch)
+        finally:
+            writer.close()
+
+def _write_feather(columns, path):
+    """
+    Write a Feather (version 2) file: the Arrow IPC file format, compressed
+    with LZ4 where available, as :func:`pyarrow.feather.write_feather` does.
+    """
+    schema, batches = _arrow_batches(columns)
+    import pyarrow
+    options = None
+    if pyarrow.Codec.is_available('lz4'):
+        options = pyarrow.ipc.IpcWriteOptions(compression='lz4')
+    _write_ipc(path, schema, batches, options)
+
+def _write_arrow(columns, path):
+    schema, batches = _arrow_batches(columns)
+    _write_ipc(path, schema, batches)
+
+def _write_npz(columns, path):
+    """
+    Write columns to a NumPy ``.npz`` archive at ``path``.
+
+    Each data column is stored under its name. Control columns are stored as
+    integer codes under their name, with values under ``<name>.categories``.
+    Integer columns with missing values are stored as floats, with NaN for
+    missing values.
+
+    Each column is written to a temporary ``.npy`` file a batch at a time,
+    then compressed into the archive.
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('numpy is required for npz output')
+    from numpy.lib import format as npy
+    import io
+    import shutil
+    import tempfile
+    import zipfile
+
+    dtypes = {}
+    for name in columns.names:
+        if columns.is_encoded(name):
+            dtypes[name] = numpy.dtype(numpy.int32)
+            continue
+        t = columns.column_type(name)
+        if t is str:
+            dtypes[name] = numpy.dtype('U{0}'.format(
+                max(columns.width(name), 1)))
+        elif t is int and not columns.has_missing(name):
+            dtypes[name] = numpy.dtype(numpy.int64)
+        else:
+            dtypes[name] = numpy.dtype(numpy.float64)
+
+    tmp_dir = tempfile.mkdtemp(prefix='nestagg-npz')
+    try:
+        files = {}
+        for i, name in enumerate(columns.names):
+            fp = files[name] = open(os.path.join(tmp_dir, str(i)), 'w+b')
+            npy.write_array_header_2_0(fp, {
+                'descr': npy.dtype_to_descr(dtypes[name]),
+                'fortran_order': False, 'shape': (columns.nrows,)})
+        for _, batch in columns.batches():
+            for name, values in batch.items():
+                if dtypes[name].kind == 'f':
+                    values = [numpy.nan if v is None else v for v in values]
+                files[name].write(
+                        numpy.asarray(values, dtype=dtypes[name]).tobytes())
+
+        with open(path, 'wb') as out:
+            with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED,
+                                 allowZip64=True) as archive:
+                for i, name in enumerate(columns.names):
+                    files[name].close()
+                    archive.write(os.path.join(tmp_dir, str(i)),
+                                  name + '.npy')
+                    if columns.is_encoded(name):
+                        buf = io.BytesIO()
+                        numpy.save(buf, numpy.array(columns.categories(name)))
+                        archive.writestr(name + '.categories.npy',
+                                         buf.getvalue())
+    finally:
+        for fp in files.values():
+            fp.close()
+        shutil.rmtree(tmp_dir)
+
+_COLUMNAR_WRITERS = {'arrow': _write_arrow,
+                     'feather': _write_feather,
+                     'npz': _write_npz,
+                     'parquet': _write_parquet}
+
+@contextlib.contextmanager
+def _open_output(path):
+    if path == '-':
+        yield sys.stdout
+    else:
+        with open(path, 'w') as fp:
+            yield fp
+
+def _control_files(arguments):
+    """
+    Return the control files specified by ``arguments``.
+    """
     if bool(arguments.control_files) == bool(arguments.directory):
         raise ValueError(
                 'Exactly one of control_files and `-d` must be specified.')
 
-    if arguments.directory:
-        arguments.control_files.extend(control_iter(arguments.directory))
+    return select_control_files(arguments.control_files, arguments.directory,
+                                arguments.where, stable=arguments.write_index)
+
+@contextlib.contextmanager
+def _offset_recorder(arguments, fp):
+    """
+    Context manager yielding a ``mark`` function for the writers, which
+    records the position of ``fp`` after the header and after each chunk.
+    With ``--write-index``, the positions are written as an offset index for
+    the output on exit, one record per control file; otherwise ``None`` is
+    yielded.
+    """
+    if not arguments.write_index:
+        yield None
+        return
+    header_end, ends = [0], []
+    def mark(header=False):
+        if header:
+            header_end[0] = fp.tell()
+        else:
+            ends.append(fp.tell())
+    yield mark
+    fp.flush()
+    # Chunks which could not be read before the header was written are
+    # empty records at the start of the body
+    start = header_end[0]
+    from ..offsets import write_offsets
+    write_offsets(arguments.output, [start] + [max(e, start) for e in ends])
+
+def _write_output(arguments, chunk_fn, header_fn=None):
+    """
+    Apply ``chunk_fn`` to each control file, writing the results as specified
+    by ``arguments``.
 
-    with arguments.output as fp:
-        results = _delim_accum(arguments.control_files,
-                arguments.file_template, arguments.keys,
-                arguments.exclude_keys, arguments.separator,
-                missing_action=arguments.missing_action)
-        r = next(results)
-        writer = csv.DictWriter(fp, r.keys(), delimiter=arguments.separator)
-        writer.writeheader()
-        writer.writerow(r)
-        writer.writerows(results)
+    :param header_fn: Function used to find the columns for each control file
+                      if ``--union`` is specified. Defaults to reading each
+                      chunk in full.
+    """
+    control_files = _control_files(arguments)
+    if arguments.format in _COLUMNAR_WRITERS and arguments.output == '-':
+        raise ValueError(
+                '--output is required for {0} output'.format(arguments.format))
+    if arguments.write_index:
+        if arguments.format in _COLUMNAR_WRITERS or arguments.output == '-':
+            raise ValueError('--write-index requires delim or jsonl output '
+                             'to a file')
+        if not arguments.preserve_order:
+            raise ValueError('--write-index cannot be used with --unordered')
+
+    if arguments.io_concurrency > 1:
+        if arguments.jobs > 1:
+            raise ValueError('--io-concurrency cannot be used with --jobs')
+        from ..aio import concurrent_imap
+        chunks = concurrent_imap(chunk_fn, control_files,
+                                 arguments.io_concurrency,
+                                 arguments.preserve_order)
+    else:
+        chunks = _pool_imap(chunk_fn, control_files, arguments.jobs,
+                            arguments.preserve_order)
+    if arguments.format == 'delim':
+        header = None
+        if arguments.union:
+            if header_fn is None:
+                header_fn = functools.partial(_chunk_header,
+                                              chunk_fn=chunk_fn)
+            header = _union_header(header_fn, control_files, arguments.jobs)
+        with _open_output(arguments.output) as fp:
+            with _offset_recorder(arguments, fp) as mark:
+                _write_delim(fp, chunks, arguments.separator, header=header,
+                             fill_value=arguments.fill_value, mark=mark)
+    elif arguments.format == 'jsonl':
+        with _open_output(arguments.output) as fp:
+            with _offset_recorder(arguments, fp) as mark:
+                _write_jsonl(fp, chunks, mark=mark)
+    else:
+        with _ColumnStore() as columns:
+            columns.extend(chunks)
+            _COLUMNAR_WRITERS[arguments.format](columns, arguments.output)
+
+def delim(arguments):
+    """
+    Execute delim action.
+
+    :param arguments: Parsed command line arguments from :func:`main`
+    """
+    chunk_fn = functools.partial(_read_delim,
+            filename_template=arguments.file_template, keys=arguments.keys,
+            exclude_keys=arguments.exclude_keys,
+            separator=arguments.separator,
+            missing_action=arguments.missing_action,
+            cache_dir=arguments.cache_dir)
+    header_fn = functools.partial(_read_delim_header,
+            filename_template=arguments.file_template, keys=arguments.keys,
+            exclude_keys=arguments.exclude_keys,
+            separator=arguments.separator)
+    _write_output(arguments, chunk_fn, header_fn)
+
+def controls(arguments):
+    """
+    Execute controls action.
+
+    :param arguments: Parsed command line arguments from :func:`main`
+    """
+    chunk_fn = functools.partial(_read_control, keys=arguments.keys,
+                                 exclude_keys=arguments.exclude_keys)
+    _write_output(arguments, chunk_fn)
+
+def json_(arguments):
+    """
+    Execute json action.
+
+    :param arguments: Parsed command line arguments from :func:`main`
+    """
+    chunk_fn = functools.partial(_read_json,
+            filename_template=arguments.file_template, keys=arguments.keys,
+            exclude_keys=arguments.exclude_keys,
+            missing_action=arguments.missing_action)
+    _write_output(arguments, chunk_fn)
 
 def comma_separated_values(s):
     s = s.split(',')
     return s
 
-def main(args=sys.argv[1:]):
+def _add_common_arguments(parser):
     """
-    Command-line interface for nestagg
+    Add arguments shared by all subcommands to ``parser``
     """
-    parser = argparse.ArgumentParser(description="""Aggregate results of
-            nestly runs""")
-    subparsers = parser.add_subparsers()
-    delim_parser = subparsers.add_parser('delim', help="""Combine control files
-            with delimited files.""")
-    delim_parser.set_defaults(func=delim)
-    key_group = delim_parser.add_mutually_exclusive_group()
+    key_group = parser.add_mutually_exclusive_group()
     key_group.add_argument('-k', '--keys', help="""Comma separated list of
             keys from the JSON file to include [default: all keys]""",
             type=comma_separated_values)
     key_group.add_argument('-x', '--exclude-keys', help="""Comma separated
             list of keys from the JSON file not to include [default:
             %(default)s]""", type=comma_separated_values)
-    delim_parser.add_argument('-m', '--missing-action', choices=('fail',
-        'warn'), help="""Action to take when a file is missing [default:
-        %(default)s]""", default='fail')
-    delim_parser.add_argument('file_template', help="""Template for the
-            delimited file to read in each directory [e.g. '{run_id}.csv']""")
-    delim_parser.add_argument('control_files', metavar="control.json",
+    parser.add_argument('control_files', metavar="control.json",
             help="""Control files""", nargs="*")
-    delim_parser.add_argument('-d', '--directory', help="""Run on all control
+    parser.add_argument('-d', '--directory', help="""Run on all control
             files under %(metavar)s. May be used in place of specifying control
             files.""", metavar='DIR')
-    delim_parser.add_argument('-s', '--separator', default=DEFAULT_SEP,
+    add_where_argument(parser)
+    parser.add_argument('-s', '--separator', default=DEFAULT_SEP,
             help="""Separator [default: %(default)s]""")
-    delim_parser.add_argument('-t', '--tab', action='store_const',
+    parser.add_argument('-t', '--tab', action='store_const',
             dest='separator', const='\t', help="""Files are tab-separated""")
-    delim_parser.add_argument('-o', '--output', default=sys.stdout,
-        type=argparse.FileType('w'), help="""Output file [default: stdout]""")
+    parser.add_argument('-o', '--output', default='-',
+        help="""Output file [default: stdout]""")
+    parser.add_argument('-f', '--format', default='delim',
+            choices=('delim', 'jsonl') + tuple(sorted(_COLUMNAR_WRITERS)),
+            help="""Output format. Columnar formats infer a type for each
+            column and store control values dictionary-encoded; arrow,
+            feather and parquet require pyarrow, npz requires numpy
+            [default: %(default)s]""")
+    parser.add_argument('-u', '--union', action='store_true',
+            help="""Read the header of every file first, and write the union of
+            all columns. Without this option, the columns of the first file
+            are used, and it is an error for a later file to contain other
+            columns. Columnar formats always use the union.""")
+    parser.add_argument('--fill-value', default='', help="""Value to
+            write for columns missing from a file [default: empty]""")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+            metavar='N', help="""Read files using %(metavar)s worker processes
+            [default: %(default)s]""")
+    parser.add_argument('--io-concurrency', type=int, default=1,
+            metavar='N', help="""Keep up to %(metavar)s files in flight on a
+            pool of threads. Useful on network file systems, where reading is
+            limited by latency rather than CPU. Requires Python 3.6+
+            [default: %(default)s]""")
+    parser.add_argument('--unordered', action='store_false',
+            dest='preserve_order', help="""When using multiple workers, write
+            rows as files are read rather than in control file order""")
+    parser.add_argument('--write-index', action='store_true', help="""Also
+            write an offset index to OUTPUT.idx, locating the rows from each
+            control file. Control files are taken in the same order as for
+            nestrun --index, so record I holds the rows for the control run
+            by nestrun --index I. See nestly.offsets.""")
+
+def _add_missing_action(parser):
+    parser.add_argument('-m', '--missing-action', choices=('fail',
+        'warn'), help="""Action to take when a file is missing [default:
+        %(default)s]""", default='fail')
+
+def main(args=sys.argv[1:]):
+    """
+    Command-line interface for nestagg
+    """
+    parser = argparse.ArgumentParser(description="""Aggregate results of
+            nestly runs""")
+    subparsers = parser.add_subparsers()
+    delim_parser = subparsers.add_parser('delim', help="""Combine control files
+            with delimited files.""")
+    delim_parser.set_defaults(func=delim)
+    _add_missing_action(delim_parser)
+    delim_parser.add_argument('file_template', help="""Template for the
+            delimited file to read in each directory [e.g. '{run_id}.csv']""")
+    _add_common_arguments(delim_parser)
+    delim_parser.add_argument('--cache', dest='cache_dir', metavar='DIR',
+            help="""Cache parsed files in %(metavar)s. On later runs, only
+            files which are new or have changed are parsed again.""")
+
+    controls_parser = subparsers.add_parser('controls', help="""Write a table
+            of control dictionaries.""")
+    controls_parser.set_defaults(func=controls)
+    _add_common_arguments(controls_parser)
+
+    json_parser = subparsers.add_parser('json', help="""Combine control files
+            with JSON result files.""")
+    json_parser.set_defaults(func=json_)
+    _add_missing_action(json_parser)
+    json_parser.add_argument('file_template', help="""Template for the JSON
+            file to read in each directory [e.g. '{run_id}.json']. The file
+            may contain an object or a list of objects.""")
+    _add_common_arguments(json_parser)
 
-    arguments = parser.parse_args()
+    arguments = parser.parse_args(args)
 
     arguments.func(arguments)
@@ -7,6 +7,8 @@ import csv
 import datetime
 import errno
 import functools
+import hashlib
+import importlib
 import json
 import logging
 import os
@@ -16,12 +18,21 @@ import shutil
 import signal
 import subprocess
 import sys
+import tempfile
+import time
+import traceback
 
-from nestly.core import control_iter
+from nestly._py3 import StringIO
+from nestly.instrument import RunMetrics, phase
+
+from nestly.scripts._adaptive import AdaptiveLimit
+from nestly.scripts._common import (add_shard_arguments, add_where_argument,
+                                    positive_int, select_control_files)
 
 # Constants to be used as defaults.
 MAX_PROCS = 2                    # Set the default maximum number of child processes that can be spawned.
 DRY_RUN = False                   # Run in dry_run mode, default is False.
+TEMPLATE_CACHE = '.nestrun-templates'  # Default cache for --link-template-file, under the run directory.
 
 
 def _terminate_procs(procs):
@@ -44,7 +55,7 @@ def sigterm_handler(nlocal, signum, frame):
     nlocal['spawn_jobs'] = False
 
 def sigusr1_handler(running_procs, signum, frame):
-    for pid, (proc, _) in running_procs.iteritems():
+    for pid, (proc, _) in running_procs.items():
         sys.stderr.write('%5d - in %s\n' % (pid, proc.working_dir))
     sys.stderr.flush()  # just in case it's being buffered by something
 
@@ -72,18 +83,28 @@ def invoke(max_procs, data, json_files):
         functools.partial(sigint_handler, nlocal, write_this_summary,
                           running_procs))
 
+    metrics = data.get('metrics')
+    # Time each process slot became free, and when each process started
+    free_since = collections.deque([time.time()] * max_procs)
+    started = {}
+
+    # With -j auto, the limit is revised periodically, so wait for children
+    # with a timeout.
+    limit = data.get('concurrency')
+    timeout = None if limit is None else limit.interval
+
     files = iter(json_files)
     try:
         while True:
             while nlocal['spawn_jobs'] and len(running_procs) < max_procs:
                 try:
-                    json_file = files.next()
+                    json_file = next(files)
                 except StopIteration:
                     # no more files; allow other processes to finish.
                     break
                 g = worker(data, json_file)
                 try:
-                    proc = g.next()
+                    proc = next(g)
                 except StopIteration:
                     continue
                 except OSError:
@@ -95,9 +116,28 @@ def invoke(max_procs, data, json_files):
                 else:
                     all_procs.append(proc)
                     running_procs[proc.pid] = proc, g
+                    started[proc.pid] = json_file, time.time()
+                    slot_free = free_since.popleft() if free_since \
+                            else time.time()
+                    if metrics is not None:
+                        metrics.add(json_file, 'dispatch', slot_free)
+
+            if limit is not None:
+                previous, max_procs = max_procs, limit.update(
+                        len(running_procs))
+                if max_procs != previous:
+                    # Keep one entry per free slot
+                    free = max(0, max_procs - len(running_procs))
+                    while len(free_since) > free:
+                        free_since.pop()
+                    while len(free_since) < free:
+                        free_since.append(time.time())
+                if max_procs > previous:
+                    # Fill the new slots now
+                    continue
 
             try:
-                pid, status = os.wait()
+                pid, status = wait_child(timeout)
             except OSError as e:
                 # wait(2) raising ECHILD means there's no child processes to wait
                 # for anymore, so we're done.
@@ -107,14 +147,23 @@ def invoke(max_procs, data, json_files):
                     continue
                 else:
                     raise
+            if not pid:
+                continue
 
             # Pull the actual exit status - high byte of 16-bit number
             exit_status = os.WEXITSTATUS(status)
             proc, g = running_procs.pop(pid)
             proc.complete(exit_status)
+            json_file, start = started.pop(pid)
+            if len(running_procs) < max_procs:
+                free_since.append(time.time())
+            if metrics is not None:
+                metrics.add(json_file, 'run', start)
+            if limit is not None:
+                limit.completed()
 
             try:
-                g.next()
+                next(g)
             except StopIteration:
                 pass
             else:
@@ -133,6 +182,61 @@ def invoke(max_procs, data, json_files):
                         exit_status)
     finally:
         write_this_summary()
+        if metrics is not None:
+            write_metrics(metrics, data)
+
+def _ignore_signal(signum, frame):
+    pass
+
+def wait_child(timeout=None):
+    """
+    Wait for a child process to exit, as :func:`os.wait`. With ``timeout``,
+    return ``(0, 0)`` if none has exited within ``timeout`` seconds.
+    """
+    if timeout is None:
+        return os.wait()
+    if hasattr(signal, 'sigtimedwait'):
+        # Block SIGCHLD, so that a child exiting after the first check is
+        # kept pending for sigtimedwait rather than discarded.
+        mask = signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGCHLD])
+        try:
+            result = os.waitpid(-1, os.WNOHANG)
+            if result[0] or \
+                    signal.sigtimedwait([signal.SIGCHLD], timeout) is None:
+                return result
+            return os.waitpid(-1, os.WNOHANG)
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+
+    # Before Python 3.3: interrupt os.wait with SIGALRM. The handler does
+    # nothing, so a child which exits as the timer fires is never lost.
+    previous = signal.signal(signal.SIGALRM, _ignore_signal)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return os.wait()
+    except OSError as e:
+        if e.errno != errno.EINTR:
+            raise
+        return 0, 0
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+def write_metrics(metrics, data):
+    """
+    Log a summary of ``metrics``, and write them to ``data['metrics_file']``
+    if given, in ``data['metrics_format']``.
+    """
+    report = StringIO()
+    metrics.report(report)
+    logging.info('Job timings:\n%s', report.getvalue().rstrip())
+    metrics_file = data.get('metrics_file')
+    if metrics_file:
+        with open(metrics_file, 'w') as fp:
+            if data.get('metrics_format') == 'prometheus':
+                metrics.write_prometheus(fp)
+            else:
+                metrics.write_jsonl(fp)
 
 
 def write_summary(all_procs, summary_file):
@@ -162,6 +266,103 @@ def template_subs_file(in_file, out_fobj, d):
             out_fobj.write(line.format(**d))
 
 
+def cache_template(content, template_file, cache_dir, seen=None):
+    """
+    Store ``content``, a rendering of ``template_file``, in ``cache_dir``
+    under a name derived from its SHA-1 digest, with the permissions of
+    ``template_file``, unless already present. Returns the path.
+
+    :param seen: Optional set of paths known to exist, updated in place.
+    """
+    encoded = content.encode('utf-8')
+    path = os.path.join(cache_dir, '{0}-{1}'.format(
+        hashlib.sha1(encoded).hexdigest(), os.path.basename(template_file)))
+    if seen is not None and path in seen:
+        return path
+    if not os.path.exists(path):
+        try:
+            os.makedirs(cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Write to a temporary file and rename, so that concurrent runs
+        # sharing a cache never link to a partial file.
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(encoded)
+            try:
+                shutil.copymode(template_file, tmp)
+            except OSError as e:
+                if e.errno != errno.EPERM:
+                    raise
+                logging.warn("Couldn't set permissions on %s. "
+                        "Continuing with existing permissions", path)
+            os.rename(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+    if seen is not None:
+        seen.add(path)
+    return path
+
+
+def link_template(cached, output_template, how):
+    """
+    Replace ``output_template`` with a hard or symbolic link to ``cached``.
+    Returns ``False`` if a hard link could not be made, e.g. across file
+    systems.
+    """
+    try:
+        os.remove(output_template)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    if how == 'symlink':
+        os.symlink(os.path.relpath(cached, os.path.dirname(output_template)),
+                   output_template)
+        return True
+    try:
+        os.link(cached, output_template)
+    except OSError as e:
+        if e.errno in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+            return False
+        raise
+    return True
+
+
+class TemplateLinker(object):
+    """
+    Links renderings of a template file into job directories from a cache,
+    for ``--link-template-file``. Holds the state shared by every job of a
+    run.
+
+    :param cache_dir: Directory storing each distinct rendering once
+    :param how: ``'hardlink'`` or ``'symlink'``
+    """
+    def __init__(self, cache_dir, how):
+        self.cache_dir = cache_dir
+        self.how = how
+        self.seen = set()
+        self.warned = False
+
+    def link(self, content, template_file, output_template):
+        """
+        Link ``output_template`` to the cached copy of ``content``, a
+        rendering of ``template_file``. Returns ``False`` if no link could be
+        made, in which case the caller should write a copy.
+        """
+        cached = cache_template(content, template_file, self.cache_dir,
+                                self.seen)
+        if link_template(cached, output_template, self.how):
+            return True
+        if not self.warned:
+            logging.warn("Couldn't hard link %s to %s. Copying template "
+                    "files instead", cached, output_template)
+            self.warned = True
+        return False
+
+
 class NestlyProcess(object):
     """
     Metadata about a process run
@@ -209,13 +410,97 @@ class NestlyProcess(object):
             return ''.join(d)
 
 
+class ForkedCall(object):
+    """
+    A call running in a forked child process, with the parts of the
+    :class:`subprocess.Popen` interface used by :class:`NestlyProcess`.
+    """
+    def __init__(self, pid):
+        self.pid = pid
+
+    def terminate(self):
+        os.kill(self.pid, signal.SIGTERM)
+
+
+def load_callable(spec):
+    """
+    Import the function named by ``spec``, as ``module:function``. The
+    current directory is searched for the module first, as with
+    ``python -m``.
+    """
+    module_name, sep, attr = spec.partition(':')
+    if not (module_name and sep and attr):
+        raise ValueError("Expected module:function, got {0}".format(spec))
+    if os.getcwd() not in sys.path and '' not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    obj = importlib.import_module(module_name)
+    for part in attr.split('.'):
+        obj = getattr(obj, part)
+    if not callable(obj):
+        raise ValueError("{0} is not callable".format(spec))
+    return obj
+
+
+def fork_call(fn, control, working_dir, log):
+    """
+    Call ``fn(control, working_dir)`` in a forked child process, in
+    ``working_dir``, with standard output and error written to the file
+    object ``log``. The child inherits the modules already imported by this
+    process.
+
+    The child exits with the function's return value if it is an integer, 0
+    if it returns anything else, or 1 if it raises an exception, whose
+    traceback is written to the log.
+
+    Only the calling thread exists in the child. If another thread held a
+    lock when this process forked, such as the OpenBLAS or MKL thread pools
+    started by importing numpy, the child can deadlock acquiring it.
+    Requires :func:`os.fork`.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid:
+        return ForkedCall(pid)
+
+    status = 1
+    try:
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGUSR1):
+            signal.signal(signum, signal.SIG_DFL)
+        os.chdir(working_dir)
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        sys.stdout = sys.stderr = log
+        try:
+            result = fn(control, working_dir)
+        except SystemExit as e:
+            result = e.code if e.code is not None else 0
+            if not isinstance(result, int):
+                log.write('{0}\n'.format(result))
+                result = 1
+        if isinstance(result, int) and not isinstance(result, bool):
+            status = result
+        else:
+            status = 0
+    except BaseException:
+        traceback.print_exc(file=log)
+    finally:
+        try:
+            log.flush()
+        finally:
+            os._exit(status & 0xff)
+
+
 def worker(data, json_file):
     """
     Handle parameter substitution and execute command as child process.
     """
+    metrics = data.get('metrics')
+
     # PERHAPS TODO: Support either full or relative paths.
-    with open(json_file) as fp:
-        d = json.load(fp)
+    with phase(metrics, json_file, 'load'):
+        with open(json_file) as fp:
+            d = json.load(fp)
     json_directory = os.path.dirname(json_file)
     def p(*parts):
         return os.path.join(json_directory, *parts)
@@ -229,27 +514,41 @@ def worker(data, json_file):
 
     # if a template file is being used, then we write out to it
     template_file = data['template_file']
-    if template_file:
-        output_template = p(os.path.basename(template_file))
-        with open(output_template, 'w') as out_fobj:
-            template_subs_file(template_file, out_fobj, d)
-
-        # Copy permissions to destination
-        try:
-            shutil.copymode(template_file, output_template)
-        except OSError as e:
-            if e.errno == errno.EPERM:
-                logging.warn("Couldn't set permissions on %s. "
-                        "Continuing with existing permissions",
-                        output_template)
-            else:
-                raise
-
-    work = data['template'].format(**d)
+    fn = data.get('callable')
+    with phase(metrics, json_file, 'render'):
+        if template_file:
+            rendered = StringIO()
+            template_subs_file(template_file, rendered, d)
+        if fn is not None:
+            work = data['callable_name']
+        else:
+            work = data['template'].format(**d)
+
+    with phase(metrics, json_file, 'write'):
+        if template_file:
+            output_template = p(os.path.basename(template_file))
+            linker = data.get('template_link')
+            linked = linker is not None and linker.link(
+                    rendered.getvalue(), template_file, output_template)
+
+            if not linked:
+                with open(output_template, 'w') as out_fobj:
+                    out_fobj.write(rendered.getvalue())
+
+                # Copy permissions to destination
+                try:
+                    shutil.copymode(template_file, output_template)
+                except OSError as e:
+                    if e.errno == errno.EPERM:
+                        logging.warn("Couldn't set permissions on %s. "
+                                "Continuing with existing permissions",
+                                output_template)
+                    else:
+                        raise
 
-    if savecmd_file:
-        with open(p(savecmd_file), 'w') as command_file:
-            command_file.write(work + "\n")
+        if savecmd_file:
+            with open(p(savecmd_file), 'w') as command_file:
+                command_file.write(work + "\n")
 
     # View what actions will take place in dry_run mode.
     if data['dry_run']:
@@ -257,17 +556,22 @@ def worker(data, json_file):
     else:
         try:
             with open(p(log_file), 'w') as log:
-                cmd = shlex.split(work)
-                while True:
-                    try:
-                        pr = subprocess.Popen(
-                            cmd, stdout=log, stderr=log, cwd=p())
-                    except OSError as e:
-                        if e.errno != errno.EINTR:
-                            raise
-                        continue
+                with phase(metrics, json_file, 'spawn'):
+                    if fn is not None:
+                        cmd = [work]
+                        pr = fork_call(fn, d, p(), log)
                     else:
-                        break
+                        cmd = shlex.split(work)
+                        while True:
+                            try:
+                                pr = subprocess.Popen(
+                                    cmd, stdout=log, stderr=log, cwd=p())
+                            except OSError as e:
+                                if e.errno != errno.EINTR:
+                                    raise
+                                continue
+                            else:
+                                break
                 logging.info('[%d] Started %s in %s', pr.pid, work, p())
                 nestproc = NestlyProcess(cmd, p(), pr)
                 yield nestproc
@@ -279,6 +583,15 @@ def worker(data, json_file):
             raise e
 
 
+def processes(x):
+    """
+    'Type' for argparse - a positive number of processes, or ``auto``.
+    """
+    if x == 'auto':
+        return x
+    return positive_int(x)
+
+
 def extant_file(x):
     """
     'Type' for argparse - checks that file exists but does not open.
@@ -288,7 +601,7 @@ def extant_file(x):
     return x
 
 
-def parse_arguments():
+def parse_arguments(args=None):
     """
     Grab options and json files.
     """
@@ -300,16 +613,43 @@ def parse_arguments():
     parser = argparse.ArgumentParser(description="""nestrun - substitute values
             into a template and run commands in parallel.""")
     parser.add_argument('-j', '--processes', '--local', dest='local_procs',
-            type=int, help="""Run a maximum of N processes in parallel locally
-            (default: %(default)s)""", metavar='N', default=MAX_PROCS)
+            type=processes, help="""Run a maximum of N processes in parallel
+            locally, or 'auto' to adjust the number from the load average,
+            memory pressure and rate at which jobs complete (default:
+            %(default)s)""", metavar='N', default=MAX_PROCS)
+    parser.add_argument('--min-processes', type=positive_int, default=1,
+            metavar='N', help="""With -j auto, run at least %(metavar)s
+            processes (default: %(default)s)""")
+    parser.add_argument('--max-processes', type=positive_int, metavar='N',
+            help="""With -j auto, run at most %(metavar)s processes (default:
+            number of CPUs)""")
     parser.add_argument('--template', dest='template',
             metavar="'template text'", help="""Command-execution template, e.g.
             bash {infile}. By default, nestrun executes the templatefile.""")
+    parser.add_argument('--callable', metavar='MODULE:FUNCTION',
+            help="""Instead of running a command, call FUNCTION from MODULE
+            with each control dictionary and job directory, in a process
+            forked from nestrun. MODULE is imported once, before any jobs
+            start. Output is written to the log file; the job's exit status is
+            the function's return value, if an integer, or 1 if it raises an
+            exception. Requires fork(), so is unavailable on Windows. Forking
+            a process running threads, such as the BLAS thread pools started
+            by numpy, can deadlock jobs: set e.g. OPENBLAS_NUM_THREADS=1, or
+            start threads in FUNCTION rather than on import.""")
     parser.add_argument('--stop-on-error', action='store_true',
             default=False, help="""Terminate remaining processes if any process
             returns non-zero exit status (default: %(default)s)""")
     parser.add_argument('--template-file', dest='template_file', metavar="FILE",
             help='Command-execution template file path.')
+    parser.add_argument('--link-template-file', dest='template_link',
+            choices=('hardlink', 'symlink'), help="""Store each distinct
+            rendering of the template file once, in the template cache, and
+            link it into each job directory rather than writing a copy. With
+            hard links, a job which modifies its template file in place
+            modifies it for every job sharing the rendering.""")
+    parser.add_argument('--template-cache', metavar='DIR', help="""Directory
+            for --link-template-file renderings [default: .nestrun-templates
+            under the -d directory, or the current directory]""")
     parser.add_argument('--save-cmd-file', dest='savecmd_file',
             help="""Name of the file that will contain the command that was
             executed.""")
@@ -324,6 +664,17 @@ def parse_arguments():
             does not execute commands.""", default=False)
     parser.add_argument('--summary-file', type=argparse.FileType('w'),
             help="""Write a summary of the run to the specified file""")
+    parser.add_argument('--metrics', action='store_true', help="""Time each
+            phase of each job: reading the control file, rendering and writing
+            templates, starting the process, running it, and the delay between
+            a process slot becoming free and the next process starting. Logs
+            percentiles of each at the end of the run.""")
+    parser.add_argument('--metrics-file', metavar='FILE', help="""Write
+            timings to %(metavar)s. Implies --metrics.""")
+    parser.add_argument('--metrics-format', choices=('jsonl', 'prometheus'),
+            default='jsonl', help="""Format for --metrics-file: one JSON object
+            per job phase, or a Prometheus text format summary [default:
+            %(default)s]""")
 
     ctrl_group = parser.add_argument_group('Control files')
     ctrl_group.add_argument('json_files', metavar='control_files', type=extant_file,
@@ -331,19 +682,40 @@ def parse_arguments():
     ctrl_group.add_argument('-d', '--directory', help="""Run on all control
             files under %(metavar)s. May be used in place of specifying control
             files.""", metavar='DIR')
-    arguments = parser.parse_args()
+    add_where_argument(ctrl_group)
+    add_shard_arguments(ctrl_group)
+    arguments = parser.parse_args(args)
 
 
     # Load controls
     if bool(arguments.directory) == bool(arguments.json_files):
         parser.error('Exactly one of `-d` and control_files must be specified.')
-    elif arguments.directory:
-        arguments.json_files.extend(control_iter(arguments.directory))
+    try:
+        json_files = select_control_files(arguments.json_files,
+                                          arguments.directory,
+                                          arguments.where, arguments.index,
+                                          arguments.shard)
+    except IndexError as e:
+        parser.error(str(e))
 
     template = arguments.template
 
+    fn = None
+    if arguments.callable:
+        if arguments.template:
+            parser.error('--template and --callable are mutually exclusive.')
+        if not hasattr(os, 'fork'):
+            parser.error('--callable requires fork(), which is not available '
+                         'on this platform.')
+        try:
+            fn = load_callable(arguments.callable)
+        except (ImportError, AttributeError, ValueError) as e:
+            parser.error("Couldn't load {0}: {1}".format(arguments.callable,
+                                                         e))
+        logging.info('Callable: %s', arguments.callable)
+
     # Make sure that either a template or a template file was given
-    if arguments.template_file:
+    if arguments.template_file and fn is None:
         # if given a template file, the default is to run the input
         if not arguments.template:
             template = os.path.join('.',
@@ -356,13 +728,21 @@ def parse_arguments():
                         "{0} is not executable. Specify a template.".format(
                     arguments.template_file))
 
-    if not (arguments.template or arguments.template_file):
-        parser.exit("Error: Please specify either a template "
-                "or a template file")
-
-    logging.info('Template: %s', template)
-
-    if arguments.local_procs is not None:
+    if not (arguments.template or arguments.template_file or fn):
+        parser.exit("Error: Please specify either a template, "
+                "a template file or a callable")
+
+    if fn is None:
+        logging.info('Template: %s', template)
+
+    limit = None
+    if arguments.local_procs == 'auto':
+        limit = AdaptiveLimit(arguments.min_processes,
+                              arguments.max_processes)
+        logging.info('Running %d to %d processes', limit.minimum,
+                     limit.maximum)
+        max_procs = limit.limit
+    elif arguments.local_procs is not None:
         max_procs = arguments.local_procs
 
     # Create a dictionary that will be shared amongst all forked processes.
@@ -371,14 +751,29 @@ def parse_arguments():
     data['start_directory'] = os.getcwd()
     data['template'] = template
     data['template_file'] = arguments.template_file
+    if fn is not None:
+        data['callable'] = fn
+        data['callable_name'] = arguments.callable
+    if arguments.template_link and arguments.template_file:
+        data['template_link'] = TemplateLinker(
+                os.path.abspath(arguments.template_cache or
+                    os.path.join(arguments.directory or '.', TEMPLATE_CACHE)),
+                arguments.template_link)
     data['savecmd_file'] = arguments.savecmd_file
     data['log_file'] = arguments.log_file
     data['stop_on_error'] = arguments.stop_on_error
     data['summary_file'] = arguments.summary_file
-
-    return data, max_procs, arguments.json_files
-
-def main():
-    data, max_procs, json_files = parse_arguments()
+    data['concurrency'] = limit
+    if arguments.metrics or arguments.metrics_file:
+        data['metrics'] = RunMetrics(
+            keep_events=arguments.metrics_format == 'jsonl' and
+            bool(arguments.metrics_file))
+        data['metrics_file'] = arguments.metrics_file
+        data['metrics_format'] = arguments.metrics_format
+
+    return data, max_procs, json_files
+
+def main(args=sys.argv[1:]):
+    data, max_procs, json_files = parse_arguments(args)
     invoke(max_procs, data, json_files)
 
@@ -0,0 +1,236 @@
+"""
+Control tables shared between processes.
+
+A :class:`ControlTable` serializes a list of ``(control_path, control_dict)``
+pairs once, into a block of shared memory, with a table of offsets to each
+row. Worker processes attach to the block by its :attr:`~ControlTable.handle`
+and decode only the rows they are given, by position, rather than each
+re-reading control files or receiving controls pickled with every task::
+
+    with ControlTable.from_control_files(control_iter('runs')) as table:
+        pool = multiprocessing.Pool(4, init_worker, (table.handle,))
+        ...
+
+    def init_worker(handle):
+        global table
+        table = ControlTable.attach(handle)
+
+Blocks are created with :mod:`multiprocessing.shared_memory` where available
+(Python 3.8+), otherwise in a memory-mapped temporary file.
+
+:func:`nestly.core.nest_map` uses a table when called with ``processes``.
+"""
+
+import json
+import mmap
+import os
+import os.path
+import struct
+import tempfile
+
+from ._py3 import xrange
+from .core import ordered_load, ordered_loads
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# Row count, then (count + 1) offsets into the payload, then the payload
+_COUNT = struct.Struct('<Q')
+_OFFSETS = struct.Struct('<QQ')
+
+
+class _SharedMemoryBlock(object):
+    kind = 'shm'
+
+    def __init__(self, size=None, name=None):
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True,
+                                                   size=max(size, 1))
+        else:
+            try:
+                # Don't let the resource tracker unlink a block owned by
+                # another process
+                self._shm = shared_memory.SharedMemory(name=name, track=False)
+            except TypeError:
+                self._shm = shared_memory.SharedMemory(name=name)
+        self.name = self._shm.name
+        self.buf = self._shm.buf
+
+    def close(self):
+        self.buf = None
+        self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
+
+
+class _MmapBlock(object):
+    kind = 'mmap'
+
+    def __init__(self, size=None, name=None):
+        if name is None:
+            fd, name = tempfile.mkstemp(prefix='nestly-', suffix='.table')
+            os.ftruncate(fd, max(size, 1))
+        else:
+            fd = os.open(name, os.O_RDWR)
+        try:
+            self._mmap = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        self.name = name
+        self.buf = memoryview(self._mmap)
+
+    def close(self):
+        self.buf.release()
+        self.buf = None
+        self._mmap.close()
+
+    def unlink(self):
+        os.remove(self.name)
+
+
+_BLOCKS = dict((cls.kind, cls) for cls in (_SharedMemoryBlock, _MmapBlock))
+
+
+class ControlTable(object):
+    """
+    A read-only table of ``(control_path, control_dict)`` rows in shared
+    memory. Create with :meth:`create` or :meth:`from_control_files` in one
+    process, and :meth:`attach` to it from others.
+
+    Used as a context manager, the table is closed on exit, and removed if
+    this process created it.
+    """
+    def __init__(self, block, owner=False):
+        self._block = block
+        self._owner = owner
+        self._count, = _COUNT.unpack_from(block.buf, 0)
+        self._base = _COUNT.size + 8 * (self._count + 1)
+
+    @classmethod
+    def create(cls, items, use_mmap=False):
+        """
+        Serialize ``items``, an iterable of ``(control_path, control_dict)``
+        pairs, into a new block.
+
+        :param use_mmap: Use a memory-mapped temporary file even if
+            :mod:`multiprocessing.shared_memory` is available.
+        """
+        rows = [json.dumps([path, control]).encode('utf-8')
+                for path, control in items]
+        offsets = [0]
+        for row in rows:
+            offsets.append(offsets[-1] + len(row))
+        header = _COUNT.pack(len(rows)) + \
+                struct.pack('<{0}Q'.format(len(offsets)), *offsets)
+        size = len(header) + offsets[-1]
+        block_cls = _MmapBlock if use_mmap or shared_memory is None \
+                else _SharedMemoryBlock
+        block = block_cls(size=size)
+        buf = block.buf
+        buf[:len(header)] = header
+        position = len(header)
+        for row in rows:
+            buf[position:position + len(row)] = row
+            position += len(row)
+        return cls(block, owner=True)
+
+    @classmethod
+    def from_control_files(cls, control_files, use_mmap=False):
+        """
+        Read each of ``control_files`` once, and serialize them into a new
+        block.
+        """
+        def load(path):
+            with open(path) as fp:
+                return path, ordered_load(fp)
+        return cls.create((load(p) for p in control_files), use_mmap)
+
+    @classmethod
+    def attach(cls, handle):
+        """
+        Attach to a table created by another process, given its
+        :attr:`handle`.
+        """
+        kind, name = handle
+        return cls(_BLOCKS[kind](name=name))
+
+    @property
+    def handle(self):
+        """
+        Picklable reference to the table, for :meth:`attach`.
+        """
+        return self._block.kind, self._block.name
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        """
+        Decode row ``i``, returning ``(control_path, control_dict)``.
+        """
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError("ControlTable index out of range")
+        start, end = _OFFSETS.unpack_from(self._block.buf,
+                                          _COUNT.size + 8 * i)
+        row = bytes(self._block.buf[self._base + start:self._base + end])
+        path, control = ordered_loads(row.decode('utf-8'))
+        return path, control
+
+    def __iter__(self):
+        for i in xrange(self._count):
+            yield self[i]
+
+    def close(self):
+        self._block.close()
+
+    def unlink(self):
+        """
+        Remove the table. Processes already attached may continue to use it.
+        """
+        self._block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        if self._owner:
+            self.unlink()
+
+
+# Per-process state of nest_map workers
+_worker_table = None
+_worker_fn = None
+
+def _init_worker(handle, map_fn):
+    global _worker_table, _worker_fn
+    _worker_table = ControlTable.attach(handle)
+    _worker_fn = map_fn
+
+def _call_worker(i):
+    path, control = _worker_table[i]
+    return _worker_fn(os.path.dirname(path), control)
+
+def shared_nest_map(control_files, map_fn, processes, chunksize=16):
+    """
+    Apply ``map_fn`` to each of ``control_files`` in a pool of ``processes``
+    worker processes, as :func:`nestly.core.nest_map`.
+
+    Control files are read once, into a :class:`ControlTable`; tasks are
+    sent to workers as row numbers. Results are generated in order.
+    """
+    import multiprocessing
+    with ControlTable.from_control_files(control_files) as table:
+        pool = multiprocessing.Pool(processes, _init_worker,
+                                    (table.handle, map_fn))
+        try:
+            for r in pool.imap(_call_worker, xrange(len(table)), chunksize):
+                yield r
+        finally:
+            pool.terminate()
+            pool.join()
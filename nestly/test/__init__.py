@@ -1,10 +1,12 @@
 import unittest
 
-from . import test_core, test_scons
+from . import (test_aio, test_core, test_imports, test_nestagg, test_nestrun,
+               test_scons, test_shared)
 
 def suite():
     suite = unittest.TestSuite()
-    for mod in [test_core, test_scons]:
+    for mod in [test_aio, test_core, test_imports, test_nestagg, test_nestrun,
+                test_scons, test_shared]:
         suite.addTest(mod.suite())
     return suite
 
@@ -0,0 +1,17 @@
+"""
+Coroutines used by test_aio. ``async def`` is a syntax error before Python
+3.5 (and asynchronous comprehensions before 3.6), so they are kept out of
+test_aio, which is imported on every version.
+"""
+
+import asyncio
+
+from nestly import aio
+
+async def double_run_id(d, control):
+    await asyncio.sleep(0)
+    return control['run_id'] * 2
+
+async def collect(controls, map_fn, concurrency):
+    return [r async for _, _, r in aio.async_nest_map(
+        controls, map_fn, concurrency=concurrency)]
@@ -0,0 +1,79 @@
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    import asyncio
+    from nestly import aio
+    from . import _aio_coroutines
+except (ImportError, SyntaxError):
+    aio = None
+
+from nestly import core
+
+def _run_id(d, c):
+    return c['run_id']
+
+@unittest.skipIf(aio is None, 'requires Python 3.6+')
+class AsyncNestMapTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        nest = core.Nest()
+        nest.add('run_id', list(range(20)))
+        nest.build(self.root)
+        self.controls = sorted(core.control_iter(self.root))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_concurrent_nest_map(self):
+        results = list(aio.concurrent_nest_map(self.controls, _run_id,
+                                               concurrency=4))
+        self.assertEqual(20, len(results))
+        for d, control, result in results:
+            self.assertEqual(control['run_id'], result)
+            self.assertEqual(os.path.join(self.root, str(result)), d)
+        self.assertEqual(sorted(core.nest_map(self.controls, _run_id)),
+                         sorted(r for _, _, r in results))
+
+    def test_ordered(self):
+        results = aio.concurrent_nest_map(self.controls, _run_id,
+                                          concurrency=4, ordered=True)
+        self.assertEqual(list(core.nest_map(self.controls, _run_id)),
+                         [r for _, _, r in results])
+
+    def test_coroutine(self):
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(_aio_coroutines.collect(
+                self.controls, _aio_coroutines.double_run_id, 3))
+        finally:
+            loop.close()
+        self.assertEqual(list(range(0, 40, 2)), sorted(results))
+
+    def test_bounded(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'max': 0}
+
+        def fn(i):
+            with lock:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+            return i
+
+        self.assertEqual(list(range(30)),
+                         list(aio.concurrent_imap(fn, range(30), 5)))
+        self.assertTrue(1 < state['max'] <= 5)
+
+def suite():
+    suite = unittest.TestSuite()
+    for cls in [AsyncNestMapTestCase]:
+        suite.addTest(unittest.makeSuite(cls))
+    return suite
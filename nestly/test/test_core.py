@@ -1,13 +1,16 @@
+import collections
 import contextlib
+import io
 import json
 import os
 import os.path
 import unittest
 import tempfile
 import shutil
+import sys
 import warnings
 
-from nestly import core
+from nestly import core, instrument
 
 @contextlib.contextmanager
 def tempdir():
@@ -67,6 +70,21 @@ class SimpleNestTestCase(NestCompareMixIn, unittest.TestCase):
                     d = json.load(fp)
                 self.assertEqual(expected[a], d)
 
+    def test_iter_changes_persist(self):
+        for _, control in self.nest:
+            control['x'] = control['number'] * 2
+        self.nest.add('last', [None], create_dir=False)
+        self.assertEqual([2, 2, 20, 20], [c['x'] for _, c in self.nest])
+        self.assertEqual(('10/a', dict(self.expected[2][1], x=20, last=None)),
+                         self.nest[2])
+        self.assertEqual(4, len(self.nest))
+
+    def test_iter_partial(self):
+        for _, control in self.nest:
+            control['x'] = 1
+            break
+        self.assertNestsEqual(self.expected, list(self.nest))
+
     def test_stringiter_warning(self):
         with warnings.catch_warnings(record=True) as w:
             warnings.simplefilter("always")
@@ -129,6 +147,322 @@ class OutdirTestCase(NestCompareMixIn, unittest.TestCase):
         self.assertNestsEqual(expected, actual)
 
 
+class ConstraintTestCase(unittest.TestCase):
+    def setUp(self):
+        self.nest = core.Nest(include_outdir=False)
+        self.calls = []
+
+    def predicate(self, c):
+        self.calls.append((c['a'], c['b']))
+        return c['a'] < c['b']
+
+    def test_pending(self):
+        self.nest.add_constraint(self.predicate, keys=['a', 'b'])
+        self.nest.add('a', [1, 2, 3])
+        self.assertEqual([], self.calls)
+        self.nest.add('b', [1, 2, 3])
+        self.nest.add('c', ['x', 'y'])
+        self.assertEqual([(1, 2), (1, 3), (2, 3)],
+                         [(c['a'], c['b']) for _, c in self.nest][::2])
+        self.assertEqual(6, len(list(self.nest)))
+        # Evaluated once per combination, not per leaf
+        self.assertEqual(9, len(self.calls))
+
+    def test_prunes_before_expansion(self):
+        expanded = []
+
+        def nestable(c):
+            expanded.append(c['b'])
+            return [1, 2]
+        self.nest.add('a', [1, 2])
+        self.nest.add('b', [1, 2])
+        self.nest.add_constraint(self.predicate, keys=['a', 'b'])
+        self.nest.add('c', nestable)
+        self.assertEqual([(1, 1), (1, 2), (2, 1), (2, 2)], self.calls)
+        self.assertEqual([2], expanded)
+
+    def test_update(self):
+        self.nest.add_constraint(lambda c: c['a'] != c['b'], keys=['a', 'b'])
+        self.nest.add('a', [1, 2])
+        self.nest.add('ab', lambda c: [{'ab': 'same', 'b': c['a']},
+                                           {'ab': 'zero', 'b': 0}],
+                      update=True)
+        self.assertEqual([(1, 0), (2, 0)],
+                         [(c['a'], c['b']) for _, c in self.nest])
+
+    def test_no_keys(self):
+        self.nest.add('a', [1, 2, 3])
+        self.nest.add_constraint(lambda c: c['a'] % 2)
+        self.nest.add('b', [1, 2])
+        self.assertEqual([1, 1, 3, 3], [c['a'] for _, c in self.nest])
+
+class IndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.nest = core.Nest()
+        self.nest.add('a', [1, 2])
+        self.nest.add('b', lambda c: range(c['a']))
+        self.nest.add('c', ['x', 'y', 'z'])
+        self.nest.add('d', [0.1, 0.2], create_dir=False)
+        self.all = list(self.nest)
+
+    def test_len(self):
+        self.assertEqual(18, len(self.nest))
+
+    def test_len_large(self):
+        nest = core.Nest()
+        for name in 'abcdefgh':
+            nest.add(name, list(range(100)))
+        self.assertEqual(100 ** 8, len(nest))
+        outdir, control = nest[-1]
+        self.assertEqual(os.path.join(*['99'] * 8), outdir)
+
+    def test_size_unbounded(self):
+        nest = core.Nest()
+        for name in 'abcdefghijk':
+            nest.add(name, list(range(100)))
+        self.assertEqual(100 ** 11, nest.size())
+        self.assertRaises(OverflowError, len, nest)
+        self.assertTrue(nest)
+
+    def test_sample_unbounded(self):
+        nest = core.Nest()
+        for name in 'abcdefghijk':
+            nest.add(name, list(range(100)))
+        sampled = list(nest.sample(3, seed=1))
+        self.assertEqual(3, len(sampled))
+        self.assertEqual(3, len(set(outdir for outdir, _ in sampled)))
+        for outdir, control in sampled:
+            self.assertEqual(os.path.join(*[str(control[name])
+                                            for name in 'abcdefghijk']),
+                             outdir)
+
+    def test_bool(self):
+        self.nest.add_constraint(lambda c: False, keys=['d'])
+        self.assertEqual(0, self.nest.size())
+        self.assertTrue(self.nest)
+
+    def test_getitem(self):
+        self.assertEqual(self.all, [self.nest[i] for i in range(18)])
+        self.assertEqual(self.all[-3], self.nest[-3])
+        self.assertRaises(IndexError, self.nest.__getitem__, 18)
+        self.assertRaises(IndexError, self.nest.__getitem__, -19)
+
+    def test_constraint(self):
+        self.nest.add_constraint(lambda c: c['c'] != 'y', keys=['c'])
+        expected = [i for i in self.all if i[1]['c'] != 'y']
+        self.assertEqual(len(expected), len(self.nest))
+        self.assertEqual(expected[5], self.nest[5])
+        # Level d does not create a directory, so each holds two controls
+        self.assertRaises(ValueError, self.nest.index_of, expected[4][0])
+
+    def test_index_of_constraint(self):
+        nest = core.Nest()
+        nest.add('a', [1, 2])
+        nest.add('b', ['x', 'y'])
+        nest.add_constraint(lambda c: c['b'] != 'x', keys=['b'])
+        outdir = os.path.join('2', 'y')
+        self.assertEqual(1, nest.index_of(outdir))
+        self.assertEqual([os.path.join('1', 'y'), outdir],
+                         [d for d, _ in nest])
+        self.assertEqual(1, nest.index_of(outdir))
+
+    def test_index_of(self):
+        nest = core.Nest()
+        nest.add('a', [1, 2])
+        nest.add('b', ['x', 'y'])
+        for i, (outdir, _) in enumerate(nest):
+            self.assertEqual(i, nest.index_of(outdir))
+            self.assertEqual(
+                i, nest.index_of(os.path.join('runs', outdir), root='runs'))
+        self.assertRaises(ValueError, nest.index_of, os.path.join('3', 'x'))
+
+    def test_index_of_ambiguous(self):
+        self.assertRaises(ValueError, self.nest.index_of,
+                          os.path.join('1', '0', 'x'))
+
+    def test_build_leaf(self):
+        with tempdir() as td:
+            path = self.nest.build_leaf(7, td)
+            with open(path) as fp:
+                self.assertEqual(self.nest[7][1], json.load(fp))
+            self.assertEqual(
+                os.path.join(td, self.nest[7][0], 'control.json'), path)
+
+class SampleTestCase(unittest.TestCase):
+    def setUp(self):
+        self.nest = core.Nest()
+        self.nest.add('a', list(range(10)))
+        self.nest.add('b', ['x', 'y', 'z'])
+        self.nest.add('c', list(range(100)))
+        self.all = list(self.nest)
+
+    def test_uniform(self):
+        sample = list(self.nest.sample(20, seed=1))
+        self.assertEqual(20, len(sample))
+        self.assertEqual(20, len(set(d for d, _ in sample)))
+        # In nest order
+        self.assertEqual(sorted(sample, key=self.all.index), sample)
+        for item in sample:
+            self.assertTrue(item in self.all)
+
+    def test_large(self):
+        nest = core.Nest()
+        for name in 'abcdefgh':
+            nest.add(name, list(range(100)))
+        self.assertEqual(3, len(list(nest.sample(3, seed=1))))
+
+    def test_seed(self):
+        self.assertEqual(list(self.nest.sample(5, seed=2)),
+                         list(self.nest.sample(5, seed=2)))
+
+    def test_more_than_size(self):
+        self.assertEqual(self.all, list(self.nest.sample(10000, seed=1)))
+
+    def test_lhs(self):
+        sample = list(self.nest.sample(30, seed=1, method='lhs'))
+        self.assertEqual(30, len(sample))
+        counts = collections.Counter(c['b'] for _, c in sample)
+        self.assertEqual({'x': 10, 'y': 10, 'z': 10}, counts)
+        self.assertEqual(set(range(10)), set(c['a'] for _, c in sample))
+
+    def test_stratified(self):
+        sample = list(self.nest.sample(4, seed=1, method='stratified',
+                                       by='b'))
+        counts = collections.Counter(c['b'] for _, c in sample)
+        self.assertEqual({'x': 4, 'y': 4, 'z': 4}, counts)
+
+    def test_stratified_materialized(self):
+        self.nest.add('d', lambda c: [c['c'] % 2])
+        sample = list(self.nest.sample(3, seed=1, method='stratified',
+                                       by='a'))
+        counts = collections.Counter(c['a'] for _, c in sample)
+        self.assertEqual(dict((i, 3) for i in range(10)), counts)
+
+    def test_constraint(self):
+        self.nest.add_constraint(lambda c: c['c'] < 5, keys=['c'])
+        sample = list(self.nest.sample(200, seed=1))
+        self.assertEqual(150, len(sample))
+        self.assertTrue(all(c['c'] < 5 for _, c in sample))
+
+    def test_sparse_constraint(self):
+        # Too few leaves remain to find by random draws
+        self.nest.add_constraint(lambda c: c['c'] == 7 and c['a'] < 2,
+                                 keys=['a', 'c'])
+        sample = list(self.nest.sample(10, seed=1))
+        self.assertEqual([(a, b, 7) for a in range(2) for b in 'xyz'],
+                         [(c['a'], c['b'], c['c']) for _, c in sample])
+
+    def test_add_after(self):
+        sample = self.nest.sample(5, seed=1)
+        sample.add('d', [1, 2])
+        self.assertEqual(10, len(list(sample)))
+        self.assertEqual(len(self.all), len(list(self.nest)))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.nest.sample, 5, method='bogus')
+        self.assertRaises(ValueError, self.nest.sample, 5,
+                          method='stratified')
+
+class MemoizeTestCase(NestCompareMixIn, unittest.TestCase):
+    def setUp(self):
+        self.nest = core.Nest(include_outdir=False)
+        self.nest.add('tree', ['t1', 't2'])
+        self.nest.add('rep', [1, 2, 3])
+        self.calls = []
+
+    def nestable(self, c):
+        self.calls.append(c['tree'])
+        return [c['tree'] + '-a', c['tree'] + '-b']
+
+    def test_depends_on(self):
+        expected = core.Nest(include_outdir=False)
+        expected.add('tree', ['t1', 't2'])
+        expected.add('rep', [1, 2, 3])
+        expected.add('k', self.nestable)
+        self.calls = []
+
+        self.nest.add('k', self.nestable, depends_on=['tree'])
+        self.assertEqual(['t1', 't2'], self.calls)
+        self.assertNestsEqual(list(expected.iter()), list(self.nest.iter()))
+
+    def test_depends_on_template_subs(self):
+        def nestable(c):
+            self.calls.append(c['tree'])
+            return ['{tree}-{rep}']
+        self.nest.add('k', nestable, depends_on=['tree'], template_subs=True)
+        self.assertEqual(['t1', 't2'], self.calls)
+        self.assertEqual(['t1-1', 't1-2', 't1-3', 't2-1', 't2-2', 't2-3'],
+                         [c['k'] for _, c in self.nest])
+
+    def test_depends_on_missing(self):
+        self.assertRaises(KeyError, self.nest.add, 'k', self.nestable,
+                          depends_on=['missing'])
+
+    def test_workers(self):
+        self.nest.add('k', self.nestable, workers=4)
+        self.assertEqual(6, len(self.calls))
+        self.assertEqual(['t1-a', 't1-b'] * 3 + ['t2-a', 't2-b'] * 3,
+                         [c['k'] for _, c in self.nest])
+
+class SelectTestCase(unittest.TestCase):
+    def setUp(self):
+        self.nest = core.Nest()
+        self.nest.add('algorithm', ['full', 'pam'])
+        self.nest.add('k', [1, 5, 10, 50])
+        self.nest.add('tags', lambda c: [['a', c['algorithm']]],
+                      create_dir=False)
+
+    def test_equality(self):
+        actual = [d for d, _ in self.nest.select(algorithm='pam', k=5)]
+        self.assertEqual(['pam/5'], actual)
+
+    def test_membership(self):
+        actual = [d for d, _ in self.nest.select(k=[1, 50, 1000])]
+        self.assertEqual(['full/1', 'full/50', 'pam/1', 'pam/50'], actual)
+
+    def test_predicate(self):
+        actual = [d for d, _ in self.nest.select(algorithm='full',
+                                                 k=lambda k: 5 <= k < 50)]
+        self.assertEqual(['full/5', 'full/10'], actual)
+
+    def test_unhashable(self):
+        actual = [d for d, _ in self.nest.select(tags=(['a', 'pam'],),
+                                                 k=10)]
+        self.assertEqual(['pam/10'], actual)
+
+    def test_no_match(self):
+        self.assertEqual([], self.nest.select(algorithm='other'))
+        self.assertEqual([], self.nest.select(missing=1))
+
+    def test_invalidated_by_add(self):
+        self.assertEqual(2, len(self.nest.select(k=1)))
+        self.nest.add('rep', [1, 2])
+        self.assertEqual(4, len(self.nest.select(k=1)))
+
+    def test_manifest(self):
+        with tempdir() as td:
+            self.nest.build(td, manifest=True)
+            index = core.NestIndex.from_manifest(td)
+            self.assertEqual(8, len(index))
+            actual = [p for p, c in index.select(algorithm='pam', k=50)]
+            self.assertEqual([os.path.join(td, 'pam', '50', 'control.json')],
+                             actual)
+            self.assertTrue(os.path.exists(actual[0]))
+
+    def test_manifest_entry(self):
+        with tempdir() as td:
+            self.nest.build(td, manifest=True)
+            entries = list(core.iter_manifest(td))
+            for i, entry in enumerate(entries):
+                self.assertEqual(entry, core.manifest_entry(td, i))
+            self.assertEqual(entries[-1], core.manifest_entry(td, -1))
+            self.assertRaises(IndexError, core.manifest_entry, td, 8)
+
+            # Appending to the manifest leaves the index out of date
+            with open(os.path.join(td, core.MANIFEST_NAME), 'a') as fp:
+                fp.write('{}\n')
+            self.assertRaises(ValueError, core.manifest_entry, td, 0)
+
 class IsIterTestCase(unittest.TestCase):
 
     def test_list(self):
@@ -177,10 +511,102 @@ class NestMapTestCase(SimpleNestMixin, unittest.TestCase):
         expected = [1, 2]
         self.assertEqual(expected, actual)
 
+class ProfilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.profiler = instrument.NestProfiler()
+        self.nest = core.Nest(profiler=self.profiler)
+        self.nest.add('a', [1, 2])
+        self.nest.add('b', lambda c: range(c['a']))
+
+    def test_events(self):
+        events = self.profiler.events
+        self.assertEqual(['a', 'b'], [e.name for e in events])
+        self.assertEqual(['add', 'add'], [e.kind for e in events])
+        self.assertEqual([2, 3], [e.controls for e in events])
+        for e in events:
+            self.assertTrue(e.duration >= 0)
+
+    def test_chrome_trace(self):
+        fp = io.StringIO() if sys.version_info[0] == 3 else io.BytesIO()
+        self.profiler.write_chrome_trace(fp)
+        trace = json.loads(fp.getvalue())
+        self.assertEqual(2, len(trace['traceEvents']))
+        self.assertEqual('X', trace['traceEvents'][0]['ph'])
+        self.assertEqual(3, trace['traceEvents'][1]['args']['controls'])
+
+class RunMetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.seen = []
+        self.metrics = instrument.RunMetrics(callbacks=[self.seen.append])
+        for i in range(1, 101):
+            self.metrics.add('job{0}'.format(i), 'run', 0, i / 100.0)
+        self.metrics.add('job1', 'load', 0, 0.5)
+
+    def test_percentile(self):
+        values = list(range(1, 11))
+        self.assertEqual(5, instrument.percentile(values, 50))
+        self.assertEqual(9, instrument.percentile(values, 90))
+        self.assertEqual(10, instrument.percentile(values, 99))
+        self.assertEqual(1, instrument.percentile(values, 0))
+        self.assertEqual(None, instrument.percentile([], 50))
+
+    def test_summary(self):
+        summary = self.metrics.summary()
+        self.assertEqual(['load', 'run'], sorted(summary))
+        run = summary['run']
+        self.assertEqual(100, run['count'])
+        self.assertAlmostEqual(0.5, run['p50'])
+        self.assertAlmostEqual(0.9, run['p90'])
+        self.assertAlmostEqual(0.99, run['p99'])
+        self.assertAlmostEqual(1.0, run['max'])
+        self.assertAlmostEqual(50.5, run['sum'])
+
+    def test_callbacks(self):
+        self.assertEqual(101, len(self.seen))
+        self.assertEqual(('job1', 'load'), (self.seen[-1].job,
+                                            self.seen[-1].phase))
+
+    def test_phase(self):
+        with instrument.phase(self.metrics, 'job2', 'render'):
+            pass
+        with instrument.phase(None, 'job2', 'render'):
+            pass
+        self.assertEqual(1, self.metrics.summary()['render']['count'])
+
+    def test_jsonl(self):
+        fp = io.StringIO() if sys.version_info[0] == 3 else io.BytesIO()
+        self.metrics.write_jsonl(fp)
+        lines = [json.loads(l) for l in fp.getvalue().splitlines()]
+        self.assertEqual(101, len(lines))
+        self.assertEqual({'job': 'job1', 'phase': 'run', 'start': 0,
+                          'duration': 0.01}, lines[0])
+
+    def test_prometheus(self):
+        fp = io.StringIO() if sys.version_info[0] == 3 else io.BytesIO()
+        self.metrics.write_prometheus(fp)
+        lines = fp.getvalue().splitlines()
+        self.assertEqual('# TYPE nestrun_phase_seconds summary', lines[1])
+        self.assertIn('nestrun_phase_seconds{phase="run",quantile="0.9"} 0.9',
+                      lines)
+        self.assertIn('nestrun_phase_seconds_count{phase="run"} 100', lines)
+
+    def test_no_events(self):
+        metrics = instrument.RunMetrics(keep_events=False)
+        metrics.add('job1', 'run', 0, 1.0)
+        self.assertEqual([], metrics.events)
+        self.assertEqual(1, metrics.summary()['run']['count'])
+
 def suite():
     suite = unittest.TestSuite()
-    for cls in [IsIterTestCase,
+    for cls in [ConstraintTestCase,
+            IndexTestCase,
+            IsIterTestCase,
+            MemoizeTestCase,
             NestMapTestCase,
+            ProfilerTestCase,
+            RunMetricsTestCase,
+            SampleTestCase,
+            SelectTestCase,
             SimpleNestTestCase,
             TemplateTestCase,
             UpdateTestCase]:
@@ -0,0 +1,55 @@
+import json
+import subprocess
+import sys
+import unittest
+
+
+def imported_modules(statement):
+    """
+    Return the set of modules loaded after running ``statement`` in a fresh
+    interpreter.
+    """
+    code = '{0}; import json, sys; print(json.dumps(sorted(sys.modules)))'
+    output = subprocess.check_output([sys.executable, '-c',
+                                      code.format(statement)])
+    return set(json.loads(output.decode('utf-8')))
+
+
+class ImportTestCase(unittest.TestCase):
+    def assertNotImported(self, statement, modules):
+        loaded = imported_modules(statement)
+        self.assertEqual(set(), loaded.intersection(modules))
+
+    def test_nestagg(self):
+        self.assertNotImported(
+            'import nestly.scripts.nestagg',
+            ['asyncio', 'multiprocessing', 'numpy', 'pickle', 'pyarrow',
+             'tracemalloc', 'zipfile'])
+
+    def test_nestrun(self):
+        self.assertNotImported(
+            'import nestly.scripts.nestrun', ['tracemalloc'])
+
+    def test_scons(self):
+        self.assertNotImported('import nestly.scons', ['SCons'])
+        from nestly import scons
+        self.assertTrue(scons.HAS_SCONS in (True, False))
+
+    @unittest.skipIf(sys.version_info < (3, 7),
+                     'module __getattr__ requires Python 3.7')
+    def test_package(self):
+        self.assertNotImported('import nestly; nestly.__version__',
+                               ['nestly.core'])
+        self.assertTrue('nestly.core' in
+                        imported_modules('from nestly import Nest'))
+        self.assertTrue('nestly.core' in
+                        imported_modules('import nestly; nestly.core.Nest'))
+        self.assertTrue('nestly.scons' in
+                        imported_modules('import nestly; nestly.scons'))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    for cls in [ImportTestCase]:
+        suite.addTest(unittest.makeSuite(cls))
+    return suite
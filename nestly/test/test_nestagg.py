@@ -0,0 +1,387 @@
+import argparse
+import collections
+import csv
+import json
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+import mock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+from nestly import core, offsets
+from nestly.scripts import _common, nestagg
+
+class DelimMixin(object):
+    """
+    Builds a temporary nest with a small delimited file in each leaf
+    """
+    def setUp(self):
+        self.td = tempfile.mkdtemp(prefix='nestagg')
+        n = core.Nest()
+        n.add('run_id', range(6))
+        n.build(self.td)
+        for d, c in n.iter(self.td):
+            with open(os.path.join(d, 'result.csv'), 'w') as fp:
+                fp.write('x,y\n')
+                for i in range(3):
+                    fp.write('{0},{1}\n'.format(i, c['run_id'] * i))
+        self.controls = sorted(core.control_iter(self.td))
+        self.output = os.path.join(self.td, 'output.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.td)
+
+    def run_delim(self, *args):
+        nestagg.main(['delim', '-o', self.output] + list(args) +
+                     ['result.csv'] + self.controls)
+        with open(self.output) as fp:
+            return list(csv.reader(fp))
+
+class DelimTestCase(DelimMixin, unittest.TestCase):
+    def test_basic(self):
+        rows = self.run_delim()
+        self.assertEqual(['x', 'y', 'OUTDIR', 'run_id'], rows[0])
+        self.assertEqual(1 + 6 * 3, len(rows))
+        self.assertEqual(['2', '4', '2', '2'], rows[9])
+
+    def test_keys(self):
+        rows = self.run_delim('-k', 'run_id')
+        self.assertEqual(['x', 'y', 'run_id'], rows[0])
+
+    def test_parallel_matches_serial(self):
+        serial = self.run_delim()
+        parallel = self.run_delim('-j', '2')
+        self.assertEqual(serial, parallel)
+
+    @unittest.skipIf(sys.version_info < (3, 6), 'requires Python 3.6+')
+    def test_io_concurrency(self):
+        serial = self.run_delim()
+        self.assertEqual(serial, self.run_delim('--io-concurrency', '4'))
+        unordered = self.run_delim('--io-concurrency', '4', '--unordered')
+        self.assertEqual(sorted(serial[1:]), sorted(unordered[1:]))
+
+    def test_parallel_unordered(self):
+        serial = self.run_delim()
+        unordered = self.run_delim('-j', '2', '--unordered')
+        self.assertEqual(serial[0], unordered[0])
+        self.assertEqual(sorted(serial[1:]), sorted(unordered[1:]))
+
+    def test_missing_warn(self):
+        os.remove(os.path.join(os.path.dirname(self.controls[0]),
+                               'result.csv'))
+        rows = self.run_delim('-m', 'warn')
+        self.assertEqual(1 + 5 * 3, len(rows))
+
+    def test_missing_fail(self):
+        os.remove(os.path.join(os.path.dirname(self.controls[0]),
+                               'result.csv'))
+        self.assertRaises(IOError, self.run_delim)
+
+    def test_extra_field(self):
+        with open(os.path.join(os.path.dirname(self.controls[-1]),
+                               'result.csv'), 'w') as fp:
+            fp.write('x,y,z\n1,2,3\n')
+        self.assertRaises(ValueError, self.run_delim)
+
+    def test_union(self):
+        with open(os.path.join(os.path.dirname(self.controls[-1]),
+                               'result.csv'), 'w') as fp:
+            fp.write('z,x\n3,1\n')
+        rows = self.run_delim('--union', '--fill-value', 'NA', '-j', '2')
+        self.assertEqual(['x', 'y', 'z', 'OUTDIR', 'run_id'], rows[0])
+        self.assertEqual(['0', '0', 'NA', '0', '0'], rows[1])
+        self.assertEqual(['1', 'NA', '3', '5', '5'], rows[-1])
+
+    def test_control_key_collision(self):
+        with open(os.path.join(os.path.dirname(self.controls[-1]),
+                               'result.csv'), 'w') as fp:
+            fp.write('x,run_id\n1,7\n')
+        for args in [('--union',), ('-f', 'jsonl')]:
+            self.assertRaises(ValueError, self.run_delim, *args)
+        # Without --union, the control value replaces the data column
+        rows = self.run_delim('-m', 'warn')
+        self.assertEqual(['x', 'y', 'OUTDIR', 'run_id'], rows[0])
+        self.assertEqual(['1', '', '5', '5'], rows[-1])
+        rows = self.run_delim('--union', '-x', 'run_id')
+        self.assertEqual(['x', 'y', 'run_id', 'OUTDIR'], rows[0])
+        self.assertEqual(['1', '', '7', '5'], rows[-1])
+
+class WriteIndexTestCase(DelimMixin, unittest.TestCase):
+    def test_delim(self):
+        missing = os.path.dirname(self.controls[0])
+        os.remove(os.path.join(missing, 'result.csv'))
+        self.run_delim('--write-index', '-m', 'warn', '-k', 'run_id')
+        with offsets.IndexedFile(self.output) as records:
+            self.assertEqual(6, len(records))
+            self.assertEqual(b'x,y,run_id\r\n', records.header)
+            self.assertEqual(b'', records[0])
+            self.assertEqual(b'0,0,3\r\n1,3,3\r\n2,6,3\r\n', records[3])
+
+    def test_jsonl(self):
+        self.run_delim('--write-index', '-f', 'jsonl', '-k', 'run_id')
+        with offsets.IndexedFile(self.output) as records:
+            self.assertEqual(b'', records.header)
+            rows = [json.loads(line) for line in
+                    records[5].decode('utf-8').splitlines()]
+        self.assertEqual([5, 5, 5], [r['run_id'] for r in rows])
+
+    def test_unordered(self):
+        self.assertRaises(ValueError, self.run_delim, '--write-index',
+                          '--unordered')
+
+class ControlsTestCase(DelimMixin, unittest.TestCase):
+    def test_controls(self):
+        nestagg.main(['controls', '-o', self.output, '-k', 'run_id', '-j',
+                      '2'] + self.controls)
+        with open(self.output) as fp:
+            rows = list(csv.reader(fp))
+        self.assertEqual([['run_id']] + [[str(i)] for i in range(6)], rows)
+
+    def test_where(self):
+        nestagg.main(['controls', '-o', self.output, '-k', 'run_id',
+                      '--where', 'run_id>=2', '--where', 'run_id!=4',
+                      '-d', self.td])
+        with open(self.output) as fp:
+            rows = list(csv.reader(fp))
+        self.assertEqual(['2', '3', '5'], sorted(r[0] for r in rows[1:]))
+
+    def test_where_expression(self):
+        self.assertEqual(('a', '=', 1), _common.where_expression('a=1'))
+        self.assertEqual(('a', '<=', 'x y'),
+                         _common.where_expression('a<=x y'))
+        self.assertRaises(argparse.ArgumentTypeError,
+                          _common.where_expression, 'a')
+
+    def test_json(self):
+        for i, c in enumerate(self.controls):
+            with open(os.path.join(os.path.dirname(c), 'result.json'),
+                      'w') as fp:
+                json.dump([{'score': i}, {'score': i + 0.5, 'note': 'x'}], fp)
+        nestagg.main(['json', '-f', 'jsonl', '-o', self.output, '-x',
+                      'OUTDIR', 'result.json'] + self.controls)
+        with open(self.output) as fp:
+            rows = [json.loads(line) for line in fp]
+        self.assertEqual(12, len(rows))
+        self.assertEqual({'score': 1.5, 'note': 'x', 'run_id': 1}, rows[3])
+
+    def test_nested_values(self):
+        control = collections.OrderedDict([('run_id', 0),
+                                           ('params', {'a': [1, 2]})])
+        with open(self.controls[0], 'w') as fp:
+            json.dump(control, fp)
+        with open(os.path.join(os.path.dirname(self.controls[0]),
+                               'result.json'), 'w') as fp:
+            json.dump({'scores': [0.5, 1], 'best': {'k': 3}}, fp)
+        for args in (['controls'], ['json', 'result.json']):
+            nestagg.main(args + [self.controls[0], '-o', self.output])
+            with open(self.output) as fp:
+                row = list(csv.DictReader(fp))[0]
+            self.assertEqual({'a': [1, 2]}, json.loads(row['params']))
+        self.assertEqual([0.5, 1], json.loads(row['scores']))
+        self.assertEqual({'k': 3}, json.loads(row['best']))
+
+class CacheTestCase(DelimMixin, unittest.TestCase):
+    def setUp(self):
+        super(CacheTestCase, self).setUp()
+        self.cache = os.path.join(self.td, 'cache')
+
+    def test_unchanged_not_parsed(self):
+        expected = self.run_delim('--cache', self.cache)
+        with mock.patch.object(nestagg, '_parse_delim') as parse:
+            actual = self.run_delim('--cache', self.cache)
+        self.assertFalse(parse.called)
+        self.assertEqual(expected, actual)
+
+    def test_changed_parsed(self):
+        self.run_delim('--cache', self.cache)
+        path = os.path.join(os.path.dirname(self.controls[0]), 'result.csv')
+        with open(path, 'w') as fp:
+            fp.write('x,y\n10,20\n')
+        rows = self.run_delim('--cache', self.cache)
+        self.assertEqual(['10', '20', '0', '0'], rows[1])
+        self.assertEqual(1 + 5 * 3 + 1, len(rows))
+
+    def cache_entries(self):
+        return [os.path.join(d, f) for d, _, files in os.walk(self.cache)
+                for f in files]
+
+    def test_changed_replaces_entry(self):
+        self.run_delim('--cache', self.cache)
+        self.assertEqual(6, len(self.cache_entries()))
+        path = os.path.join(os.path.dirname(self.controls[0]), 'result.csv')
+        with open(path, 'w') as fp:
+            fp.write('x,y\n10,20\n30,40\n')
+        self.run_delim('--cache', self.cache)
+        self.assertEqual(6, len(self.cache_entries()))
+
+    def test_invalid_entry(self):
+        expected = self.run_delim('--cache', self.cache)
+        for i, entry in enumerate(self.cache_entries()):
+            with open(entry, 'wb') as fp:
+                # Truncated, garbage, and a reference to a missing class
+                fp.write([b'', b'not a pickle',
+                          b'cnestly.missing\nThing\n.'][i % 3])
+        self.assertEqual(expected, self.run_delim('--cache', self.cache))
+
+class ColumnStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.columns = nestagg._ColumnStore()
+        self.columns.add(nestagg._DelimChunk(
+            'a.csv', ['x', 'y'], [('run', 'a')], [['1', '0.5'], ['2', '']],
+            None))
+        self.columns.add(nestagg._DelimChunk(
+            'b.csv', ['x', 'z'], [('run', 'b')], [['3', 'q']], None))
+
+    def tearDown(self):
+        self.columns.close()
+
+    def test_names(self):
+        self.assertEqual(['x', 'y', 'z', 'run'], self.columns.names)
+        self.assertEqual(3, self.columns.nrows)
+
+    def test_widen(self):
+        self.assertEqual(int, nestagg._widen(None, '-7'))
+        self.assertEqual(float, nestagg._widen(int, '1e3'))
+        self.assertEqual(float, nestagg._widen(None, 'NaN'))
+        self.assertEqual(float, nestagg._widen(float, 2))
+        self.assertEqual(str, nestagg._widen(None, 'a'))
+        self.assertEqual(str, nestagg._widen(None, True))
+        self.assertEqual(str, nestagg._widen(str, '1'))
+        self.assertEqual(None, nestagg._widen(None, ''))
+
+    def test_strict_numbers(self):
+        for value in ('1_000', ' 7 ', '7\n', '1_0.5', '0x10'):
+            self.assertEqual(str, nestagg._widen(None, value))
+
+    def test_types(self):
+        self.assertEqual(int, self.columns.column_type('x'))
+        self.assertEqual(float, self.columns.column_type('y'))
+        self.assertEqual(str, self.columns.column_type('z'))
+        self.assertFalse(self.columns.has_missing('x'))
+        self.assertTrue(self.columns.has_missing('y'))
+        self.assertTrue(self.columns.has_missing('z'))
+        self.assertEqual(1, self.columns.width('z'))
+
+    def test_batches(self):
+        batches = list(self.columns.batches())
+        self.assertEqual(1, len(batches))
+        n, batch = batches[0]
+        self.assertEqual(3, n)
+        self.assertEqual([1, 2, 3], batch['x'])
+        self.assertEqual([0.5, None, None], batch['y'])
+        self.assertEqual(['', '', 'q'], batch['z'])
+        self.assertEqual([0, 0, 1], batch['run'])
+        self.assertEqual(['a', 'b'], self.columns.categories('run'))
+
+    def test_small_batches(self):
+        batches = list(self.columns.batches(size=1))
+        self.assertEqual([2, 1], [n for n, _ in batches])
+        self.assertEqual([3], batches[1][1]['x'])
+        self.assertEqual([None], batches[1][1]['y'])
+
+    def test_collision(self):
+        self.assertRaises(ValueError, self.columns.add, nestagg._DelimChunk(
+            'c.csv', ['run'], [], [['1']], None))
+
+    def test_json_values(self):
+        columns = nestagg._ColumnStore()
+        columns.add(nestagg._DelimChunk('a.json', ['v', 'w'], [],
+                                        [[1, 'a'], [2.5, [1]], [None, True]],
+                                        None))
+        _, batch = next(columns.batches())
+        self.assertEqual([1.0, 2.5, None], batch['v'])
+        self.assertEqual(['a', '[1]', 'true'], batch['w'])
+        columns.close()
+
+class ColumnarMixin(DelimMixin):
+    def write(self, fmt, *args):
+        output = os.path.join(self.td, 'output')
+        nestagg.main(['delim', '-f', fmt, '-o', output] + list(args) +
+                     ['result.csv'] + self.controls)
+        self.assertEqual(['output'], [f for f in os.listdir(self.td)
+                                      if f.startswith('output')])
+        return output
+
+@unittest.skipIf(numpy is None, 'numpy not available')
+class NpzTestCase(ColumnarMixin, unittest.TestCase):
+    def test_npz(self):
+        with mock.patch.object(nestagg, 'COLUMNAR_BATCH_ROWS', 4):
+            output = self.write('npz')
+        with numpy.load(output) as data:
+            self.assertEqual(numpy.int64, data['y'].dtype)
+            self.assertEqual([0, 2, 4], list(data['y'][6:9]))
+            self.assertEqual(18, len(data['run_id']))
+            self.assertEqual(list(range(6)),
+                             list(data['run_id.categories']))
+            self.assertEqual([5, 5, 5], list(data['run_id'][-3:]))
+
+    def test_missing(self):
+        with open(os.path.join(os.path.dirname(self.controls[-1]),
+                               'result.csv'), 'w') as fp:
+            fp.write('x,z\n1,abc\n')
+        output = self.write('npz')
+        with numpy.load(output) as data:
+            self.assertEqual(numpy.float64, data['y'].dtype)
+            self.assertTrue(numpy.isnan(data['y'][-1]))
+            self.assertEqual(['', 'abc'], list(data['z'][-2:]))
+
+@unittest.skipIf(pyarrow is None, 'pyarrow not available')
+class ArrowTestCase(ColumnarMixin, unittest.TestCase):
+    def check(self, table):
+        self.assertEqual(18, table.num_rows)
+        self.assertEqual(['x', 'y', 'OUTDIR', 'run_id'],
+                         table.column_names)
+        self.assertEqual([0, 2, 4], table.column('y').to_pylist()[6:9])
+        self.assertEqual([5, 5, 5], table.column('run_id').to_pylist()[-3:])
+
+    def test_parquet(self):
+        import pyarrow.parquet
+        with mock.patch.object(nestagg, 'COLUMNAR_BATCH_ROWS', 4):
+            output = self.write('parquet')
+        parquet_file = pyarrow.parquet.ParquetFile(output)
+        self.assertEqual(3, parquet_file.num_row_groups)
+        self.check(parquet_file.read())
+
+    def test_union_order(self):
+        import pyarrow.parquet
+        with open(os.path.join(os.path.dirname(self.controls[-1]),
+                               'result.csv'), 'w') as fp:
+            fp.write('x,z\n1,abc\n')
+        table = pyarrow.parquet.read_table(self.write('parquet', '--union'))
+        # Data columns first, as in delimited output
+        self.assertEqual(self.run_delim('--union')[0], table.column_names)
+        self.assertEqual(['x', 'y', 'z', 'OUTDIR', 'run_id'],
+                         table.column_names)
+
+    def test_feather(self):
+        import pyarrow.feather
+        self.check(pyarrow.feather.read_table(self.write('feather')))
+
+    def test_arrow(self):
+        import pyarrow.ipc
+        with mock.patch.object(nestagg, 'COLUMNAR_BATCH_ROWS', 4):
+            output = self.write('arrow')
+        with pyarrow.OSFile(output, 'rb') as source:
+            reader = pyarrow.ipc.open_file(source)
+            self.assertEqual(3, reader.num_record_batches)
+            self.check(reader.read_all())
+
+def suite():
+    suite = unittest.TestSuite()
+    for cls in [ArrowTestCase, CacheTestCase, ColumnStoreTestCase,
+                ControlsTestCase, DelimTestCase, NpzTestCase,
+                WriteIndexTestCase]:
+        suite.addTest(unittest.makeSuite(cls))
+    return suite
@@ -0,0 +1,392 @@
+import argparse
+import contextlib
+import errno
+import json
+import os
+import os.path
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
+import unittest
+
+import mock
+
+from nestly import core
+from nestly.scripts import _adaptive, nestrun
+from nestly.scripts._common import select_control_files
+
+@contextlib.contextmanager
+def restore_signals():
+    """
+    nestrun.invoke installs signal handlers: put back the originals.
+    """
+    signums = (signal.SIGINT, signal.SIGTERM, signal.SIGUSR1)
+    handlers = [signal.getsignal(signum) for signum in signums]
+    try:
+        yield
+    finally:
+        for signum, handler in zip(signums, handlers):
+            signal.signal(signum, handler)
+
+def echo_a(control, working_dir):
+    """
+    Job for CallableTestCase: print ``a``, and fail if it is 3.
+    """
+    print(control['a'])
+    with open('cwd.txt', 'w') as fp:
+        fp.write(os.getcwd())
+    if control['a'] == 3:
+        return 2
+
+def fail(control, working_dir):
+    raise ValueError('failed in {0}'.format(working_dir))
+
+class CallableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.nest = core.Nest()
+        self.nest.add('a', [1, 2, 3])
+        self.nest.build(self.root)
+        self.summary_file = os.path.join(self.root, 'summary.tsv')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def run_nestrun(self, spec, *args):
+        with restore_signals():
+            nestrun.main(['--callable', spec, '--summary-file',
+                          self.summary_file, '-d', self.root] + list(args))
+        with open(self.summary_file) as fp:
+            rows = [line.rstrip('\n').split('\t') for line in fp][1:]
+        return dict((os.path.basename(r[0]), r) for r in rows)
+
+    def read(self, outdir, name):
+        with open(os.path.join(self.root, outdir, name)) as fp:
+            return fp.read()
+
+    def test_callable(self):
+        rows = self.run_nestrun(__name__ + ':echo_a')
+        for outdir, control in self.nest:
+            self.assertEqual('{0}\n'.format(control['a']),
+                             self.read(outdir, 'log.txt'))
+            self.assertEqual(os.path.realpath(os.path.join(self.root, outdir)),
+                             os.path.realpath(self.read(outdir, 'cwd.txt')))
+        self.assertEqual(['0', 'COMPLETE'], rows['1'][-2:])
+        self.assertEqual(['2', 'FAILED'], rows['3'][-2:])
+        self.assertEqual(__name__ + ':echo_a', rows['1'][1])
+
+    def test_exception(self):
+        rows = self.run_nestrun(__name__ + ':fail')
+        self.assertEqual(set(['1']), set(r[-2] for r in rows.values()))
+        log = self.read('2', 'log.txt')
+        self.assertIn('Traceback', log)
+        self.assertIn('ValueError: failed in', log)
+
+    def test_no_fork(self):
+        fork = os.fork
+        del os.fork
+        try:
+            with restore_signals():
+                self.assertRaises(SystemExit, nestrun.main,
+                                  ['--callable', __name__ + ':echo_a',
+                                   '-d', self.root])
+        finally:
+            os.fork = fork
+
+    def test_bad_spec(self):
+        for spec in ('os.path', 'os.path:nonexistent', 'nonexistent:f',
+                     'os:sep'):
+            with restore_signals():
+                self.assertRaises(SystemExit, nestrun.main,
+                                  ['--callable', spec, '-d', self.root])
+
+class AdaptiveLimitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.signals = {'load': 0.5, 'psi': 0.0, 'available': 0.5}
+        self.limit = _adaptive.AdaptiveLimit(
+                1, 4, interval=10, ncpus=4,
+                load=lambda: self.signals['load'] * 4,
+                psi=lambda: self.signals['psi'],
+                available=lambda: self.signals['available'],
+                clock=lambda: self.now)
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def step(self, running=None, completions=0):
+        for _ in range(completions):
+            self.limit.completed()
+        self.now += 10
+        if running is None:
+            running = self.limit.limit
+        return self.limit.update(running)
+
+    def test_interval(self):
+        self.now = 5
+        self.assertEqual(1, self.limit.update(1))
+        self.assertEqual([], self.limit.decisions)
+
+    def test_increase_to_maximum(self):
+        self.assertEqual([2, 3, 4, 4], [self.step() for _ in range(4)])
+        self.assertEqual('at maximum', self.limit.decisions[-1].reason)
+
+    def test_not_saturated(self):
+        self.assertEqual(1, self.step(running=0))
+        self.assertEqual('limit not reached', self.limit.decisions[-1].reason)
+
+    def test_load(self):
+        self.step()
+        self.step()
+        self.signals['load'] = 1.5
+        self.assertEqual(2, self.step())
+        self.assertEqual('load above CPU count',
+                         self.limit.decisions[-1].reason)
+
+    def test_memory(self):
+        for _ in range(3):
+            self.step()
+        self.signals['psi'] = 25.0
+        self.assertEqual(2, self.step())
+        self.signals['psi'] = None
+        self.signals['available'] = 0.05
+        self.assertEqual(1, self.step())
+        self.assertEqual(1, self.step())
+        self.assertEqual('memory pressure', self.limit.decisions[-1].reason)
+
+    def test_throughput(self):
+        self.assertEqual(2, self.step(completions=10))
+        self.assertEqual(1, self.step(completions=5))
+        self.assertEqual('throughput fell', self.limit.decisions[-1].reason)
+
+    def test_memory_psi(self):
+        path = os.path.join(self.root, 'memory')
+        with open(path, 'w') as fp:
+            fp.write('some avg10=1.50 avg60=0.00 avg300=0.00 total=10\n'
+                     'full avg10=0.25 avg60=0.00 avg300=0.00 total=5\n')
+        self.assertEqual(1.5, _adaptive.memory_psi(path))
+        self.assertEqual(None, _adaptive.memory_psi(path + '.missing'))
+
+    def test_memory_available(self):
+        path = os.path.join(self.root, 'meminfo')
+        with open(path, 'w') as fp:
+            fp.write('MemTotal:        1000 kB\nMemFree:          100 kB\n'
+                     'MemAvailable:     250 kB\n')
+        self.assertEqual(0.25, _adaptive.memory_available(path))
+        self.assertEqual(None, _adaptive.memory_available(path + '.missing'))
+
+    def test_run_auto(self):
+        nest = core.Nest()
+        nest.add('a', [1, 2, 3])
+        nest.build(self.root)
+        with restore_signals():
+            nestrun.main(['-j', 'auto', '--max-processes', '2',
+                          '--template', 'echo {a}', '-d', self.root])
+        for outdir, control in nest:
+            with open(os.path.join(self.root, outdir, 'log.txt')) as fp:
+                self.assertEqual('{0}\n'.format(control['a']), fp.read())
+
+    def test_wait_child(self):
+        # Reap children left by other tests, which wait_child would return
+        try:
+            while os.waitpid(-1, os.WNOHANG)[0]:
+                pass
+        except OSError:
+            pass
+        sleeper = subprocess.Popen(['sleep', '5'])
+        try:
+            start = time.time()
+            self.assertEqual((0, 0), nestrun.wait_child(0.1))
+            # Returns as soon as a child exits, well before the timeout
+            child = subprocess.Popen(['true'])
+            pid, status = nestrun.wait_child(30)
+            self.assertEqual((child.pid, 0), (pid, status))
+            self.assertTrue(time.time() - start < 5)
+        finally:
+            sleeper.kill()
+            os.waitpid(sleeper.pid, 0)
+
+
+    def test_processes_argument(self):
+        self.assertEqual('auto', nestrun.processes('auto'))
+        self.assertEqual(3, nestrun.processes('3'))
+        self.assertRaises(argparse.ArgumentTypeError, nestrun.processes, '0')
+        self.assertRaises(argparse.ArgumentTypeError, nestrun.processes, 'x')
+
+class ShardTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.nest = core.Nest()
+        self.nest.add('a', [2, 1, 10])
+        self.nest.add('b', ['y', 'x'])
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def control_file(self, a, b):
+        return os.path.join(self.root, str(a), b, 'control.json')
+
+    def test_index_sorted(self):
+        self.nest.build(self.root)
+        self.assertEqual([self.control_file(1, 'x')],
+                         select_control_files([], self.root, index=0))
+        self.assertEqual([self.control_file(10, 'y')],
+                         select_control_files([], self.root, index=3))
+        self.assertRaises(IndexError, select_control_files, [], self.root,
+                          index=6)
+
+    def test_index_manifest(self):
+        self.nest.build(self.root, manifest=True)
+        for i, (outdir, _) in enumerate(self.nest):
+            self.assertEqual(
+                [os.path.join(self.root, outdir, 'control.json')],
+                select_control_files([], self.root, index=i))
+
+    def test_index_where(self):
+        self.nest.build(self.root)
+        self.assertEqual([self.control_file(10, 'x')],
+                         select_control_files([], self.root,
+                                              where=[('b', '=', 'x')],
+                                              index=1))
+
+    def test_shard(self):
+        self.nest.build(self.root)
+        shards = [select_control_files([], self.root, shard=(i, 4))
+                  for i in range(4)]
+        self.assertEqual([2, 2, 1, 1], [len(s) for s in shards])
+        self.assertEqual(sorted(core.control_iter(self.root)),
+                         sorted(p for s in shards for p in s))
+
+    def test_run_index(self):
+        self.nest.build(self.root, manifest=True)
+        with restore_signals():
+            nestrun.main(['--template', 'true', '--index', '2',
+                          '-d', self.root])
+        logs = [os.path.exists(os.path.join(self.root, outdir, 'log.txt'))
+                for outdir, _ in self.nest]
+        self.assertEqual([False, False, True, False, False, False], logs)
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        nest = core.Nest()
+        nest.add('a', [1, 2, 3])
+        nest.build(self.root)
+        self.template_file = os.path.join(self.root, 'run.sh')
+        with open(self.template_file, 'w') as fp:
+            fp.write('echo {a}\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def run_nestrun(self, *args):
+        metrics_file = os.path.join(self.root, 'metrics.txt')
+        with restore_signals():
+            nestrun.main(['--template', 'true', '--template-file',
+                          self.template_file, '--metrics-file', metrics_file,
+                          '-d', self.root] + list(args))
+        with open(metrics_file) as fp:
+            return fp.read()
+
+    def test_jsonl(self):
+        events = [json.loads(l) for l in self.run_nestrun().splitlines()]
+        phases = {}
+        for e in events:
+            phases.setdefault(e['phase'], set()).add(e['job'])
+            self.assertTrue(e['duration'] >= 0)
+        self.assertEqual(
+            set(['load', 'render', 'write', 'spawn', 'dispatch', 'run']),
+            set(phases))
+        for jobs in phases.values():
+            self.assertEqual(3, len(jobs))
+
+    def test_prometheus(self):
+        lines = self.run_nestrun('--metrics-format', 'prometheus').splitlines()
+        self.assertIn('nestrun_phase_seconds_count{phase="run"} 3', lines)
+
+    def test_auto(self):
+        events = [json.loads(l)
+                  for l in self.run_nestrun('-j', 'auto').splitlines()]
+        dispatch = [e for e in events if e['phase'] == 'dispatch']
+        self.assertEqual(3, len(dispatch))
+        self.assertTrue(all(e['duration'] >= 0 for e in dispatch))
+
+class LinkTemplateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.nest = core.Nest()
+        self.nest.add('a', [1, 2, 3])
+        self.nest.add('b', ['x', 'y'])
+        self.nest.build(self.root)
+        self.template_file = os.path.join(self.root, 'run.sh')
+        with open(self.template_file, 'w') as fp:
+            fp.write('#!/bin/sh\necho {a}\n')
+        os.chmod(self.template_file, 0o755)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def run_nestrun(self, how):
+        with restore_signals():
+            nestrun.main(['--template-file', self.template_file,
+                          '--link-template-file', how, '-d', self.root])
+
+    def job_file(self, outdir, name):
+        return os.path.join(self.root, outdir, name)
+
+    def check_logs(self):
+        for outdir, control in self.nest:
+            with open(self.job_file(outdir, 'log.txt')) as fp:
+                self.assertEqual('{0}\n'.format(control['a']), fp.read())
+
+    def cache(self):
+        return os.path.join(self.root, nestrun.TEMPLATE_CACHE)
+
+    def test_hardlink(self):
+        self.run_nestrun('hardlink')
+        self.check_logs()
+        self.assertEqual(3, len(os.listdir(self.cache())))
+        inodes = {}
+        for outdir, control in self.nest:
+            st = os.stat(self.job_file(outdir, 'run.sh'))
+            inodes.setdefault(control['a'], set()).add(st.st_ino)
+            self.assertEqual(3, st.st_nlink)
+            self.assertTrue(st.st_mode & 0o100)
+        self.assertEqual([1, 1, 1], [len(i) for i in inodes.values()])
+
+    def test_symlink(self):
+        self.run_nestrun('symlink')
+        self.check_logs()
+        for outdir, control in self.nest:
+            path = self.job_file(outdir, 'run.sh')
+            self.assertTrue(os.path.islink(path))
+            self.assertEqual(self.cache(),
+                             os.path.dirname(os.path.realpath(path)))
+
+    def test_rerun(self):
+        self.run_nestrun('symlink')
+        self.run_nestrun('hardlink')
+        self.check_logs()
+        self.assertEqual(3, len(os.listdir(self.cache())))
+        for outdir, _ in self.nest:
+            self.assertFalse(os.path.islink(self.job_file(outdir, 'run.sh')))
+
+    def test_copymode_eperm(self):
+        error = OSError(errno.EPERM, 'Operation not permitted')
+        with mock.patch.object(nestrun.shutil, 'copymode',
+                               side_effect=error), \
+                mock.patch.object(nestrun.logging, 'warn') as warn:
+            path = nestrun.cache_template('echo 1\n', self.template_file,
+                                          self.cache())
+        self.assertEqual(1, warn.call_count)
+        with open(path) as fp:
+            self.assertEqual('echo 1\n', fp.read())
+
+def suite():
+    suite = unittest.TestSuite()
+    for cls in [AdaptiveLimitTestCase, CallableTestCase, LinkTemplateTestCase, MetricsTestCase, ShardTestCase]:
+        suite.addTest(unittest.makeSuite(cls))
+    return suite
@@ -1,9 +1,37 @@
 import copy
+import json
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
+import warnings
+
 import mock
 
 from nestly import scons, Nest
 
+try:
+    import SCons
+except ImportError:
+    SCons = None
+
+# Builds one control file per item with add_controls(batch=True). The value
+# for item 2 is taken from the command line.
+SCONSTRUCT = '''
+from nestly import Nest
+from nestly.scons import SConsWrap
+
+n = Nest()
+n.add('item', [1, 2])
+w = SConsWrap(n, 'build')
+w.add('value', lambda c: [ARGUMENTS.get('value', 0) if c['item'] == 2 else 0],
+      create_dir=False)
+w.add_controls(Environment(), batch=True)
+'''
+
 class OutputCopyingMock(mock.MagicMock):
     def __call__(self, *args, **kwargs):
         return copy.deepcopy(super(OutputCopyingMock, self).__call__(*args, **kwargs))
@@ -32,6 +60,132 @@ class AddTargetWithEnvTestCase(unittest.TestCase):
                  mock.call({'item': 2, 'OUTDIR': './2'}, './2', {'item': 2, 'OUTDIR': '2'})]
         self.func_mock.assert_has_calls(calls)
 
+    def test_override(self):
+        env = mock.MagicMock(name='MockSConsEnvironment')
+        w = scons.SConsWrap(self.n)
+
+        w.add_target_with_env(env, clone=False)(self.func_mock)
+
+        self.assertFalse(env.Clone.called)
+        env.Override.assert_has_calls([
+            mock.call({'item': 1, 'OUTDIR': './1'}),
+            mock.call({'item': 2, 'OUTDIR': './2'})])
+        self.assertEqual(2, self.func_mock.call_count)
+
+    def test_warn_once(self):
+        self.env.Clone.return_value = {'item': 0}
+        w = scons.SConsWrap(self.n)
+
+        with mock.patch.object(scons.logger, 'warn') as warn:
+            w.add_target_with_env(self.env)(self.func_mock)
+        self.assertEqual(1, warn.call_count)
+
+def _flatten(values):
+    result = []
+    for v in values:
+        if isinstance(v, list):
+            result.extend(_flatten(v))
+        else:
+            result.append(v)
+    return result
+
+class AliasTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = mock.Mock(['Alias', 'Flatten'], name='MockSConsEnvironment')
+        self.env.Flatten.side_effect = _flatten
+
+    def build(self, **kwargs):
+        w = scons.SConsWrap(Nest(), alias_environment=self.env, **kwargs)
+        w.add('algorithm', ['pam', 'mmc'])
+        w.add('tree', [1, 2])
+
+        @w.add_target()
+        def result(outdir, c):
+            return ['{0}-{1}'.format(c['algorithm'], c['tree'])]
+        return w
+
+    def test_key_alias(self):
+        self.build()
+        self.env.Alias.assert_called_once_with(
+            'result', ['pam-1', 'pam-2', 'mmc-1', 'mmc-2'])
+
+    def test_level_aliases(self):
+        self.build(level_aliases=True)
+        self.env.Alias.assert_has_calls([
+            mock.call('result', ['pam-1', 'pam-2', 'mmc-1', 'mmc-2']),
+            mock.call('algorithm:pam', ['pam-1', 'pam-2']),
+            mock.call('tree:1', ['pam-1', 'mmc-1']),
+            mock.call('tree:2', ['pam-2', 'mmc-2']),
+            mock.call('algorithm:mmc', ['mmc-1', 'mmc-2'])])
+        self.assertEqual(5, self.env.Alias.call_count)
+
+    def test_skip_dicts(self):
+        w = scons.SConsWrap(Nest(), alias_environment=self.env)
+        w.add('level', [1])
+        with warnings.catch_warnings(record=True) as warned:
+            warnings.simplefilter('always')
+            w.add_target()(lambda outdir, c: {'a': 1})
+        self.assertEqual(1, len(warned))
+        self.assertFalse(self.env.Alias.called)
+
+class AddControlsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = mock.Mock(['Command', 'Precious', 'Value'],
+                             name='MockSConsEnvironment')
+        self.env.Command.side_effect = lambda target, source, **kw: list(target)
+        n = Nest()
+        n.add('item', [1, 2])
+        self.w = scons.SConsWrap(n, 'build')
+
+    def test_batch(self):
+        with mock.patch.object(scons, 'HAS_SCONS', True):
+            self.w.add_controls(self.env, batch=True,
+                                encoder_cls=json.JSONEncoder)
+
+        self.assertEqual(1, self.env.Command.call_count)
+        args, kwargs = self.env.Command.call_args
+        self.assertEqual(['build/1/control.json', 'build/2/control.json'],
+                         args[0])
+        self.assertEqual([{'item': 1, 'OUTDIR': '1'},
+                          {'item': 2, 'OUTDIR': '2'}],
+                         [json.loads(c) for c in kwargs['control_contents']])
+        self.assertEqual([['build/1/control.json'], ['build/2/control.json']],
+                         [c['control'] for _, c in self.w])
+        self.env.Precious.assert_called_once_with(args[0])
+
+    @unittest.skipIf(SCons is None, 'SCons not available')
+    def test_batch_build(self):
+        td = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(td, 'SConstruct'), 'w') as fp:
+                fp.write(SCONSTRUCT)
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.pathsep.join(
+                [os.path.dirname(os.path.dirname(scons.__file__))] +
+                [p for p in [env.get('PYTHONPATH')] if p])
+
+            def build(value):
+                subprocess.check_call(
+                    [sys.executable, '-m', 'SCons', '-Q',
+                     'value={0}'.format(value)],
+                    cwd=td, env=env, stdout=subprocess.PIPE)
+
+            paths = [os.path.join(td, 'build', item, 'control.json')
+                     for item in ('1', '2')]
+            build(0)
+            mtime = os.path.getmtime(paths[0]) - 100
+            for path in paths:
+                os.utime(path, (mtime, mtime))
+
+            # Only the control file for item 2 changes
+            build(1)
+            self.assertEqual(mtime, os.path.getmtime(paths[0]))
+            self.assertNotEqual(mtime, os.path.getmtime(paths[1]))
+            with open(paths[1]) as fp:
+                self.assertEqual('1', json.load(fp)['value'])
+        finally:
+            shutil.rmtree(td)
+
 class CheckpointTestCase(unittest.TestCase):
     def setUp(self):
         self.nest = Nest()
@@ -83,6 +237,46 @@ class CheckpointTestCase(unittest.TestCase):
             self.assertFalse('level2' in c)
             self.assertTrue('level1' in c)
 
+    def test_checkpoint_order(self):
+        self.assertEqual(['level1', 'level2'], list(self.w.checkpoints))
+        # Each checkpoint holds the nest the next level was added to
+        n1 = self.w.checkpoints['level2']
+        self.w.pop()
+        self.assertTrue(self.w.nest is n1)
+
+    def test_pop_then_add(self):
+        w = self.w
+        w.pop('level2')
+        w.add('level3', ['a'])
+        self.assertEqual(['level1', 'level3'], list(w.checkpoints))
+        w.pop('level1')
+        self.assertTrue(w.nest is self.nest)
+        self.assertEqual([], list(w.checkpoints))
+        self.assertRaises(KeyError, w.pop, 'level3')
+        self.assertRaises(KeyError, w.pop)
+
+    def test_shared_history(self):
+        w = self.w
+        w.add_target('target1')(lambda outdir, c: c['level2'])
+        w.add('level3', ['a', 'b'])
+        w.add_target('target2')(lambda outdir, c: c['level3'])
+
+        # Checkpoints keep no control dictionaries of their own...
+        for nest in w.checkpoints.values():
+            self.assertTrue(nest._control_list is None)
+        # ...only history nodes, which the leaves point back into
+        parents = w.checkpoints['level3']._history
+        self.assertEqual(6, len(parents))
+        grandparents = set(id(node.parent.parent) for node in w.nest._history)
+        self.assertEqual(set(id(node) for node in parents), grandparents)
+        self.assertEqual(('target2', 'a'), w.nest._history[0].items[0])
+
+        w.pop('level3')
+        self.assertEqual([(l1, l2, l2) for l1 in range(2) for l2 in (1, 2, 3)],
+                         [(c['level1'], c['level2'], c['target1'])
+                          for _, c in w])
+        self.assertEqual('0/1', next(iter(w))[1]['OUTDIR'])
+
     def test_pop_missing(self):
         self.assertRaises(KeyError, self.w.pop, 'missing_key')
         self.assertEqual(['level1', 'level2'],
@@ -91,6 +285,7 @@ class CheckpointTestCase(unittest.TestCase):
 
 def suite():
     suite = unittest.TestSuite()
-    for cls in [AddTargetWithEnvTestCase, CheckpointTestCase]:
+    for cls in [AddControlsTestCase, AddTargetWithEnvTestCase, AliasTestCase,
+                CheckpointTestCase]:
         suite.addTest(unittest.makeSuite(cls))
     return suite
@@ -0,0 +1,74 @@
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from nestly import core, shared
+
+def _outdir(d, c):
+    return d, c['run_id']
+
+class ControlTableTestCase(unittest.TestCase):
+    use_mmap = False
+
+    def setUp(self):
+        self.items = [('a/control.json', {'run_id': 1, 'x': [1, 2]}),
+                      ('b/control.json', {'run_id': 2, 'x': None})]
+        self.table = shared.ControlTable.create(self.items,
+                                                use_mmap=self.use_mmap)
+
+    def tearDown(self):
+        self.table.close()
+        self.table.unlink()
+
+    def test_getitem(self):
+        self.assertEqual(2, len(self.table))
+        self.assertEqual(self.items, list(self.table))
+        self.assertEqual(self.items[1], self.table[-1])
+        self.assertRaises(IndexError, self.table.__getitem__, 2)
+
+    def test_attach(self):
+        other = shared.ControlTable.attach(self.table.handle)
+        try:
+            self.assertEqual(self.items, list(other))
+        finally:
+            other.close()
+
+    def test_empty(self):
+        with shared.ControlTable.create([], use_mmap=self.use_mmap) as table:
+            self.assertEqual([], list(table))
+
+class MmapControlTableTestCase(ControlTableTestCase):
+    use_mmap = True
+
+    def test_removed(self):
+        with shared.ControlTable.create(self.items, use_mmap=True) as table:
+            path = table.handle[1]
+            self.assertTrue(os.path.exists(path))
+        self.assertFalse(os.path.exists(path))
+
+class SharedNestMapTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        nest = core.Nest()
+        nest.add('run_id', list(range(20)))
+        nest.build(self.root)
+        self.controls = sorted(core.control_iter(self.root))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_nest_map(self):
+        expected = list(core.nest_map(self.controls, _outdir))
+        actual = list(core.nest_map(self.controls, _outdir, processes=3))
+        self.assertEqual(expected, actual)
+        self.assertEqual(20, len(actual))
+
+def suite():
+    suite = unittest.TestSuite()
+    for cls in [ControlTableTestCase,
+            MmapControlTableTestCase,
+            SharedNestMapTestCase]:
+        suite.addTest(unittest.makeSuite(cls))
+    return suite